@@ -1,34 +1,139 @@
+import asyncio
+import atexit
 import logging
+import multiprocessing
+import multiprocessing.connection
 import signal
-from base64 import b64encode
+import threading
 from concurrent import futures
 from datetime import datetime
+from itertools import product
 from time import perf_counter_ns
 
 import grpc
 import numpy as np
 import pytz
+from grpc import aio
+from grpc_health.v1 import health, health_pb2, health_pb2_grpc
 from google.protobuf.timestamp_pb2 import Timestamp
 
-from pfizer import compute_probs as compute_pfizer_probs
+import pfizer
+import tts
 from proto import corical_pb2, corical_pb2_grpc
-from risks import generate_relatable_risks
-from tts import compute_probs, scenario_to_vec
-from tts_util import get_age_bracket, get_age_bracket_pz, get_age_bracket_children, get_link, get_comparison_doses
-from model import SmileModel
+from tts_util import get_age_bracket, get_age_bracket_pz, get_age_bracket_pfizer, get_age_bracket_children, get_link, get_comparison_doses, sex_vecs
+import config
+import metrics
+import responses
+import texts
+from async_server import stream_in_executor, unary_in_executor
+from binlog import BinlogSink, binlog_request, read_binlogs, recent_binlogs
+from cache import ResponseCache
+from model import ModelRegistry, compute_outcome_intervals, compute_outcome_sensitivities, compute_outcomes
+from tables import (
+    CombinedTable,
+    combined_baseline_outcomes,
+    combined_evidence,
+    combined_infected_outcomes,
+    compute_combined_outcomes,
+)
 
 utc = pytz.UTC
 
 logging.basicConfig(format="%(asctime)s: %(name)s: %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-server = grpc.server(futures.ThreadPoolExecutor(32))
-server.add_insecure_port(f"[::]:21000")
-
-
 PZ_children_model_file = "pfizer_children_02-09.xdsl"
 combined_model_file = "combined_22-09-22.xdsl"
 
+# health checks report on the server as a whole and on the Corical service
+health_services = ["", "corical.Corical"]
+
+# ComputeTTSReq.compute_count repetitions evaluated per batch
+timing_batch_repeats = 1000
+
+children_baseline_outcomes = {
+    "get_myocarditis_vax": "n10_Myo_Vax",
+    "get_myocarditis_bg": "n11_Myo_Background",
+    "risk_of_infection": "n9_Risk_Infection",
+}
+
+children_infected_outcomes = {
+    "get_myocarditis_given_infected": "n12_Myo_Covid",
+    # unclear if these should be given infected or not
+    "hospitalisation_given_infected": "n13_Hospital",
+    "MSIC_given_infected": "n15_MSI_Covid",
+    "severse_MSIC_given_infected": "n16_MSI_severe",
+}
+
+# the files are the defaults, a newer one can be swapped in while serving
+registry = ModelRegistry(config.ENGINE, pool_size=config.THREADS)
+registry.register(
+    "pfizer_children",
+    PZ_children_model_file,
+    nodes=["n3_Sex", "n1_Vax", "n2_Age", "n4_Transmission"]
+    + list(children_baseline_outcomes.values())
+    + list(children_infected_outcomes.values()),
+)
+registry.register(
+    "combined",
+    combined_model_file,
+    nodes=["n5_Sex", "n1_Dose", "n2_Age", "n4_Transmission"]
+    + list(combined_baseline_outcomes.values())
+    + list(combined_infected_outcomes.values()),
+)
+
+# registered model -> its baseline outcomes, infected outcomes and infection
+# node, for Sensitivity
+sensitivity_outcomes = {
+    "pfizer_children": (children_baseline_outcomes, children_infected_outcomes, "n9_Risk_Infection"),
+    "combined": (combined_baseline_outcomes, combined_infected_outcomes, "n14_Infection_at_current_transmission"),
+}
+
+# CPT entries a Sensitivity call returns unless it asks for a number
+sensitivity_top_k = 20
+
+# model version -> CombinedTable, for the active combined network only
+combined_tables = {}
+
+response_cache = ResponseCache(config.CACHE_SIZE, config.CACHE_TTL)
+
+# templates of the text of compact responses, the same in every worker
+string_catalogue = responses.StringCatalogue(texts.catalogue())
+
+# catalogues never change, so clients and proxies can keep them
+string_catalogue_metadata = (("cache-control", "public, max-age=31536000, immutable"),)
+
+binlog_sink = BinlogSink(
+    config.BINLOG_DIR,
+    max_bytes=config.BINLOG_MAX_BYTES,
+    backup_count=config.BINLOG_BACKUP_COUNT,
+    compress=config.BINLOG_COMPRESS,
+    queue_size=config.BINLOG_QUEUE_SIZE,
+    policy=config.BINLOG_POLICY,
+)
+
+metrics.Gauge("corical_cache_entries", "Responses in the response cache", lambda: response_cache.stats()["entries"])
+metrics.Gauge("corical_binlog_dropped", "Binlog records dropped since start", lambda: binlog_sink.dropped)
+metrics.Gauge("corical_binlog_written", "Binlog records written since start", lambda: binlog_sink.written)
+
+
+def load_combined_table(network):
+    """
+    Map the precomputed table of a new combined network version in place of
+    the old one. Returns whether lookups will be served from it.
+    """
+    global combined_tables
+    if network.name != "combined":
+        return False
+    table = CombinedTable(network.file)
+    used = table.load()
+    combined_tables = {network.version: table}
+    return used
+
+
+registry.on_swap.append(load_combined_table)
+
+
 def now():
     return datetime.now(utc)
 
@@ -39,16 +144,6 @@ def Timestamp_from_datetime(dt: datetime):
     return pb_ts
 
 
-def generate_bar_graph_risks(input_risks):
-    return sorted(input_risks, key=lambda br: br.risk) + [
-        corical_pb2.BarGraphRisk(
-            label=r["event"],
-            risk=r["risk"],
-            is_relatable=True,
-        )
-        for r in generate_relatable_risks([risk.risk for risk in input_risks])
-    ]
-
 def calculate_clots(outcomes):
     die_from_clots = (outcomes["die_from_csvt"] + outcomes["die_from_pvt"] 
                     - outcomes["die_from_csvt"] * outcomes["die_from_pvt"])
@@ -70,32 +165,734 @@ def calculate_clots(outcomes):
 
 
 
+def risk_interval(outcomes, name):
+    """
+    (lower, upper) interval of an outcome for responses.bar, or None if
+    intervals weren't asked for
+    """
+    bounds = outcomes.get("intervals")
+    if bounds is None:
+        return None
+    return bounds[name]
+
+
+def cached_response(key, build, request):
+    """
+    Serialised ComputeRes for the request, from the response cache or build(),
+    which returns one from responses.compute_res. msg holds the raw request,
+    so it is appended per request instead of cached.
+
+    Compact responses are cached under the key plus "compact", and made from
+    the full response.
+    """
+    if request.compact:
+        return _cached(
+            key + ("compact",), lambda: responses.compact_res(key[1:], _cached(key, build), string_catalogue)
+        )
+    # fields of concatenated messages merge, so this just sets msg
+    return _cached(key, build) + corical_pb2.ComputeRes(msg=str(request)).SerializeToString()
+
+
+def _cached(key, build):
+    res = response_cache.get(key)
+    metrics.cache_lookups.inc(rpc=key[0], result="miss" if res is None else "hit")
+    metrics.lap("cache")
+    if res is None:
+        res = build()
+        response_cache.put(key, res)
+    return res
+
+
+# response cache keys: ages are only used by bracket, so requests within one
+# share a response
+
+
+def tts_key(request):
+    return (
+        "ComputeTTS",
+        tts.model().source_sha256[:12],
+        request.sex,
+        get_age_bracket(request.age)[1],
+        request.transmission,
+        request.vaccine,
+    )
+
+
+def pfizer_key(request):
+    return (
+        "ComputePfizer",
+        pfizer.model().source_sha256[:12],
+        request.sex,
+        get_age_bracket_pfizer(request.age)[1],
+        request.ct,
+        request.dose,
+    )
+
+
+def children_key(request, network):
+    return (
+        "ComputePfizerChildren",
+        network.version,
+        request.sex,
+        get_age_bracket_children(request.age)[1],
+        request.ct,
+        request.credible_intervals,
+    )
+
+
+def combined_key(request, network):
+    return (
+        "ComputeCombined",
+        network.version,
+        request.sex,
+        get_age_bracket_pz(request.age)[1],
+        request.ct,
+        request.dose_number,
+        request.dose_2,
+        request.dose_3,
+        request.dose_time,
+        request.credible_intervals,
+    )
+
+
+def response_key(rpc, request):
+    """
+    Response cache key of a request to one of the Compute RPCs
+    """
+    if rpc == "ComputeTTS":
+        return tts_key(request)
+    if rpc == "ComputePfizer":
+        return pfizer_key(request)
+    if rpc == "ComputePfizerChildren":
+        return children_key(request, registry.current("pfizer_children"))
+    return combined_key(request, registry.current("combined"))
+
+
+def warm_set(paths, since=0):
+    """
+    Distinct responses asked for in binlog files, most frequent first
+
+    Params:
+        paths - binlog files, see binlog.read_binlogs
+        since - only count requests from this time on, in seconds since the epoch
+    Returns list of (count, cache key, rpc, request)
+    """
+    counts = {}
+    for path in paths:
+        for binlog in read_binlogs(path):
+            if binlog.time.seconds < since:
+                continue
+            rpc, request = binlog_request(binlog)
+            # timing runs are never served from the cache
+            if rpc is None or rpc == "ComputeTTS" and request.compute_count:
+                continue
+            try:
+                key = response_key(rpc, request)
+            except Exception:
+                # an age out of range, which was turned away
+                continue
+            if key in counts:
+                counts[key][0] += 1
+            else:
+                counts[key] = [1, rpc, request]
+    return sorted(((count, key, rpc, request) for key, (count, rpc, request) in counts.items()), key=lambda entry: -entry[0])
+
+
+class WarmContext:
+    """
+    The parts of grpc.ServicerContext the build methods use, for building
+    responses outside a call
+    """
+
+    def is_active(self):
+        return True
+
+    def time_remaining(self):
+        return None
+
+    def abort(self, code, details):
+        raise ValueError(details)
+
+
+def warm_cache(paths, max_bytes, since=0):
+    """
+    Build the responses most often asked for in binlog files and put them in
+    the response cache, most frequent first, until they take up max_bytes or
+    fill the cache. The models' plan caches fill along the way.
+
+    Params:
+        paths, since - as for warm_set
+    Returns the number of responses cached
+    """
+    start = perf_counter_ns()
+    servicer = Corical()
+    context = WarmContext()
+    builders = {
+        "ComputeTTS": lambda request: servicer.build_tts(request, context),
+        "ComputePfizer": lambda request: servicer.build_pfizer(request, context),
+        "ComputePfizerChildren": lambda request: servicer.build_pfizer_children(
+            request, context, registry.current("pfizer_children")
+        ),
+        "ComputeCombined": lambda request: servicer.build_combined(request, context, registry.current("combined")),
+    }
+    used = cached = 0
+    for count, key, rpc, request in warm_set(paths, since):
+        if cached >= response_cache.max_entries:
+            break
+        try:
+            res = builders[rpc](request)
+        except Exception as e:
+            logger.warning(f"Could not warm {rpc} response {key}: {e}")
+            continue
+        if used + len(res) > max_bytes:
+            break
+        response_cache.put(key, res)
+        used += len(res)
+        cached += 1
+    logger.info(f"Warmed {cached} responses ({used} bytes) in {(perf_counter_ns() - start) / 1e6:.0f} ms")
+    return cached
+
+
+def serialize_response(response):
+    # cached responses are already serialised
+    if isinstance(response, bytes):
+        return response
+    return response.SerializeToString()
+
+
+def check_deadline(context):
+    """
+    Abort if the caller has gone away or its deadline has passed, so that
+    abandoned requests don't use up inference time
+    """
+    if not context.is_active():
+        context.abort(grpc.StatusCode.CANCELLED, "Request cancelled")
+    remaining = context.time_remaining()
+    if remaining is not None and remaining <= 0:
+        context.abort(grpc.StatusCode.DEADLINE_EXCEEDED, "Deadline exceeded")
+
+
+def check_finite(context, probs):
+    """
+    Abort rather than answer with risks that aren't numbers, which would sort
+    anywhere and be compared to a relatable risk of 100%
+    """
+    if not np.isfinite(probs).all():
+        logger.error(f"Non-finite risks: {probs}")
+        context.abort(grpc.StatusCode.INTERNAL, "Could not compute the risks for this scenario")
+
+
+def check_possible(context, outcomes):
+    """
+    Abort with INVALID_ARGUMENT if a scenario is impossible in the network,
+    such as infection without community transmission, whose outcomes come
+    out nan
+
+    Params:
+        outcomes - list of dictionaries, as from model.compute_outcomes
+    """
+    if not all(np.isfinite(list(dose_outcomes.values())).all() for dose_outcomes in outcomes):
+        context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Impossible scenario for the network")
+
+
+def add_servicer(servicer, server, executor=None):
+    """
+    corical_pb2_grpc.add_CoricalServicer_to_server, except that handlers may
+    return pre-serialised responses. Given an executor, the handlers are run
+    in it on a grpc.aio server.
+    """
+    handlers = {}
+    for method in corical_pb2.DESCRIPTOR.services_by_name["Corical"].methods:
+        behaviour = getattr(servicer, method.name)
+        if method.server_streaming:
+            handler = grpc.unary_stream_rpc_method_handler
+            if executor is not None:
+                behaviour = stream_in_executor(behaviour, executor)
+        else:
+            handler = grpc.unary_unary_rpc_method_handler
+            if executor is not None:
+                behaviour = unary_in_executor(behaviour, executor)
+        handlers[method.name] = handler(
+            behaviour,
+            request_deserializer=getattr(corical_pb2, method.input_type.name).FromString,
+            response_serializer=serialize_response,
+        )
+    server.add_generic_rpc_handlers((grpc.method_handlers_generic_handler("corical.Corical", handlers),))
+
+
 class Corical(corical_pb2_grpc.CoricalServicer):
-    def ComputePfizerChildren(self, request, context):
-        start = perf_counter_ns()
-        time = Timestamp_from_datetime(now())
+    def ComputeTTS(self, request, context):
+        with metrics.track("ComputeTTS", context):
+            start = perf_counter_ns()
+            time = Timestamp_from_datetime(now())
+
+            logger.debug(request)
 
-        logger.info(request)
+            try:
+                key = tts_key(request)
+            except Exception:
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Invalid age")
+            if request.compute_count:
+                # timing runs are never served from the cache
+                res = self.build_tts(request, context)
+            else:
+                res = cached_response(key, lambda: self.build_tts(request, context), request)
 
+            duration = (perf_counter_ns() - start) / 1e6  # ms
+            binlog_sink.log(
+                time=time,
+                tts_req=request,
+                res=res,
+                duration_ms=duration,
+                model_version=tts.model().source_sha256[:12],
+            )
+            metrics.lap("log")
+
+            return res
+
+    def build_tts(self, request, context):
         messages = []
 
         # sex
         if request.sex == "female":
             sex_label = "female"
-            sex_vec = np.array([0.0, 1.0])
+            sex_vec = np.array(sex_vecs["female"])
         elif request.sex == "male":
             sex_label = "male"
-            sex_vec = np.array([1.0, 0.0])
+            sex_vec = np.array(sex_vecs["male"])
         elif request.sex == "other":
             sex_label = "person of unspecified sex"
-            sex_vec = np.array([0.5, 0.5])
+            sex_vec = np.array(sex_vecs["other"])
+            messages.append(responses.sex_disclaimer)
+        else:
+            context.abort(grpc.StatusCode.FAILED_PRECONDITION, "Invalid sex")
+
+        age_text, age_label, age_ix = get_age_bracket(request.age)
+        if age_label not in tts.model().nodes["n2_Age"]["states"]:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Invalid age")
+        if request.transmission not in tts.model().nodes["n4_Transmission"]["states"]:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Invalid transmission")
+
+        if request.transmission == "None":
+            transmission_label = "no"
+        elif request.transmission == "Ten_percent":
+            transmission_label = "a huge number of cases "
+        elif request.transmission == "Five_percent":
+            transmission_label = "a large number of cases "
+        elif request.transmission == "Two_percent":
+            transmission_label = "a lot of cases "
+        elif request.transmission == "ATAGI_Med":
+            transmission_label = "few cases"
+        elif request.transmission == "ATAGI_Low":
+            transmission_label = "not many cases"
+        else:
+            transmission_label = request.transmission
+
+        if request.transmission == "None":
+            messages.append(responses.no_transmission_note)
+
+        dose_labels = {
+            "None": ("not had any vaccines", "no"),
+            "OneAZ_under_3_weeks": ("had one shot of Astrazeneca (under 3 weeks ago)", "first"),
+            "TwoAZ_under_2_months": ("had two shots of Astrazeneca (2 months ago)", "second"),
+            "TwoAZ_2to4_months": ("had two shots of Astrazeneca (2-4 months ago)", "second"),
+            "TwoAZ_4to6_months": ("had two shots of Astrazeneca (4-6 months ago)", "second"),
+            "TwoAZ_OnePfz_under_2_months": ("had two shots of Astrazeneca and one shot of Pfizer (2 months ago)", "third"),
+        }
+        if request.vaccine not in dose_labels:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Invalid vaccine")
+
+        if request.vaccine == "None":
+            comparison_doses = ["OneAZ_under_3_weeks", "TwoAZ_under_2_months"]
+        elif request.vaccine == "OneAZ_under_3_weeks":
+            comparison_doses = ["None", "TwoAZ_under_2_months"]
+        elif request.vaccine == "TwoAZ_OnePfz_under_2_months":
+            comparison_doses = ["OneAZ_under_3_weeks", "TwoAZ_under_2_months", "None"]
+        else:
+            comparison_doses = ["OneAZ_under_3_weeks", "TwoAZ_OnePfz_under_2_months"]
+
+        # variant
+        # hardcoded as 100% omicron, the network has no variant node
+
+        doses = [request.vaccine] + comparison_doses
+        scenarios = [(cdose, age_label, sex_vec, request.transmission) for cdose in doses]
+        metrics.lap("normalize")
+        check_deadline(context)
+        probs = tts.compute_probs_batch(scenarios)
+        check_finite(context, probs)
+
+        if request.compute_count:
+            # timing mode: evaluate the scenarios compute_count times over, in
+            # batches of bounded size so a huge count can't exhaust memory or
+            # outlive the caller
+            timing_start = perf_counter_ns()
+            for done in range(0, request.compute_count, timing_batch_repeats):
+                check_deadline(context)
+                tts.compute_probs_batch(scenarios * min(timing_batch_repeats, request.compute_count - done))
+            timing = (perf_counter_ns() - timing_start) / 1e6  # ms
             messages.append(
                 corical_pb2.Message(
-                    heading="Sex disclaimer",
-                    text="We do not have data on the chosen sex, so the results reflect a population with 50% females and 50% males",
+                    heading="Timing",
+                    text=f"Computed {len(scenarios) * request.compute_count} scenarios in {timing:.3f} ms",
                     severity="info",
                 )
             )
+
+        cmp = []
+        for i, (cdose, dose_probs) in enumerate(zip(doses, probs)):
+            label, shot_ordinal = dose_labels[cdose]
+            cur = {
+                "label": label,
+                "is_other_shot": i != 0,
+                "shot_ordinal": shot_ordinal,
+            }
+            cur.update(zip(tts.outcome_names, dose_probs))
+            cmp.append(cur)
+
+        logger.debug(cmp)
+
+        subtitle = texts.SUBTITLE.format(age=age_text, sex=sex_label)
+        scenario_description = texts.SCENARIO.format(
+            age=age_text, sex=sex_label, transmission=transmission_label, vaccine="AstraZeneca"
+        )
+        link = get_link(request.sex, min(age_ix, 7))
+        out = responses.compute_res(
+            messages=messages,
+            scenario_description=scenario_description,
+            bar_graphs=[
+                responses.bar_graph(
+                    title=texts.COVID_TITLE,
+                    subtitle=texts.COVID_SUBTITLE.format(age=age_text, sex=sex_label, transmission=transmission_label),
+                    risks=responses.bars(
+                        [
+                            responses.bar(
+                                label=texts.COVID_LABEL.format(dose=d["label"]),
+                                risk=d["get_covid"],
+                                is_other_shot=d["is_other_shot"],
+                            )
+                            for d in cmp
+                        ]
+                    ),
+                ),
+                responses.bar_graph(
+                    title=texts.DEATH_TITLE,
+                    subtitle=subtitle,
+                    risks=responses.bars(
+                        [
+                            responses.bar(
+                                label=texts.DEATH_LABEL.format(dose=d["label"]),
+                                risk=d["die_from_covid_given_infected"],
+                                is_other_shot=d["is_other_shot"],
+                            )
+                            for d in cmp
+                        ]
+                    ),
+                ),
+                responses.bar_graph(
+                    title=texts.CLOTS_TITLE,
+                    subtitle=texts.CLOTS_SUBTITLE.format(age=age_text, sex=sex_label),
+                    risks=responses.bars(
+                        [
+                            responses.bar(
+                                label=texts.CLOTS_VAX_LABEL.format(ordinal=d["shot_ordinal"]),
+                                risk=d["get_tts"],
+                                is_other_shot=d["is_other_shot"],
+                            )
+                            for d in cmp
+                            if d["shot_ordinal"] != "no"
+                        ]
+                        + [
+                            responses.bar(
+                                label=texts.CLOTS_COVID_LABEL,
+                                risk=cmp[0]["get_clots_covid_given_infected"],
+                                is_other_shot=True,
+                            ),
+                        ]
+                    ),
+                ),
+                responses.bar_graph(
+                    title=texts.CLOTS_DEATH_TITLE,
+                    subtitle=subtitle,
+                    risks=responses.bars(
+                        [
+                            responses.bar(
+                                label=texts.CLOTS_DEATH_VAX_LABEL.format(ordinal=d["shot_ordinal"]),
+                                risk=d["die_from_tts"],
+                                is_other_shot=d["is_other_shot"],
+                            )
+                            for d in cmp
+                            if d["shot_ordinal"] != "no"
+                        ]
+                        + [
+                            responses.bar(
+                                label=texts.CLOTS_DEATH_BG_LABEL,
+                                risk=cmp[0]["die_from_clots"],
+                                is_other_shot=True,
+                            ),
+                            responses.bar(
+                                label=texts.CLOTS_DEATH_COVID_LABEL,
+                                risk=cmp[0]["die_from_clots_covid_given_infected"],
+                                is_other_shot=True,
+                            ),
+                        ]
+                    ),
+                ),
+            ],
+            printable=corical_pb2.PrintableButton(text=texts.PRINTABLE, url=link) if link else None,
+            success=True,
+            vaccine_type="AZ",
+        )
+
+        metrics.lap("build")
+        return out
+
+    def ComputePfizer(self, request, context):
+        with metrics.track("ComputePfizer", context):
+            start = perf_counter_ns()
+            time = Timestamp_from_datetime(now())
+
+            logger.debug(request)
+
+            try:
+                key = pfizer_key(request)
+            except Exception:
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Invalid age")
+            res = cached_response(key, lambda: self.build_pfizer(request, context), request)
+
+            duration = (perf_counter_ns() - start) / 1e6  # ms
+            binlog_sink.log(
+                time=time,
+                pfizer_req=request,
+                res=res,
+                duration_ms=duration,
+                model_version=pfizer.model().source_sha256[:12],
+            )
+            metrics.lap("log")
+
+            return res
+
+    def build_pfizer(self, request, context):
+        messages = []
+
+        # sex
+        if request.sex == "female":
+            sex_label = "female"
+            sex_vec = np.array(sex_vecs["female"])
+        elif request.sex == "male":
+            sex_label = "male"
+            sex_vec = np.array(sex_vecs["male"])
+        elif request.sex == "other":
+            sex_label = "person of unspecified sex"
+            sex_vec = np.array(sex_vecs["other"])
+            messages.append(responses.sex_disclaimer)
+        else:
+            context.abort(grpc.StatusCode.FAILED_PRECONDITION, "Invalid sex")
+
+        age_text, age_label, age_ix = get_age_bracket_pfizer(request.age)
+        if request.ct not in pfizer.model().nodes["n4_Community_transmission"]["states"]:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Invalid ct")
+
+        if request.ct == "None_0":
+            transmission_label = "no"
+        elif request.ct == "Ten_percent":
+            transmission_label = "a huge number of cases "
+        elif request.ct == "Five_percent":
+            transmission_label = "a large number of cases "
+        elif request.ct == "Two_percent":
+            transmission_label = "a lot of cases "
+        elif request.ct == "ATAGI_Med":
+            transmission_label = "few cases"
+        elif request.ct == "ATAGI_Low":
+            transmission_label = "not many cases"
+        else:
+            transmission_label = request.ct
+
+        if request.ct == "None_0":
+            messages.append(responses.no_transmission_note)
+
+        dose_labels = {
+            "None": ("not had any vaccines", "no"),
+            "One_at_3wks": ("had one shot (3 weeks ago)", "first"),
+            "Two_under_2mths": ("had two shots (2 months ago)", "second"),
+            "Two_2_4mths": ("had two shots (2-4 months after the vaccine)", "second"),
+            "Two_4_6mths": ("had two shots (4-6 months after the vaccine)", "second"),
+            "Three": ("had three shots", "third"),
+        }
+        if request.dose not in dose_labels:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Invalid dose")
+
+        if request.dose == "None":
+            comparison_doses = ["One_at_3wks", "Two_under_2mths"]
+        elif request.dose == "One_at_3wks":
+            comparison_doses = ["None", "Two_under_2mths"]
+        elif request.dose == "Three":
+            comparison_doses = ["One_at_3wks", "Two_under_2mths", "None"]
+        else:
+            comparison_doses = ["One_at_3wks", "Three"]
+
+        doses = [request.dose] + comparison_doses
+        metrics.lap("normalize")
+        check_deadline(context)
+        probs = pfizer.compute_probs_batch([(cdose, age_label, request.ct, sex_vec) for cdose in doses])
+        check_finite(context, probs)
+
+        cmp = []
+        for i, (cdose, dose_probs) in enumerate(zip(doses, probs)):
+            label, shot_ordinal = dose_labels[cdose]
+            cur = {
+                "label": label,
+                "is_other_shot": i != 0,
+                "shot_ordinal": shot_ordinal,
+            }
+            cur.update(zip(pfizer.outcome_names, dose_probs))
+            cmp.append(cur)
+
+        logger.debug(cmp)
+
+        subtitle = texts.SUBTITLE.format(age=age_text, sex=sex_label)
+        myo_subtitle = texts.MYO_SUBTITLE.format(age=age_text, sex=sex_label)
+        scenario_description = texts.SCENARIO.format(
+            age=age_text, sex=sex_label, transmission=transmission_label, vaccine="Pfizer"
+        )
+        out = responses.compute_res(
+            messages=messages,
+            scenario_description=scenario_description,
+            bar_graphs=[
+                responses.bar_graph(
+                    title=texts.COVID_TITLE,
+                    subtitle=texts.COVID_SUBTITLE.format(age=age_text, sex=sex_label, transmission=transmission_label),
+                    risks=responses.bars(
+                        [
+                            responses.bar(
+                                label=texts.COVID_LABEL.format(dose=d["label"]),
+                                risk=d["get_covid"],
+                                is_other_shot=d["is_other_shot"],
+                            )
+                            for d in cmp
+                        ]
+                    ),
+                ),
+                responses.bar_graph(
+                    title=texts.DEATH_TITLE,
+                    subtitle=subtitle,
+                    risks=responses.bars(
+                        [
+                            responses.bar(
+                                label=texts.DEATH_LABEL.format(dose=d["label"]),
+                                risk=d["die_from_covid_given_infected"],
+                                is_other_shot=d["is_other_shot"],
+                            )
+                            for d in cmp
+                        ]
+                    ),
+                ),
+                responses.bar_graph(
+                    title=texts.MYO_TITLE,
+                    subtitle=myo_subtitle,
+                    risks=responses.bars(
+                        [
+                            responses.bar(
+                                label=texts.MYO_BG_LABEL,
+                                risk=cmp[0]["get_myocarditis_bg"],
+                                is_other_shot=True,
+                            ),
+                            responses.bar(
+                                label=texts.MYO_COVID_LABEL,
+                                risk=cmp[0]["get_myocarditis_given_covid"],
+                                is_other_shot=True,
+                            ),
+                        ]
+                        + [
+                            responses.bar(
+                                label=texts.MYO_VAX_LABEL.format(ordinal=d["shot_ordinal"]),
+                                risk=d["get_myocarditis_vax"],
+                                is_other_shot=d["is_other_shot"],
+                            )
+                            for d in cmp[0:1]
+                            if d["shot_ordinal"] != "no"
+                        ]
+                    ),
+                ),
+                responses.bar_graph(
+                    title=texts.MYO_DEATH_TITLE,
+                    subtitle=myo_subtitle,
+                    risks=responses.bars(
+                        [
+                            responses.bar(
+                                label=texts.MYO_DEATH_BG_LABEL,
+                                risk=cmp[0]["die_myocarditis_bg"],
+                                is_other_shot=True,
+                            ),
+                            responses.bar(
+                                label=texts.MYO_DEATH_COVID_LABEL,
+                                risk=cmp[0]["die_myocarditis_given_covid"],
+                                is_other_shot=True,
+                            ),
+                        ]
+                        + [
+                            responses.bar(
+                                label=texts.MYO_DEATH_VAX_LABEL.format(ordinal=d["shot_ordinal"]),
+                                risk=d["die_myocarditis_vax"],
+                                is_other_shot=d["is_other_shot"],
+                            )
+                            for d in cmp[0:1]
+                            if d["shot_ordinal"] != "no"
+                        ]
+                    ),
+                ),
+            ],
+            success=True,
+            vaccine_type="PZ",
+        )
+
+        metrics.lap("build")
+        return out
+
+    def ComputePfizerChildren(self, request, context):
+        with metrics.track("ComputePfizerChildren", context):
+            start = perf_counter_ns()
+            time = Timestamp_from_datetime(now())
+
+            logger.debug(request)
+
+            # The only case there is evidence of is two doses, so this is set here
+            # it is easiest to set this here in case there is more evidence later
+            request.dose = "Two_Pfizer"
+
+            # the whole call uses one version, even if a new one is swapped in
+            network = registry.current("pfizer_children")
+            try:
+                key = children_key(request, network)
+            except Exception:
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Invalid age")
+            res = cached_response(key, lambda: self.build_pfizer_children(request, context, network), request)
+
+            duration = (perf_counter_ns() - start) / 1e6  # ms
+            binlog_sink.log(
+                time=time,
+                pfizer_req=request,
+                res=res,
+                duration_ms=duration,
+                model_version=network.version,
+            )
+            metrics.lap("log")
+
+            return res
+
+    def build_pfizer_children(self, request, context, network):
+        messages = []
+
+        # sex
+        if request.sex == "female":
+            sex_label = "female"
+            sex_vec = np.array(sex_vecs["female"])
+        elif request.sex == "male":
+            sex_label = "male"
+            sex_vec = np.array(sex_vecs["male"])
+        elif request.sex == "other":
+            sex_label = "person of unspecified sex"
+            sex_vec = np.array(sex_vecs["other"])
+            messages.append(responses.sex_disclaimer)
         else:
             context.abort(grpc.StatusCode.FAILED_PRECONDITION, "Invalid sex")
 
@@ -114,23 +911,13 @@ class Corical(corical_pb2_grpc.CoricalServicer):
             transmission_label = request.ct
 
         if request.ct == "None_0":
-            messages.append(
-                corical_pb2.Message(
-                    heading="Note",
-                    text="You have selected a scenario with no community transmission. This is only a temporary situation and will change when state or national borders open.",
-                    severity="warning",
-                )
-            )
+            messages.append(responses.no_transmission_note)
 
         dose_labels = {
             "None": ("not had any vaccines", "no"),
             "Two_Pfizer": ("hadhad two shots of ( ago) shots second the Pfizer ", "Pfizer"),
         }
 
-        # The only case there is evidence of is two doses, so this is set here
-        # it is easiest to set this here in case there is more evidence later
-        request.dose = "Two_Pfizer"
-        
         if request.dose == "None":
             comparison_doses = ["Two_Pfizer"]
         elif request.dose == "Two_Pfizer":
@@ -138,43 +925,51 @@ class Corical(corical_pb2_grpc.CoricalServicer):
         else:
             comparison_doses = []
 
-        network = SmileModel(PZ_children_model_file)
-        baseline_outcomes = {
-            "get_myocarditis_vax": "n10_Myo_Vax",
-            "get_myocarditis_bg": "n11_Myo_Background",
-            "risk_of_infection": "n9_Risk_Infection",
-        }
-
-        infected_outcomes = {
-            "get_myocarditis_given_infected": "n12_Myo_Covid",
-            # unclear if these should be given infected or not
-            "hospitalisation_given_infected": "n13_Hospital",
-            "MSIC_given_infected": "n15_MSI_Covid",
-            "severse_MSIC_given_infected": "n16_MSI_severe",
-        }
-
         cmp = []
 
-        for i, cdose in enumerate([request.dose] + comparison_doses):
-            label, shot_ordinal = dose_labels[cdose]
-            cur = {
-                "label": label,
-                "is_other_shot": i != 0,
-                "shot_ordinal": shot_ordinal,
-            }
-            evidence = {
+        doses = [request.dose] + comparison_doses
+        scenarios = [
+            {
                 "n3_Sex": sex_vec,
                 "n1_Vax": cdose,
                 "n2_Age": age_label,
                 "n4_Transmission": request.ct
             }
+            for cdose in doses
+        ]
+        metrics.lap("normalize")
+        check_deadline(context)
+        # intervals come from CPT draws on the xdsl model, so with them the
+        # points do too, whichever engine serves the rest
+        engine = "xdsl" if request.credible_intervals else network.engine
+        with network.acquire(engine) as instance:
+            outcomes = compute_outcomes(
+                instance, scenarios, children_baseline_outcomes, children_infected_outcomes, "n9_Risk_Infection"
+            )
+        check_possible(context, outcomes)
+        if request.credible_intervals:
+            check_deadline(context)
+            intervals = compute_outcome_intervals(
+                network.model(),
+                scenarios,
+                children_baseline_outcomes,
+                children_infected_outcomes,
+                "n9_Risk_Infection",
+                network.concentration(config.CI_CONCENTRATION),
+                config.CI_SAMPLES,
+                config.CI_LEVEL,
+            )
+            for dose_outcomes, dose_intervals in zip(outcomes, intervals):
+                dose_outcomes["intervals"] = dose_intervals
 
-            network.set_evidence(evidence)
-            cur.update(network.get_binary_outcomes(baseline_outcomes))
-            network.set_evidence({"n9_Risk_Infection":"Yes"})
-            cur.update(network.get_binary_outcomes(infected_outcomes))
-            network.get_network().clear_evidence("n9_Risk_Infection")
-            
+        for i, (cdose, dose_outcomes) in enumerate(zip(doses, outcomes)):
+            label, shot_ordinal = dose_labels[cdose]
+            cur = {
+                "label": label,
+                "is_other_shot": i != 0,
+                "shot_ordinal": shot_ordinal,
+            }
+            cur.update(dose_outcomes)
             cmp.append(cur)
         
         # since there was not enough evidence for severe outcomes given one
@@ -186,167 +981,180 @@ class Corical(corical_pb2_grpc.CoricalServicer):
             cmp[0]["MSIC_given_infected"] == 0.5):
             remove_severe_nodes = True
 
-        scenario_description = f"Here are your results. These are for a {age_text} {sex_label} when there is {transmission_label} in your community. They are based on the number and timing of shots of vaccines the child has had."
-        out = corical_pb2.ComputeRes(
+        scenario_description = texts.CHILDREN_SCENARIO.format(age=age_text, sex=sex_label, transmission=transmission_label)
+        out = responses.compute_res(
             messages=messages,
             scenario_description=scenario_description,
             bar_graphs=[
-                corical_pb2.BarGraph(
-                    title=f"What is my child's chance of getting COVID-19?",
-                    subtitle=f"The COVID-19 vaccines aim to stop children from getting very sick from COVID-19. The vaccines can also protect children from getting COVID-19.",
-                    risks=generate_bar_graph_risks(
+                responses.bar_graph(
+                    title=texts.CHILDREN_COVID_TITLE,
+                    subtitle=texts.CHILDREN_COVID_SUBTITLE,
+                    risks=responses.bars(
                         [
-                            corical_pb2.BarGraphRisk(
-                                label=f"Chance of getting COVID-19 if the child has had two shots of the vaccine ",
+                            responses.bar(
+                                label=texts.CHILDREN_COVID_VAX_LABEL,
                                 risk=cmp[0]["risk_of_infection"],
+                                interval=risk_interval(cmp[0], "risk_of_infection"),
                                 is_other_shot=cmp[0]["is_other_shot"],
                             )
                         ]
                         + [
-                            corical_pb2.BarGraphRisk(
-                                label=f"Chance of getting COVID-19 if the child has had 0 shot of the vaccine",
+                            responses.bar(
+                                label=texts.CHILDREN_COVID_NO_VAX_LABEL,
                                 risk=d["risk_of_infection"],
+                                interval=risk_interval(d, "risk_of_infection"),
                                 is_other_shot=True,
                             ) for d in cmp
                             if d["risk_of_infection"] > 0.0 and (d['shot_ordinal'] == "no")
                         ]
                     ),
                 ),
-                corical_pb2.BarGraph(
-                    title=f"What is my child's chance of having inflammation of their heart muscle (myocarditis)?",
-                    subtitle=f"The Pfizer vaccine can cause inflammation of the heart muscle. This is called myocarditis. Children can get myocarditis from other causes even if they haven't had the vaccine. COVID-19 infection can also cause myocarditis in some children. ",
-                    risks=generate_bar_graph_risks(
+                responses.bar_graph(
+                    title=texts.CHILDREN_MYO_TITLE,
+                    subtitle=texts.CHILDREN_MYO_SUBTITLE,
+                    risks=responses.bars(
                         [
-                            corical_pb2.BarGraphRisk(
-                                label=f"Chance of getting myocarditis after the child has 2 shots of the vaccine ",
+                            responses.bar(
+                                label=texts.CHILDREN_MYO_VAX_LABEL,
                                 risk=d["get_myocarditis_vax"],
+                                interval=risk_interval(d, "get_myocarditis_vax"),
                                 is_other_shot=d["is_other_shot"],
                             ) for d in cmp
                             if d["get_myocarditis_vax"] > 0.0 or d['label'] == cmp[0]['label'] and (d['shot_ordinal'] != "no")
                         ]
                         + [
-                            corical_pb2.BarGraphRisk(
-                                label=f"Chance of getting myocarditis over 2 weeks if the child has had 0 shots of the vaccine and no COVID-19",
+                            responses.bar(
+                                label=texts.CHILDREN_MYO_BG_LABEL,
                                 risk=cmp[0]["get_myocarditis_bg"],
+                                interval=risk_interval(cmp[0], "get_myocarditis_bg"),
                                 is_other_shot=True,
                             ),
                         ]
                         + [
-                            corical_pb2.BarGraphRisk(
-                                label=f"Chance of getting myocarditis after the child gets COVID-19",
+                            responses.bar(
+                                label=texts.CHILDREN_MYO_COVID_LABEL,
                                 risk=cmp[0]["get_myocarditis_given_infected"],
+                                interval=risk_interval(cmp[0], "get_myocarditis_given_infected"),
                                 is_other_shot=True,
                             ),
                         ]
                     ),
                 ),
-                corical_pb2.BarGraph(
-                    title=f"What is the chance of my child going to hospital due to COVID-19?",
-                    subtitle=f"Whilst most children do not get very sick from COVID-19, some do need to go to hospital. Many of these children have other health problems.",
-                    risks=generate_bar_graph_risks(
+                responses.bar_graph(
+                    title=texts.CHILDREN_HOSPITAL_TITLE,
+                    subtitle=texts.CHILDREN_HOSPITAL_SUBTITLE,
+                    risks=responses.bars(
                         [
-                            corical_pb2.BarGraphRisk(
-                                label=f"Chance of going to hospital if the child has 2 shots of the vaccine and gets COVID-19 ",
+                            responses.bar(
+                                label=texts.CHILDREN_HOSPITAL_VAX_LABEL,
                                 risk=d["hospitalisation_given_infected"],
+                                interval=risk_interval(d, "hospitalisation_given_infected"),
                                 is_other_shot=d["is_other_shot"],
                             ) for d in cmp
                             if d['hospitalisation_given_infected'] > 0.0 and d['shot_ordinal']  !=  "no"
                         ] 
                         + [
-                            corical_pb2.BarGraphRisk(
-                                label=f"Chance of going to hospital if the child has 0 shots of the vaccine and gets COVID-19",
+                            responses.bar(
+                                label=texts.CHILDREN_HOSPITAL_NO_VAX_LABEL,
                                 risk=d["hospitalisation_given_infected"],
+                                interval=risk_interval(d, "hospitalisation_given_infected"),
                                 is_other_shot=d["is_other_shot"],
                             ) for d in cmp
                             if d['hospitalisation_given_infected'] > 0.0 and d['shot_ordinal']  == "no"
                         ]
                     ),
                 ),
-                corical_pb2.BarGraph(
-                    title=f"What is the chance of my child having Multisystem Inflammatory Syndrome due to COVID-19?",
-                    subtitle=f"COVID-19 can cause serious health problems in some children. A small number of children can get inflammation of their organs, such as the heart, brain, kidneys, blood vessels, skin, digestive system or eyes. This is called Multisystem Inflammatory Syndrome in Children.",
-                    risks=generate_bar_graph_risks(
+                responses.bar_graph(
+                    title=texts.CHILDREN_MIS_TITLE,
+                    subtitle=texts.CHILDREN_MIS_SUBTITLE,
+                    risks=responses.bars(
                         [
-                            corical_pb2.BarGraphRisk(
-                                label=f"Chance of Multisystem Inflammatory Syndrome if the child has 2 shots of the vaccine and gets COVID-19",
+                            responses.bar(
+                                label=texts.CHILDREN_MIS_VAX_LABEL,
                                 risk=d["MSIC_given_infected"],
+                                interval=risk_interval(d, "MSIC_given_infected"),
                                 is_other_shot=d["is_other_shot"],
                             ) for d in cmp
                             if d["MSIC_given_infected"] > 0.0 and d['shot_ordinal']  != "no"
                         ]
                         + [
-                            corical_pb2.BarGraphRisk(
-                                label=f"Chance of Multisystem Inflammatory Syndrome if the child has 0 shots of the vaccine and gets COVID-19",
+                            responses.bar(
+                                label=texts.CHILDREN_MIS_NO_VAX_LABEL,
                                 risk=d["MSIC_given_infected"],
+                                interval=risk_interval(d, "MSIC_given_infected"),
                                 is_other_shot=d["is_other_shot"],
                             ) for d in cmp
                             if d["MSIC_given_infected"] > 0.0 and d['shot_ordinal']  == "no"
                         ]
                     ) if not remove_severe_nodes else
-                        generate_bar_graph_risks(
+                        responses.bars(
                             [
-                                corical_pb2.BarGraphRisk(
-                                    label=f"Chance of going to the hospital from COVID-19 if infected",
+                                responses.bar(
+                                    label=texts.CHILDREN_HOSPITAL_UNKNOWN_LABEL,
                                     risk=0.0,
                                     is_other_shot=True,
-                                    bar_text="Not enough evidence available.",
-                                    hover_text="There is not enough evidence to provide information on this."
+                                    bar_text=texts.NOT_ENOUGH_EVIDENCE,
+                                    hover_text=texts.NOT_ENOUGH_EVIDENCE_HOVER
                                 ),
-                                corical_pb2.BarGraphRisk(
-                                    label=f"Chance of Multisystem Inflammatory Syndrome in Children from COVID-19 if infected",
+                                responses.bar(
+                                    label=texts.CHILDREN_MIS_UNKNOWN_LABEL,
                                     risk=0.0,
                                     is_other_shot=True,
-                                    bar_text="Not enough evidence available.",
-                                    hover_text="There is not enough evidence to provide information on this."
+                                    bar_text=texts.NOT_ENOUGH_EVIDENCE,
+                                    hover_text=texts.NOT_ENOUGH_EVIDENCE_HOVER
                                 ),
                             ]
                         ),
                     ),
                 ],
-            output_groups=[],
             success=True,
-            msg=str(request),
             vaccine_type = "Children",
         )
-        duration = (perf_counter_ns() - start) / 1e6  # ms
-        binlog = corical_pb2.BinLog(
-            time=time,
-            pfizer_req=request,
-            res=out,
-            duration_ms=duration,
-        )
-
-        binlog_out = b64encode(binlog.SerializeToString()).decode("utf8")
-
-        logger.info(f"binlog: {binlog_out}")
 
+        metrics.lap("build")
         return out
-    
+
     def ComputeCombined(self, request, context):
-        start = perf_counter_ns()
-        time = Timestamp_from_datetime(now())
+        with metrics.track("ComputeCombined", context):
+            start = perf_counter_ns()
+            time = Timestamp_from_datetime(now())
 
-        logger.info(request)
+            logger.debug(request)
 
+            # the whole call uses one version, even if a new one is swapped in
+            network = registry.current("combined")
+            try:
+                key = combined_key(request, network)
+            except Exception:
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Invalid age")
+            res = cached_response(key, lambda: self.build_combined(request, context, network), request)
+
+            duration = (perf_counter_ns() - start) / 1e6  # ms
+            binlog_sink.log(
+                time=time,
+                combined_req=request,
+                res=res,
+                duration_ms=duration,
+                model_version=network.version,
+            )
+            metrics.lap("log")
+
+            return res
+
+    def build_combined(self, request, context, network):
         messages = []
 
         # sex
         if request.sex == "female":
             sex_label = "female"
-            sex_vec = np.array([0.0, 1.0])
+            sex_vec = np.array(sex_vecs["female"])
         elif request.sex == "male":
             sex_label = "male"
-            sex_vec = np.array([1.0, 0.0])
+            sex_vec = np.array(sex_vecs["male"])
         elif request.sex == "other":
             sex_label = "person of unspecified sex"
-            sex_vec = np.array([0.5, 0.5])
-            messages.append(
-                corical_pb2.Message(
-                    heading="Sex disclaimer",
-                    text="We do not have data on the chosen sex, so the results reflect a population with 50% females and 50% males",
-                    severity="info",
-                )
-            )
+            sex_vec = np.array(sex_vecs["other"])
+            messages.append(responses.sex_disclaimer)
         else:
             context.abort(grpc.StatusCode.FAILED_PRECONDITION, "Invalid sex")
 
@@ -367,13 +1175,7 @@ class Corical(corical_pb2_grpc.CoricalServicer):
             transmission_label = request.ct
 
         if request.ct == "None":
-            messages.append(
-                corical_pb2.Message(
-                    heading="Note",
-                    text="You have selected a scenario with no community transmission. This is only a temporary situation and will change when state or national borders open.",
-                    severity="warning",
-                )
-            )
+            messages.append(responses.no_transmission_note)
 
         dose_labels = {
             # "None": ("not had any vaccines", "no"),
@@ -422,8 +1224,8 @@ class Corical(corical_pb2_grpc.CoricalServicer):
         }
 
         # for graphs
-        subtitle = f"These results are for a {age_text} {sex_label}."
-        myo_subtitle = f"You may have heard that the Pfizer vaccine can give you inflammation of your heart muscle. This is also called myocarditis. There are many other causes of myocarditis, so people can develop this problem even if they haven’t had the vaccine. Myocarditis is also very common in people who have had COVID-19 (infection).  "
+        subtitle = texts.SUBTITLE.format(age=age_text, sex=sex_label)
+        myo_subtitle = texts.MYO_SUBTITLE.format(age=age_text, sex=sex_label)
 
         # # for tables
         # if request.dose == "None":
@@ -461,105 +1263,117 @@ class Corical(corical_pb2_grpc.CoricalServicer):
         # hardcoded as 100% omicron
         variant_vec = None
 
-        network = SmileModel(combined_model_file)
-        baseline_outcomes = {
-            "get_covid": "n14_Infection_at_current_transmission",
-            "get_myocarditis_bg": "n10_BackMyo",
-            "die_myocarditis_bg": "n22_Die_from_myocarditis__background",
-            "get_myocarditis_vax": "n7_VacMyo",
-            "die_myocarditis_vax": "n19_Die_from_vaccine_associatedmyocarditis",
-        }
-
-        infected_outcomes = {
-            "die_from_covid_given_infected": "n23_Die_from_Covid",
-            "get_myocarditis_given_covid": "n17_COV_Myo",
-            "die_myocarditis_given_covid": "n26_Die_from_COV_Myo" ,
-        }
-
         cmp = []
 
-        for i, cdose in enumerate([dose] + comparison_doses):
+        doses = [dose] + comparison_doses
+        metrics.lap("normalize")
+        # intervals come from CPT draws on the xdsl model, so with them the
+        # points do too, not a table built with another engine
+        engine = "xdsl" if request.credible_intervals else network.engine
+        table = combined_tables.get(network.version) if engine == network.engine else None
+        outcomes = [table.lookup(request.sex, age_label, request.ct, cdose) if table else None for cdose in doses]
+        metrics.lap("table")
+        # whatever the table can't answer is computed live, in one batch
+        missing = [i for i, dose_outcomes in enumerate(outcomes) if dose_outcomes is None]
+        if missing:
+            check_deadline(context)
+            scenarios = [combined_evidence(sex_vec, age_label, request.ct, doses[i]) for i in missing]
+            with network.acquire(engine) as instance:
+                for i, dose_outcomes in zip(missing, compute_combined_outcomes(instance, scenarios)):
+                    outcomes[i] = dose_outcomes
+            check_possible(context, outcomes)
+        if request.credible_intervals:
+            check_deadline(context)
+            intervals = compute_outcome_intervals(
+                network.model(),
+                [combined_evidence(sex_vec, age_label, request.ct, cdose) for cdose in doses],
+                combined_baseline_outcomes,
+                combined_infected_outcomes,
+                "n14_Infection_at_current_transmission",
+                network.concentration(config.CI_CONCENTRATION),
+                config.CI_SAMPLES,
+                config.CI_LEVEL,
+            )
+            for dose_outcomes, dose_intervals in zip(outcomes, intervals):
+                dose_outcomes["intervals"] = dose_intervals
+
+        for i, (cdose, dose_outcomes) in enumerate(zip(doses, outcomes)):
             label, shot_ordinal = dose_labels[cdose]
             cur = {
                 "label": label,
                 "is_other_shot": i != 0,
                 "shot_ordinal": shot_ordinal,
             }
-            evidence = {
-                "n5_Sex": sex_vec,
-                "n1_Dose": cdose,
-                "n2_Age": age_label,
-                "n4_Transmission": request.ct
-            }
-
-            network.set_evidence(evidence)
-            cur.update(network.get_binary_outcomes(baseline_outcomes))
-            network.set_evidence({"n14_Infection_at_current_transmission":"Yes"})
-            cur.update(network.get_binary_outcomes(infected_outcomes))
-            network.get_network().clear_evidence("n14_Infection_at_current_transmission")
-            
+            cur.update(dose_outcomes)
             cmp.append(cur)
         
         vaccine_type  = ""
 
-        logger.info(comparison_doses)
-        logger.info(cmp)
+        logger.debug(comparison_doses)
+        logger.debug(cmp)
 
-        scenario_description = f"Here are your results. These are for a {age_text} {sex_label} when there are {transmission_label} in your community. They are based on the number and timing of shots of {vaccine_type} vaccines you have had."
-        out = corical_pb2.ComputeRes(
+        scenario_description = texts.COMBINED_SCENARIO.format(
+            age=age_text, sex=sex_label, transmission=transmission_label, vaccine=vaccine_type
+        )
+        out = responses.compute_res(
             messages=messages,
             scenario_description=scenario_description,
             bar_graphs=[
-                corical_pb2.BarGraph(
-                    title=f"What is my chance of getting COVID-19?",
-                    subtitle=f"This is your chance of getting COVID-19 over a 2-month period. These results are for a {age_text} {sex_label} when there are {transmission_label} in your community.",
-                    risks=generate_bar_graph_risks(
+                responses.bar_graph(
+                    title=texts.COVID_TITLE,
+                    subtitle=texts.COVID_SUBTITLE.format(age=age_text, sex=sex_label, transmission=transmission_label),
+                    risks=responses.bars(
                         [
-                            corical_pb2.BarGraphRisk(
-                                label=f"Chance of getting COVID-19 if you have {d['label']}",
+                            responses.bar(
+                                label=texts.COVID_LABEL.format(dose=d["label"]),
                                 risk=d["get_covid"],
+                                interval=risk_interval(d, "get_covid"),
                                 is_other_shot=d["is_other_shot"],
                             )
                             for d in cmp
                         ]
                     ),
                 ),
-                corical_pb2.BarGraph(
-                    title="If I get COVID-19, what are my chances of dying?",
+                responses.bar_graph(
+                    title=texts.DEATH_TITLE,
                     subtitle=subtitle,
-                    risks=generate_bar_graph_risks(
+                    risks=responses.bars(
                         [
-                            corical_pb2.BarGraphRisk(
-                                label=f"Chance of dying from COVID-19 if you have {d['label']}",
+                            responses.bar(
+                                label=texts.DEATH_LABEL.format(dose=d["label"]),
                                 risk=d["die_from_covid_given_infected"],
+                                interval=risk_interval(d, "die_from_covid_given_infected"),
                                 is_other_shot=d["is_other_shot"],
                             )
                             for d in cmp
                         ]
                     ),
                 ),
-                corical_pb2.BarGraph(
-                    title="What is my chance of having inflammation of my heart muscle (myocarditis)?",
-                    subtitle=myo_subtitle + " " + subtitle,
-                    risks=generate_bar_graph_risks(
+                responses.bar_graph(
+                    title=texts.MYO_TITLE,
+                    subtitle=myo_subtitle,
+                    risks=responses.bars(
                         [
-                            corical_pb2.BarGraphRisk(
-                                label=f"Chance of having myocarditis over 2 months even if you haven't had a vaccine or COVID-19 infection (background rate)",
+                            responses.bar(
+                                label=texts.MYO_BG_LABEL,
                                 risk=cmp[0]["get_myocarditis_bg"],
+                                interval=risk_interval(cmp[0], "get_myocarditis_bg"),
                                 is_other_shot=True,
                             ),
                         ]
                         + [
-                            corical_pb2.BarGraphRisk(
-                                label=f"Chance of having myocarditis from a COVID-19 infection",
+                            responses.bar(
+                                label=texts.MYO_COVID_LABEL,
                                 risk=cmp[0]["get_myocarditis_given_covid"],
+                                interval=risk_interval(cmp[0], "get_myocarditis_given_covid"),
                                 is_other_shot=True,
                             ),
                         ]
                         + [
-                            corical_pb2.BarGraphRisk(
-                                label=f"Your chance of myocarditis after the {cmp[0]['shot_ordinal']} shot of Pfizer vaccine will increase by:",
+                            responses.bar(
+                                label=texts.MYO_VAX_LABEL.format(ordinal=cmp[0]["shot_ordinal"]),
                                 risk=cmp[0]["get_myocarditis_vax"],
+                                interval=risk_interval(cmp[0], "get_myocarditis_vax"),
                                 is_other_shot=cmp[0]["is_other_shot"],
                             )
                             # for d in cmp  # reduce number of comparison doses in myo case
@@ -567,28 +1381,31 @@ class Corical(corical_pb2_grpc.CoricalServicer):
                         ]
                     ),
                 ),
-                corical_pb2.BarGraph(
-                    title="What is my chance of dying from inflammation of my heart muscle (myocarditis)?",
-                    subtitle=myo_subtitle + " " + subtitle,
-                    risks=generate_bar_graph_risks(
+                responses.bar_graph(
+                    title=texts.MYO_DEATH_TITLE,
+                    subtitle=myo_subtitle,
+                    risks=responses.bars(
                         [
-                            corical_pb2.BarGraphRisk(
-                                label=f"Chance of dying from myocarditis in 2 months even if you haven’t had any vaccine and haven’t had COVID-19 (infection)",
+                            responses.bar(
+                                label=texts.MYO_DEATH_BG_LABEL,
                                 risk=cmp[0]["die_myocarditis_bg"],
+                                interval=risk_interval(cmp[0], "die_myocarditis_bg"),
                                 is_other_shot=True,
                             ),
                         ]
                         + [
-                            corical_pb2.BarGraphRisk(
-                                label=f"Chance of dying from myocarditis after COVID-19 (infection) ",
+                            responses.bar(
+                                label=texts.MYO_DEATH_COVID_LABEL,
                                 risk=cmp[0]["die_myocarditis_given_covid"],
+                                interval=risk_interval(cmp[0], "die_myocarditis_given_covid"),
                                 is_other_shot=True,
                             ),
                         ]
                         + [
-                            corical_pb2.BarGraphRisk(
-                                label=f"Your chance of dying from myocarditis after the {d['shot_ordinal']} shot of Pfizer vaccine will increase by:",
+                            responses.bar(
+                                label=texts.MYO_DEATH_VAX_LABEL.format(ordinal=d["shot_ordinal"]),
                                 risk=d["die_myocarditis_vax"],
+                                interval=risk_interval(d, "die_myocarditis_vax"),
                                 is_other_shot=d["is_other_shot"],
                             )
                             for d in cmp[0:1]
@@ -597,27 +1414,297 @@ class Corical(corical_pb2_grpc.CoricalServicer):
                     ),
                 ),
             ],
-            output_groups=[],
             success=True,
-            msg=str(request),
             vaccine_type = "PZ",
         )
-        duration = (perf_counter_ns() - start) / 1e6  # ms
-        binlog = corical_pb2.BinLog(
-            time=time,
-            combined_req=request,
-            res=out,
-            duration_ms=duration,
-        )
 
-        binlog_out = b64encode(binlog.SerializeToString()).decode("utf8")
+        metrics.lap("build")
+        return out
+
+    def SweepCombined(self, request, context):
+        # the whole stream uses one version, even if a new one is swapped in
+        network = registry.current("combined")
+        table = combined_tables.get(network.version)
+        nodes = network.model().nodes
 
-        logger.info(f"binlog: {binlog_out}")
+        def axis(requested, options, name):
+            if not requested:
+                return list(options)
+            invalid = [value for value in requested if value not in options]
+            if invalid:
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT, f"Invalid {name}: {', '.join(invalid)}")
+            return list(requested)
 
-        return out
+        sexes = axis(request.sex, sex_vecs, "sex")
+        cts = axis(request.ct, nodes["n4_Transmission"]["states"], "ct")
+        doses = axis(request.dose, nodes["n1_Dose"]["states"], "dose")
+        # ages collapse to the brackets the model has
+        age_min = request.age_min or 12
+        age_max = request.age_max or 120
+        if not 12 <= age_min <= age_max <= 120:
+            context.abort(grpc.StatusCode.INVALID_ARGUMENT, f"Invalid age range: {age_min} to {age_max}")
+        ages = []
+        for age in range(age_min, age_max + 1):
+            age_label = get_age_bracket_pz(age)[1]
+            if age_label in nodes["n2_Age"]["states"] and age_label not in ages:
+                ages.append(age_label)
+
+        outcome_names = list(combined_baseline_outcomes) + list(combined_infected_outcomes)
+        header = corical_pb2.SweepCombinedHeader(sex=sexes, age=ages, ct=cts, dose=doses, outcomes=outcome_names)
+
+        # one message per (sex, age, ct) with a row per dose; the next one is
+        # only computed when grpc asks for it, so a slow reader holds us back
+        for i, (sex_ix, age_ix, ct_ix) in enumerate(product(range(len(sexes)), range(len(ages)), range(len(cts)))):
+            if not context.is_active():
+                return
+            # streamed calls are measured per message
+            with metrics.track("SweepCombined", context):
+                check_deadline(context)
+                sex, age_label, ct = sexes[sex_ix], ages[age_ix], cts[ct_ix]
+                outcomes = [table.lookup(sex, age_label, ct, dose) if table else None for dose in doses]
+                metrics.lap("table")
+                missing = [j for j, dose_outcomes in enumerate(outcomes) if dose_outcomes is None]
+                if missing:
+                    scenarios = [combined_evidence(np.array(sex_vecs[sex]), age_label, ct, doses[j]) for j in missing]
+                    with network.acquire() as instance:
+                        for j, dose_outcomes in zip(missing, compute_combined_outcomes(instance, scenarios)):
+                            outcomes[j] = dose_outcomes
+
+                res = corical_pb2.SweepCombinedRes(
+                    header=header if i == 0 else None,
+                    rows=[
+                        corical_pb2.SweepCombinedRow(
+                            sex=sex_ix,
+                            age=age_ix,
+                            ct=ct_ix,
+                            dose=dose_ix,
+                            values=[dose_outcomes[name] for name in outcome_names],
+                        )
+                        for dose_ix, dose_outcomes in enumerate(outcomes)
+                    ],
+                )
+                metrics.lap("build")
+            yield res
+
+    def Sensitivity(self, request, context):
+        with metrics.track("Sensitivity", context):
+            if request.model not in sensitivity_outcomes:
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT, f"Invalid model: {request.model}")
+            baseline_outcomes, infected_outcomes, infection_node = sensitivity_outcomes[request.model]
+            if request.outcomes:
+                invalid = [name for name in request.outcomes if name not in baseline_outcomes and name not in infected_outcomes]
+                if invalid:
+                    context.abort(grpc.StatusCode.INVALID_ARGUMENT, f"Invalid outcomes: {', '.join(invalid)}")
+                baseline_outcomes = {name: node for name, node in baseline_outcomes.items() if name in request.outcomes}
+                infected_outcomes = {name: node for name, node in infected_outcomes.items() if name in request.outcomes}
+
+            network = registry.current(request.model)
+            model = network.model()
+            for node, state in request.evidence.items():
+                if node not in model.nodes or state not in model.nodes[node]["states"]:
+                    context.abort(grpc.StatusCode.INVALID_ARGUMENT, f"Invalid evidence: {node}={state}")
+            metrics.lap("request")
+
+            try:
+                found = compute_outcome_sensitivities(
+                    model,
+                    dict(request.evidence),
+                    baseline_outcomes,
+                    infected_outcomes,
+                    infection_node,
+                    request.top_k or sensitivity_top_k,
+                )
+            except ValueError as e:
+                context.abort(grpc.StatusCode.INVALID_ARGUMENT, str(e))
+
+            res = corical_pb2.SensitivityRes(
+                model_version=network.version,
+                parameters=[
+                    corical_pb2.Sensitivity(
+                        outcome=entry["outcome"],
+                        node=entry["node"],
+                        probability=entry["probability"],
+                        parameter=entry["parameter"],
+                        parents=entry["parents"],
+                        state=entry["state"],
+                        value=entry["value"],
+                        derivative=entry["derivative"],
+                    )
+                    for entry in found
+                ],
+            )
+            metrics.lap("build")
+            return res
+
+    def StringCatalogue(self, request, context):
+        with metrics.track("StringCatalogue", context):
+            if request.version != string_catalogue.version:
+                context.abort(
+                    grpc.StatusCode.NOT_FOUND,
+                    f"Unknown string catalogue {request.version}, this server has {string_catalogue.version}",
+                )
+            context.send_initial_metadata(string_catalogue_metadata)
+            return string_catalogue.serialised
+
+
+def warm_up():
+    """
+    Read every network and build its junction tree, so no request pays for
+    it, then warm the response cache if configured to
+    """
+    start = perf_counter_ns()
+    registry.preload()
+    tts.model().junction_tree
+    pfizer.model().junction_tree
+    logger.info(f"Models warm after {(perf_counter_ns() - start) / 1e6:.0f} ms")
+    if config.WARM_BINLOG_DIR:
+        since = now().timestamp() - config.WARM_HOURS * 3600
+        warm_cache(recent_binlogs(config.WARM_BINLOG_DIR, since), config.WARM_MAX_BYTES, since)
+
+
+def serve_worker(index=0):
+    # the table is only mapped, so it is always loaded up front
+    load_combined_table(registry.current("combined"))
+    if config.WARMUP == "eager":
+        warm_up()
+    if config.BINLOG_DIR:
+        binlog_sink.start(index)
+        atexit.register(binlog_sink.close)
+    if config.METRICS_PORT:
+        # one port per worker, so each can be scraped
+        metrics.start_http_server(config.METRICS_PORT + index)
+    if config.MODEL_DIR:
+        registry.watch(config.MODEL_DIR, config.MODEL_POLL)
+
+    if config.SERVER == "aio":
+        asyncio.run(serve_aio())
+        return
+
+    # with several workers the kernel spreads connections over their sockets
+    server = grpc.server(
+        futures.ThreadPoolExecutor(config.THREADS),
+        options=[("grpc.so_reuseport", int(config.WORKERS > 1))],
+        maximum_concurrent_rpcs=config.MAX_CONCURRENT_RPCS or None,
+    )
+    server.add_insecure_port(f"[::]:{config.PORT}")
+    add_servicer(Corical(), server)
+    health_servicer = health.HealthServicer()
+    health_pb2_grpc.add_HealthServicer_to_server(health_servicer, server)
+
+    def set_serving(status):
+        for service in health_services:
+            health_servicer.set(service, status)
+
+    server.start()
+    logger.info(f"Listening on port {config.PORT}")
+
+    if config.WARMUP == "background":
+        # answer health checks with NOT_SERVING until the models are in
+        set_serving(health_pb2.HealthCheckResponse.NOT_SERVING)
+
+        def warm_up_then_serve():
+            warm_up()
+            set_serving(health_pb2.HealthCheckResponse.SERVING)
+
+        threading.Thread(target=warm_up_then_serve, name="warm-up", daemon=True).start()
+    else:
+        set_serving(health_pb2.HealthCheckResponse.SERVING)
+
+    def drain(signum, frame):
+        logger.info(f"Draining for up to {config.SHUTDOWN_GRACE}s")
+        health_servicer.enter_graceful_shutdown()
+        server.stop(config.SHUTDOWN_GRACE)
+
+    signal.signal(signal.SIGTERM, drain)
+    signal.signal(signal.SIGINT, drain)
+    server.wait_for_termination()
+
+
+async def serve_aio():
+    """
+    Serve from an event loop, with the handlers running in a thread pool
+    """
+    executor = futures.ThreadPoolExecutor(config.THREADS)
+    server = aio.server(
+        options=[("grpc.so_reuseport", int(config.WORKERS > 1))],
+        maximum_concurrent_rpcs=config.MAX_CONCURRENT_RPCS or None,
+    )
+    server.add_insecure_port(f"[::]:{config.PORT}")
+    add_servicer(Corical(), server, executor)
+    health_servicer = health.aio.HealthServicer()
+    health_pb2_grpc.add_HealthServicer_to_server(health_servicer, server)
+
+    async def set_serving(status):
+        for service in health_services:
+            await health_servicer.set(service, status)
+
+    await server.start()
+    logger.info(f"Listening on port {config.PORT} (aio)")
+
+    loop = asyncio.get_running_loop()
+    if config.WARMUP == "background":
+        await set_serving(health_pb2.HealthCheckResponse.NOT_SERVING)
+
+        async def warm_up_then_serve():
+            await loop.run_in_executor(executor, warm_up)
+            await set_serving(health_pb2.HealthCheckResponse.SERVING)
+
+        # keep a reference, the loop only holds tasks weakly
+        warming = asyncio.create_task(warm_up_then_serve())
+    else:
+        await set_serving(health_pb2.HealthCheckResponse.SERVING)
+
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+    await stop.wait()
+
+    logger.info(f"Draining for up to {config.SHUTDOWN_GRACE}s")
+    await health_servicer.enter_graceful_shutdown()
+    await server.stop(config.SHUTDOWN_GRACE)
+    executor.shutdown()
+
+
+def serve():
+    """
+    Run the server in this process, or in CORICAL_WORKERS processes that all
+    listen on the same port, since inference in one process is bound by the GIL
+    """
+    if config.WORKERS <= 1:
+        serve_worker()
+        return
+
+    # spawn rather than fork, grpc doesn't survive a fork
+    ctx = multiprocessing.get_context("spawn")
+    workers = {}
+    stopping = False
+
+    def start_worker(index):
+        worker = ctx.Process(target=serve_worker, args=(index,), daemon=True)
+        worker.index = index
+        worker.start()
+        workers[worker.sentinel] = worker
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for worker in workers.values():
+            worker.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for index in range(config.WORKERS):
+        start_worker(index)
+    logger.info(f"Started {config.WORKERS} workers")
 
+    while workers:
+        for sentinel in multiprocessing.connection.wait(list(workers)):
+            worker = workers.pop(sentinel)
+            worker.join()
+            if not stopping:
+                logger.error(f"Worker {worker.pid} exited with {worker.exitcode}, restarting it")
+                start_worker(worker.index)
 
 
-corical_pb2_grpc.add_CoricalServicer_to_server(Corical(), server)
-server.start()
-signal.pause()
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,93 @@
+"""
+Run the synchronous Corical handlers on a grpc.aio server.
+
+Inference is CPU-bound, so the handlers run in a thread pool executor and the
+event loop only moves bytes. Each call gets an ExecutorContext in place of the
+aio context, which the handler can use from its executor thread. Calls
+cancelled while they wait for an executor thread never run.
+"""
+import asyncio
+import threading
+from time import monotonic
+
+
+class _Abort(Exception):
+    def __init__(self, code, details):
+        super().__init__(details)
+        self.code = code
+        self.details = details
+
+
+class ExecutorContext:
+    """
+    The parts of grpc.ServicerContext the handlers use, safe to call from an
+    executor thread. abort() is handed back to the event loop.
+    """
+
+    def __init__(self, context):
+        remaining = context.time_remaining()
+        self._deadline = None if remaining is None else monotonic() + remaining
+        self._done = threading.Event()
+        self._code = None
+        self.initial_metadata = None
+        context.add_done_callback(lambda _: self._done.set())
+
+    def is_active(self):
+        return not self._done.is_set()
+
+    def time_remaining(self):
+        if self._deadline is None:
+            return None
+        return max(0.0, self._deadline - monotonic())
+
+    def code(self):
+        return self._code
+
+    def send_initial_metadata(self, metadata):
+        # sent from the event loop once a unary handler returns
+        self.initial_metadata = metadata
+
+    def abort(self, code, details):
+        self._code = code
+        raise _Abort(code, details)
+
+
+def unary_in_executor(behaviour, executor):
+    """
+    Async version of a unary handler, running it in the executor
+    """
+
+    async def handle(request, context):
+        loop = asyncio.get_running_loop()
+        executor_context = ExecutorContext(context)
+        try:
+            res = await loop.run_in_executor(executor, behaviour, request, executor_context)
+        except _Abort as e:
+            await context.abort(e.code, e.details)
+        if executor_context.initial_metadata is not None:
+            await context.send_initial_metadata(executor_context.initial_metadata)
+        return res
+
+    return handle
+
+
+def stream_in_executor(behaviour, executor):
+    """
+    Async version of a server-streaming handler, running each step of its
+    generator in the executor
+    """
+
+    async def handle(request, context):
+        loop = asyncio.get_running_loop()
+        responses = behaviour(request, ExecutorContext(context))
+        end = object()
+        try:
+            while True:
+                res = await loop.run_in_executor(executor, next, responses, end)
+                if res is end:
+                    return
+                yield res
+        except _Abort as e:
+            await context.abort(e.code, e.details)
+
+    return handle
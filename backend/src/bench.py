@@ -0,0 +1,252 @@
+"""
+Latency benchmarks for the models, engines and RPCs.
+
+    python src/bench.py run --out bench.json [--only load,infer,probs,rpc] [--repeat 20]
+    python src/bench.py compare base.json bench.json [--threshold 0.2]
+
+run writes one entry per benchmark with its median ("ms") and spread.
+CORICAL_ENGINE chooses the engine; only "smile" needs pysmile to load,
+infer and compute probabilities, rpc needs it either way like the server.
+compare lists every benchmark and exits with 1 if any median grew by more
+than the threshold (a fraction of the base median) since the base run.
+"""
+import argparse
+import json
+import logging
+import platform
+import sys
+from concurrent import futures
+from datetime import datetime
+from itertools import product
+from pathlib import Path
+from time import perf_counter_ns
+
+import grpc
+import numpy as np
+
+import config
+import xdsl
+
+logging.basicConfig(format="%(asctime)s: %(name)s: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+model_files = sorted(p.name for p in Path(__file__).parent.glob("*.xdsl"))
+
+
+def summary(times):
+    times = np.array(times)
+    return {
+        "ms": float(np.median(times)),
+        "p90_ms": float(np.percentile(times, 90)),
+        "min_ms": float(times.min()),
+        "runs": len(times),
+    }
+
+
+def timed(fn, repeat, warmup=1):
+    """
+    Summary of the milliseconds fn takes, over repeat calls after warmup ones
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = perf_counter_ns()
+        fn()
+        times.append((perf_counter_ns() - start) / 1e6)
+    return summary(times)
+
+
+def bench_load(repeat):
+    results = {}
+    for model_file in model_files:
+        results[f"load/parse/{model_file}"] = timed(lambda: xdsl.Model(model_file, compile=False), repeat, warmup=0)
+        results[f"load/compiled/{model_file}"] = timed(lambda: xdsl.Model(model_file), repeat)
+        model = xdsl.Model(model_file, compile=False)
+        results[f"load/junction_tree/{model_file}"] = timed(
+            lambda: xdsl.JunctionTree(model.nodes, model.probability_matrix), repeat, warmup=0
+        )
+        if config.ENGINE == "smile":
+            # pysmile and its license are only needed for the smile engine
+            from model import SmileModel
+
+            results[f"load/smile/{model_file}"] = timed(lambda: SmileModel(model_file), repeat, warmup=0)
+    return results
+
+
+def bench_infer(repeat):
+    results = {}
+    for model_file in model_files:
+        model = xdsl.Model(model_file)
+        for node in model.nodes:
+            results[f"infer/{model_file}/{node}"] = timed(lambda: model.infer({}, node), repeat)
+    return results
+
+
+def bench_probs(repeat):
+    import pfizer
+    import tts
+
+    sex_vec = np.array([0.5, 0.5])
+    return {
+        "probs/tts": timed(
+            lambda: tts.compute_probs("TwoAZ_2to4_months", "age_50_59", sex_vec, tts.scenario_to_vec("ATAGI_Med")), repeat
+        ),
+        "probs/tts_batch_3": timed(
+            lambda: tts.compute_probs_batch(
+                [(dose, "age_50_59", sex_vec, "ATAGI_Med") for dose in ["TwoAZ_2to4_months", "OneAZ_under_3_weeks", "TwoAZ_OnePfz_under_2_months"]]
+            ),
+            repeat,
+        ),
+        "probs/pfizer": timed(lambda: pfizer.compute_probs("Two_2_4mths", "Age_50_59", "ATAGI_Med", sex_vec), repeat),
+        "probs/pfizer_batch_3": timed(
+            lambda: pfizer.compute_probs_batch(
+                [(dose, "Age_50_59", "ATAGI_Med", sex_vec) for dose in ["Two_2_4mths", "One_at_3wks", "Three"]]
+            ),
+            repeat,
+        ),
+    }
+
+
+def rpc_requests():
+    from proto import corical_pb2
+
+    combined = [
+        corical_pb2.ComputeCombinedReq(dose_number=dose_number, dose_2=dose_2, dose_3=dose_3, dose_time=dose_time, age=age, sex=sex, ct=ct)
+        for (dose_number, dose_2, dose_3, dose_time), age, sex, ct in product(
+            [("Two", "Pf", "", "under_2_months"), ("Three", "AZ", "Pf", "6_months"), ("Four_doses_any", "", "", "")],
+            [19, 44, 90],
+            ["female", "other"],
+            ["Two_percent", "ATAGI_Low"],
+        )
+    ]
+    children = [
+        corical_pb2.ComputePfizerReq(age=age, sex=sex, ct=ct)
+        for age, sex, ct in product([6, 15], ["female", "male", "other"], ["One_Percent", "Ten_Percent"])
+    ]
+    return {"ComputeCombined": combined, "ComputePfizerChildren": children}
+
+
+def bench_rpc(repeat, clients=(1, 8, 32), cache=False):
+    """
+    Latency of each RPC through an in-process server, with every client
+    thread sending repeat requests back to back
+    """
+    import app
+    from proto import corical_pb2_grpc
+
+    if not cache:
+        app.response_cache.max_entries = 0
+    app.registry.preload()
+    combined_table_used = app.load_combined_table(app.registry.current("combined"))
+
+    server = grpc.server(futures.ThreadPoolExecutor(config.THREADS))
+    port = server.add_insecure_port("localhost:0")
+    app.add_servicer(app.Corical(), server)
+    server.start()
+    stub = corical_pb2_grpc.CoricalStub(grpc.insecure_channel(f"localhost:{port}"))
+
+    results = {}
+    for method, reqs in rpc_requests().items():
+        call = getattr(stub, method)
+        for req in reqs:
+            call(req)
+
+        for count in clients:
+
+            def client(offset):
+                times = []
+                for i in range(repeat):
+                    start = perf_counter_ns()
+                    call(reqs[(offset + i) % len(reqs)])
+                    times.append((perf_counter_ns() - start) / 1e6)
+                return times
+
+            start = perf_counter_ns()
+            with futures.ThreadPoolExecutor(count) as pool:
+                times = [t for client_times in pool.map(client, range(count)) for t in client_times]
+            elapsed = (perf_counter_ns() - start) / 1e9
+            result = summary(times)
+            result["p99_ms"] = float(np.percentile(times, 99))
+            result["rps"] = len(times) / elapsed
+            results[f"rpc/{method}/{count}_clients"] = result
+
+    server.stop(None)
+    results["rpc/meta"] = {"engine": config.ENGINE, "cache": cache, "combined_table": combined_table_used}
+    return results
+
+
+benchmarks = {
+    "load": bench_load,
+    "infer": bench_infer,
+    "probs": bench_probs,
+    "rpc": bench_rpc,
+}
+
+
+def run(args):
+    only = args.only.split(",") if args.only else list(benchmarks)
+    results = {}
+    for name in only:
+        logger.info(f"Running {name} benchmarks")
+        results.update(benchmarks[name](args.repeat))
+    out = {
+        "meta": {
+            "time": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+        },
+        "results": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(out, f, indent=2)
+    logger.info(f"Wrote {len(results)} results to {args.out}")
+
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)["results"]
+    with open(args.new) as f:
+        new = json.load(f)["results"]
+
+    regressions = 0
+    for name in sorted(set(base) & set(new)):
+        if "ms" not in base[name] or "ms" not in new[name]:
+            continue
+        before, after = base[name]["ms"], new[name]["ms"]
+        change = after / before - 1 if before else 0.0
+        flag = ""
+        if change > args.threshold:
+            regressions += 1
+            flag = "  REGRESSION"
+        print(f"{name:80} {before:10.3f} -> {after:10.3f} ms {change:+7.1%}{flag}")
+    for name in sorted(set(base) ^ set(new)):
+        print(f"{name:80} only in {'base' if name in base else 'new'}")
+
+    print(f"{regressions} regressions over {args.threshold:.0%}")
+    sys.exit(1 if regressions else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run")
+    run_parser.add_argument("--out", default="bench.json")
+    run_parser.add_argument("--only", help=f"comma separated subset of {','.join(benchmarks)}")
+    run_parser.add_argument("--repeat", type=int, default=20, help="timed calls per benchmark (per client for rpc)")
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown, as a fraction")
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
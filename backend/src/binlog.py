@@ -0,0 +1,234 @@
+"""
+Binary request log.
+
+Handlers hand their BinLog fields to a BinlogSink, which builds and
+serialises the message on a background thread and appends it, prefixed with
+its varint length (like protobuf's writeDelimitedTo), to rotating files.
+
+Run this module to read the files back, or older "binlog: <base64>" log lines:
+
+    python src/binlog.py decode binlogs/*.bin.gz
+    python src/binlog.py json binlogs/*.bin.gz
+    python src/binlog.py base64 binlogs/*.bin.gz
+"""
+import argparse
+import base64
+import gzip
+import logging
+import queue
+import sys
+import threading
+from datetime import datetime
+from pathlib import Path
+
+from google.protobuf import json_format, text_format
+
+from proto import corical_pb2
+
+logging.basicConfig(format="%(asctime)s: %(name)s: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte, value = value & 0x7F, value >> 7
+        if not value:
+            out.append(byte)
+            return bytes(out)
+        out.append(byte | 0x80)
+
+
+def _read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+class BinlogSink:
+    """
+    Bounded queue of BinLog records and the thread that writes them out
+    """
+
+    def __init__(self, directory, max_bytes=64 << 20, backup_count=20, compress=True, queue_size=10000, policy="drop"):
+        """
+        params:
+            directory - where the binlog files go
+            max_bytes - start a new file after this many (uncompressed) bytes
+            backup_count - number of old files to keep
+            compress - gzip the files
+            queue_size - records waiting to be written before the policy applies
+            policy - "drop" records or "block" the request when the queue is full
+        """
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = compress
+        self.policy = policy
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0
+        self.written = 0
+        self.worker = 0
+        self._file = None
+        self._file_bytes = 0
+        self._thread = None
+
+    def start(self, worker=0):
+        """
+        params:
+            worker - index of the server worker, which names its files, so a
+                restarted worker takes over the files of the one it replaces
+        """
+        self.worker = worker
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="binlog", daemon=True)
+        self._thread.start()
+
+    def log(self, **fields):
+        """
+        Queue a BinLog with the given fields, serialised off the request thread.
+        res may be given as a ComputeRes or its serialised bytes.
+        """
+        if self._thread is None:
+            # binlogs are off, nothing is lost
+            return
+        try:
+            self.queue.put(fields, block=self.policy == "block")
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning(f"Binlog queue full, {self.dropped} records dropped so far")
+
+    def close(self):
+        """
+        Write out everything queued so far and close the current file
+        """
+        if self._thread is None:
+            return
+        self.queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def _open(self):
+        suffix = ".bin.gz" if self.compress else ".bin"
+        name = f"binlog-{datetime.now():%Y%m%d-%H%M%S-%f}-w{self.worker}{suffix}"
+        self._file = gzip.open(self.directory / name, "wb") if self.compress else open(self.directory / name, "wb")
+        self._file_bytes = 0
+
+        # the other workers' files are theirs to remove, one may still be open
+        paths = sorted(self.directory.glob(f"binlog-*-w{self.worker}.bin*"), key=lambda path: path.stat().st_mtime)
+        old = paths[: -self.backup_count - 1]
+        for path in old:
+            path.unlink()
+
+    def _write(self, fields):
+        res = fields.pop("res", None)
+        data = corical_pb2.BinLog(**fields).SerializeToString()
+        if isinstance(res, bytes):
+            # already serialised ComputeRes: append it as field 3
+            data += b"\x1a" + _varint(len(res)) + res
+        elif res is not None:
+            data += corical_pb2.BinLog(res=res).SerializeToString()
+        if self._file is None or self._file_bytes >= self.max_bytes:
+            if self._file is not None:
+                self._file.close()
+            self._open()
+        self._file.write(_varint(len(data)) + data)
+        self._file_bytes += len(data)
+        self.written += 1
+
+    def _run(self):
+        while True:
+            fields = self.queue.get()
+            # write whatever else is already waiting before flushing
+            while fields is not None:
+                try:
+                    self._write(fields)
+                except Exception as e:
+                    logger.error(f"Could not write binlog: {e}")
+                try:
+                    fields = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            if self._file is not None:
+                self._file.flush()
+            if fields is None:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                return
+
+
+def recent_binlogs(directory, since=0):
+    """
+    Binlog files in the directory written to since the given time (in seconds
+    since the epoch), oldest first
+    """
+    paths = [path for path in Path(directory).glob("binlog-*.bin*") if path.stat().st_mtime >= since]
+    return sorted(paths, key=lambda path: path.stat().st_mtime)
+
+
+def read_binlogs(path):
+    """
+    Yield the BinLog messages in a binlog file (gzipped or not), or in a text
+    log with "binlog: <base64>" lines
+    """
+    path = Path(path)
+    with (gzip.open(path, "rb") if path.suffix == ".gz" else path.open("rb")) as f:
+        data = f.read()
+
+    if b"binlog: " in data:
+        for line in data.decode("utf8", errors="replace").splitlines():
+            _, sep, encoded = line.partition("binlog: ")
+            if sep:
+                yield corical_pb2.BinLog.FromString(base64.b64decode(encoded.strip()))
+        return
+
+    pos = 0
+    while pos < len(data):
+        size, pos = _read_varint(data, pos)
+        if pos + size > len(data):
+            logger.warning(f"{path} ends with a partly written record")
+            return
+        yield corical_pb2.BinLog.FromString(data[pos : pos + size])
+        pos += size
+
+
+def binlog_request(binlog):
+    """
+    RPC name and request of a BinLog, or (None, None) if it has none
+    """
+    if binlog.HasField("combined_req"):
+        return "ComputeCombined", binlog.combined_req
+    if binlog.HasField("pfizer_req"):
+        # both Pfizer RPCs log a pfizer_req
+        return ("ComputePfizerChildren" if binlog.res.vaccine_type == "Children" else "ComputePfizer"), binlog.pfizer_req
+    if binlog.HasField("tts_req"):
+        return "ComputeTTS", binlog.tts_req
+    return None, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("format", choices=["decode", "json", "base64"])
+    parser.add_argument("files", nargs="+")
+    args = parser.parse_args()
+
+    for path in args.files:
+        for binlog in read_binlogs(path):
+            if args.format == "decode":
+                print(text_format.MessageToString(binlog))
+            elif args.format == "json":
+                print(json_format.MessageToJson(binlog, indent=None, preserving_proto_field_name=True))
+            else:
+                print("binlog: " + base64.b64encode(binlog.SerializeToString()).decode("utf8"))
+            sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
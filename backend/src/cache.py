@@ -0,0 +1,51 @@
+"""
+Bounded LRU cache with expiry, for serialised responses
+"""
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+
+class ResponseCache:
+    def __init__(self, max_entries=4096, ttl=3600.0):
+        """
+        params:
+            max_entries - least recently used entries are evicted beyond this
+            ttl - seconds an entry stays valid, 0 for no expiry
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Cached value for the key, or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or (self.ttl and entry[0] < monotonic()):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        if not self.max_entries:
+            return
+        with self._lock:
+            self._entries[key] = (monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,127 @@
+"""
+Check the ComputeTTS and ComputePfizer networks against forward evaluation.
+
+These networks were first evaluated by pushing distributions forward from
+the evidence, where setting a node replaces its distribution. For every
+dose, age, sex and transmission (including none, where infection is
+impossible) this compares the baseline and given-infected outcomes of
+xdsl.Model, in a single pass and batched, with that evaluation, and checks
+they are all finite. A sex of "other" (evidence that isn't a single state)
+is only checked for being finite and the same both ways, since forward
+evaluation treats parents that share it as independent.
+
+    python src/compare_forward.py [--tolerance 1e-9]
+"""
+import argparse
+import logging
+import sys
+from itertools import product
+
+import numpy as np
+
+import pfizer
+import tts
+
+logging.basicConfig(format="%(asctime)s: %(name)s: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# module, infection node, sex node, the nodes with a state per scenario in
+# the order compute_probs_batch takes them, with the sex vector at sex_index,
+# and compute_probs for such a scenario
+networks = {
+    "tts": (
+        tts,
+        "n14_Infection_at_current_transmission",
+        "n5_Sex",
+        ["n1_Dose", "n2_Age", "n4_Transmission"],
+        2,
+        lambda dose, age, sex_vec, ct: tts.compute_probs(dose, age, sex_vec, tts.scenario_to_vec(ct)),
+    ),
+    "pfizer": (
+        pfizer,
+        "n10_Risk_of_infection_under_current_transmission_and_vaccination_status",
+        "n3_Sex",
+        ["n1_Pfizer_dose", "n2_Age_group", "n4_Community_transmission"],
+        3,
+        pfizer.compute_probs,
+    ),
+}
+
+
+def forward(model, values, node, memo):
+    """
+    Distribution of the node, multiplying parent distributions into its CPT
+    """
+    if node in values:
+        return values[node]
+    if node not in memo:
+        cur = model.probability_matrix[node]
+        for parent in reversed(model.nodes[node]["parents"]):
+            cur = forward(model, values, parent, memo) @ cur
+        memo[node] = cur
+    return memo[node]
+
+
+def compare(name, tolerance):
+    """
+    Returns (compared scenarios, worst absolute difference, non-finite outcomes)
+    """
+    module, infection_node, sex_node, scenario_nodes, sex_index, compute_probs = networks[name]
+    model = module.model()
+    yes = model.unit_vec_for_state(infection_node, "Yes")
+    sexes = [model.unit_vec_for_state(sex_node, state) for state in model.nodes[sex_node]["states"]]
+    sexes.append(np.full(len(sexes), 1 / len(sexes)))
+
+    scenarios = []
+    worst = 0.0
+    non_finite = 0
+    for states, sex_vec in product(product(*(model.nodes[node]["states"] for node in scenario_nodes)), sexes):
+        values = {node: model.unit_vec_for_state(node, state) for node, state in zip(scenario_nodes, states)}
+        values[sex_node] = sex_vec
+        scenario = list(states)
+        scenario.insert(sex_index, sex_vec)
+        scenarios.append(tuple(scenario))
+
+        evidence, roots = model.split_roots(values)
+        baseline = model.posteriors(evidence, module.baseline_nodes, interventions=roots)
+        infected = model.posteriors(evidence, module.infected_nodes, interventions=dict(roots, **{infection_node: yes}))
+        got = [baseline[node] for node in module.baseline_nodes] + [infected[node] for node in module.infected_nodes]
+        non_finite += sum(not np.isfinite(dist).all() for dist in got)
+        if sex_vec.max() < 1:
+            continue
+        memo = {}
+        memo_infected = {}
+        expected = [forward(model, values, node, memo) for node in module.baseline_nodes]
+        expected += [forward(model, dict(values, **{infection_node: yes}), node, memo_infected) for node in module.infected_nodes]
+        for node, dist, reference in zip(module.baseline_nodes + module.infected_nodes, got, expected):
+            # some CPT rows sum to 1 give or take 1e-8, posteriors are normalised
+            diff = np.abs(dist - reference / reference.sum()).max()
+            if not diff <= tolerance:
+                logger.error(f"{name}: {node} differs by {diff} for {states} {sex_vec}")
+            worst = max(worst, diff)
+
+    # the batched path, used to serve requests, must agree with the single one
+    batched = np.array(module.compute_probs_batch(scenarios))
+    single = np.array([compute_probs(*scenario) for scenario in scenarios])
+    non_finite += int((~np.isfinite(batched)).sum() + (~np.isfinite(single)).sum())
+    diff = np.abs(batched - single).max()
+    if not diff <= tolerance:
+        logger.error(f"{name}: compute_probs_batch differs from compute_probs by {diff}")
+    return len(scenarios), max(worst, diff), non_finite
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tolerance", type=float, default=1e-9)
+    args = parser.parse_args()
+
+    ok = True
+    for name in networks:
+        compared, worst, non_finite = compare(name, args.tolerance)
+        logger.info(f"{name}: {compared} scenarios, max difference {worst:.3g}, {non_finite} non-finite outcomes")
+        ok = ok and worst <= args.tolerance and not non_finite
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Check xdsl.Model posteriors against pysmile's update_beliefs.
+
+For every bundled network this sets each single state as evidence, then a
+number of random evidence combinations of each kind, and compares the
+marginals of all nodes:
+
+    hard     states of a few nodes
+    virtual  likelihood vectors on nodes with parents (set_virtual_evidence)
+    mixed    both of the above
+    root     likelihood vectors on nodes without parents, which both
+             engines multiply into the prior (e.g. sex "other")
+
+Needs pysmile and its license, like model.py.
+
+    python src/compare_smile.py [--cases 200] [--tolerance 1e-9] [files...]
+"""
+import argparse
+import logging
+import random
+import sys
+from pathlib import Path
+
+import numpy as np
+
+import xdsl
+import pysmile
+from model import SmileModel
+
+logging.basicConfig(format="%(asctime)s: %(name)s: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def likelihood(model, node, rng):
+    return np.array([rng.uniform(0.05, 1) for _ in model.nodes[node]["states"]])
+
+
+def evidence_cases(model, count, rng):
+    """
+    Yields (kind, evidence), evidence maps nodes to a state or a likelihood vector
+    """
+    for node, facts in model.nodes.items():
+        for state in facts["states"]:
+            yield "hard", {node: state}
+    roots = [node for node, facts in model.nodes.items() if not facts["parents"]]
+    children = [node for node, facts in model.nodes.items() if facts["parents"]]
+    for _ in range(count):
+        nodes = rng.sample(list(model.nodes), rng.randint(2, min(6, len(model.nodes))))
+        yield "hard", {node: rng.choice(model.nodes[node]["states"]) for node in nodes}
+        nodes = rng.sample(children, rng.randint(1, min(4, len(children))))
+        yield "virtual", {node: likelihood(model, node, rng) for node in nodes}
+        nodes = rng.sample(children, rng.randint(2, min(6, len(children))))
+        yield "mixed", {
+            node: rng.choice(model.nodes[node]["states"]) if i % 2 else likelihood(model, node, rng)
+            for i, node in enumerate(nodes)
+        }
+        nodes = rng.sample(roots, rng.randint(1, min(3, len(roots))))
+        yield "root", {node: likelihood(model, node, rng) for node in nodes}
+
+
+def compare(model_file, count, tolerance, rng):
+    """
+    Returns {kind: (compared cases, worst absolute difference)}
+    """
+    model = xdsl.Model(model_file)
+    net = SmileModel(model_file).get_network()
+    results = {}
+    for kind, evidence in evidence_cases(model, count, rng):
+        net.clear_all_evidence()
+        values = {}
+        for node, state in evidence.items():
+            if isinstance(state, str):
+                net.set_evidence(node, state)
+                model.set_fact(values, node, state)
+            else:
+                net.set_virtual_evidence(node, list(state))
+                values[node] = state
+        try:
+            net.update_beliefs()
+        except pysmile.SMILEException:
+            # impossible evidence, nothing to compare
+            continue
+
+        posteriors = model.posteriors(values)
+        diffs = {node: np.abs(posteriors[node] - np.array(net.get_node_value(node))).max() for node in model.nodes}
+        node = max(diffs, key=diffs.get)
+        if diffs[node] > tolerance:
+            logger.error(f"{model_file}: {node} differs by {diffs[node]} given {kind} evidence on {sorted(evidence)}")
+        compared, worst = results.get(kind, (0, 0.0))
+        results[kind] = (compared + 1, max(worst, diffs[node]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*", help="xdsl files, defaults to all bundled networks")
+    parser.add_argument("--cases", type=int, default=200, help="random evidence combinations of each kind per network")
+    parser.add_argument("--tolerance", type=float, default=1e-9)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    files = args.files or sorted(p.name for p in Path(__file__).parent.glob("*.xdsl"))
+    ok = True
+    for model_file in files:
+        for kind, (compared, worst) in compare(model_file, args.cases, args.tolerance, rng).items():
+            logger.info(f"{model_file}: {compared} {kind} evidence sets, max difference {worst:.3g}")
+            ok = ok and worst <= args.tolerance
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Server settings, read from the environment
+"""
+import os
+
+# inference engine for the request handlers: "xdsl" (in-process NumPy) or "smile"
+# (pysmile), which give the same posteriors, see compare_smile.py
+ENGINE = os.environ.get("CORICAL_ENGINE", "xdsl")
+
+# port the server listens on
+PORT = int(os.environ.get("CORICAL_PORT", 21000))
+
+# server processes sharing the port, each with its own models, caches and threads
+WORKERS = int(os.environ.get("CORICAL_WORKERS", 1))
+
+# request handler threads per process, also the most pysmile networks loaded per model
+THREADS = int(os.environ.get("CORICAL_THREADS", 32))
+
+# "thread" for a grpc.server, or "aio" for a grpc.aio server running the
+# handlers in a pool of THREADS threads
+SERVER = os.environ.get("CORICAL_SERVER", "thread")
+
+# calls in progress or queued per process before new ones are turned away
+# with RESOURCE_EXHAUSTED, 0 for no limit
+MAX_CONCURRENT_RPCS = int(os.environ.get("CORICAL_MAX_CONCURRENT_RPCS", 256))
+
+# seconds in-flight calls get to finish after SIGTERM
+SHUTDOWN_GRACE = float(os.environ.get("CORICAL_SHUTDOWN_GRACE", 10))
+
+# when the networks are read: "eager" before the port opens, "background" after
+# it opens with health checks answering NOT_SERVING until they are in, or
+# "lazy" on first use
+WARMUP = os.environ.get("CORICAL_WARMUP", "eager")
+
+# Prometheus text metrics on /metrics, worker N of several uses METRICS_PORT + N,
+# 0 turns the endpoint off
+METRICS_PORT = int(os.environ.get("CORICAL_METRICS_PORT", 21001))
+
+# binlog files, an empty directory turns binlogs off
+BINLOG_DIR = os.environ.get("CORICAL_BINLOG_DIR", "binlogs")
+BINLOG_MAX_BYTES = int(os.environ.get("CORICAL_BINLOG_MAX_BYTES", 64 << 20))
+BINLOG_BACKUP_COUNT = int(os.environ.get("CORICAL_BINLOG_BACKUP_COUNT", 20))
+BINLOG_COMPRESS = os.environ.get("CORICAL_BINLOG_COMPRESS", "1") == "1"
+BINLOG_QUEUE_SIZE = int(os.environ.get("CORICAL_BINLOG_QUEUE_SIZE", 10000))
+# what to do with a request's binlog when the queue is full: "drop" or "block"
+BINLOG_POLICY = os.environ.get("CORICAL_BINLOG_POLICY", "drop")
+
+# response cache entries and their lifetime in seconds (0 for no expiry)
+CACHE_SIZE = int(os.environ.get("CORICAL_CACHE_SIZE", 4096))
+CACHE_TTL = float(os.environ.get("CORICAL_CACHE_TTL", 3600))
+
+# before reporting ready (see WARMUP), fill the response cache with the
+# responses most often asked for in the binlogs in this directory, e.g. the
+# previous deploy's BINLOG_DIR; empty for none
+WARM_BINLOG_DIR = os.environ.get("CORICAL_WARM_BINLOG_DIR", "")
+# only requests from the last this many hours count
+WARM_HOURS = float(os.environ.get("CORICAL_WARM_HOURS", 24))
+# bytes of responses warmed at most
+WARM_MAX_BYTES = int(os.environ.get("CORICAL_WARM_MAX_BYTES", 32 << 20))
+
+# directory watched for new network files, see ModelRegistry.poll; empty turns
+# hot reloading off
+MODEL_DIR = os.environ.get("CORICAL_MODEL_DIR", "")
+# seconds between checks of MODEL_DIR
+MODEL_POLL = float(os.environ.get("CORICAL_MODEL_POLL", 30))
+
+# credible intervals, for requests that ask for them: CPT draws evaluated (cost
+# grows with them, 400 puts 10 draws past each end of a 95% interval), the
+# Dirichlet concentration of CPT rows without their own in <model>.uncertainty.json,
+# and the probability inside each interval
+CI_SAMPLES = int(os.environ.get("CORICAL_CI_SAMPLES", 400))
+CI_CONCENTRATION = float(os.environ.get("CORICAL_CI_CONCENTRATION", 1000))
+CI_LEVEL = float(os.environ.get("CORICAL_CI_LEVEL", 0.95))
+
+# relatable risk catalogue, see risks.py
+RISKS_FILE = os.environ.get("CORICAL_RISKS_FILE", "risks.json")
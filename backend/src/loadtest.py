@@ -0,0 +1,211 @@
+"""
+Load test: replay binlogged requests against a running server.
+
+    python src/loadtest.py binlogs/ [--target localhost:21000] [--concurrency 32]
+    python src/loadtest.py server.log --rate 200
+    python src/loadtest.py binlogs/*.bin.gz --speedup 10 --out load.json
+
+Requests come from binlog files, directories of them, or logs with
+"binlog: <base64>" lines (see binlog.py), in the order they were logged.
+
+By default --concurrency clients each send their next request as soon as the
+last one is answered (closed loop). --rate sends that many requests a second
+and --speedup keeps the logged arrival times, sped up by that factor; both are
+open loop, so a slow server gets requests faster than it answers them, and
+latency is measured from when each request was due.
+
+Reports latency percentiles and throughput per RPC, and counts responses that
+differ from the logged ones (drift), with risks compared to --tolerance.
+Exits with 1 on drift or failed calls.
+"""
+import argparse
+import json
+import logging
+import sys
+import threading
+from collections import defaultdict
+from concurrent import futures
+from pathlib import Path
+from time import perf_counter, sleep
+
+import grpc
+import numpy as np
+
+import config
+from binlog import binlog_request, read_binlogs, recent_binlogs
+from proto import corical_pb2
+
+logging.basicConfig(format="%(asctime)s: %(name)s: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def load_binlogs(paths, limit=0):
+    """
+    BinLogs with a request in the given files and directories, oldest first
+    """
+    binlogs = []
+    for path in map(Path, paths):
+        for file in recent_binlogs(path) if path.is_dir() else [path]:
+            binlogs += [binlog for binlog in read_binlogs(file) if binlog_request(binlog)[0]]
+    binlogs.sort(key=lambda binlog: (binlog.time.seconds, binlog.time.nanos))
+    return binlogs[:limit] if limit else binlogs
+
+
+def _risks(res):
+    return [risk.risk for graph in res.bar_graphs for risk in graph.risks]
+
+
+def drifted(expected, actual, tolerance=0.0):
+    """
+    Whether a response differs from the logged one, with risks allowed to be
+    off by a relative tolerance
+    """
+    if expected == actual:
+        return False
+    if not tolerance:
+        return True
+    expected_risks, actual_risks = _risks(expected), _risks(actual)
+    if len(expected_risks) != len(actual_risks):
+        return True
+    if not np.allclose(actual_risks, expected_risks, rtol=tolerance, atol=0, equal_nan=True):
+        return True
+    # everything but the risks must still match exactly
+    expected, actual = corical_pb2.ComputeRes.FromString(expected.SerializeToString()), corical_pb2.ComputeRes.FromString(actual.SerializeToString())
+    for res in (expected, actual):
+        for graph in res.bar_graphs:
+            for risk in graph.risks:
+                risk.risk = 0
+    return expected != actual
+
+
+class Results:
+    """
+    Latencies, status codes and drift per RPC, filled in from several threads
+    """
+
+    def __init__(self, tolerance, show_drift):
+        self.tolerance = tolerance
+        self.show_drift = show_drift
+        self.latencies = defaultdict(list)
+        self.codes = defaultdict(lambda: defaultdict(int))
+        self.drift = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add(self, binlog, rpc, latency_ms, code, res):
+        is_drift = False
+        # timing mode responses report how long they took, so always differ
+        timing = rpc == "ComputeTTS" and binlog_request(binlog)[1].compute_count
+        if res is not None and binlog.HasField("res") and not timing:
+            is_drift = drifted(binlog.res, corical_pb2.ComputeRes.FromString(res), self.tolerance)
+        with self._lock:
+            self.latencies[rpc].append(latency_ms)
+            self.codes[rpc][code] += 1
+            if is_drift:
+                self.drift[rpc] += 1
+                if self.drift[rpc] <= self.show_drift:
+                    logger.warning(f"{rpc} response differs from the logged one for {binlog_request(binlog)[1]}")
+
+    def report(self, elapsed):
+        rows = {}
+        for rpc in sorted(self.latencies) + ["all"]:
+            times = np.array(sum(self.latencies.values(), []) if rpc == "all" else self.latencies[rpc])
+            codes = defaultdict(int)
+            for name in self.codes if rpc == "all" else [rpc]:
+                for code, count in self.codes[name].items():
+                    codes[code] += count
+            rows[rpc] = {
+                "requests": len(times),
+                "rps": len(times) / elapsed,
+                "p50_ms": float(np.percentile(times, 50)),
+                "p90_ms": float(np.percentile(times, 90)),
+                "p99_ms": float(np.percentile(times, 99)),
+                "max_ms": float(times.max()),
+                "errors": sum(count for code, count in codes.items() if code != "OK"),
+                "codes": dict(codes),
+                "drift": sum(self.drift.values()) if rpc == "all" else self.drift[rpc],
+            }
+        return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="binlog files, directories of them, or logs with binlog lines")
+    parser.add_argument("--target", default=f"localhost:{config.PORT}", help="server, host:port")
+    parser.add_argument("--concurrency", type=int, default=32, help="clients, for a closed loop")
+    parser.add_argument("--rate", type=float, help="requests a second, for an open loop")
+    parser.add_argument("--speedup", type=float, help="replay at the logged arrival times, this many times faster")
+    parser.add_argument("--limit", type=int, default=0, help="requests replayed, 0 for all")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds before a call fails")
+    parser.add_argument("--tolerance", type=float, default=0.0, help="relative difference in risks that isn't drift")
+    parser.add_argument("--show-drift", type=int, default=5, help="drifted requests logged per RPC")
+    parser.add_argument("--out", help="write the report to this JSON file")
+    args = parser.parse_args()
+    if args.rate and args.speedup:
+        parser.error("--rate and --speedup are exclusive")
+
+    binlogs = load_binlogs(args.paths, args.limit)
+    if not binlogs:
+        parser.error("no requests in the binlogs")
+    channel = grpc.insecure_channel(args.target)
+    grpc.channel_ready_future(channel).result(timeout=args.timeout)
+    methods = {
+        method.name: channel.unary_unary(f"/corical.Corical/{method.name}", request_serializer=lambda request: request.SerializeToString())
+        for method in corical_pb2.DESCRIPTOR.services_by_name["Corical"].methods
+        if not method.server_streaming
+    }
+    results = Results(args.tolerance, args.show_drift)
+    # released once per recorded open loop call
+    recorded = threading.Semaphore(0)
+
+    def done(binlog, rpc, due, future):
+        latency = (perf_counter() - due) * 1000
+        try:
+            results.add(binlog, rpc, latency, "OK", future.result())
+        except grpc.RpcError as e:
+            results.add(binlog, rpc, latency, e.code().name, None)
+        recorded.release()
+
+    start = perf_counter()
+    if args.rate or args.speedup:
+        first = binlogs[0].time.seconds + binlogs[0].time.nanos / 1e9
+        for i, binlog in enumerate(binlogs):
+            offset = i / args.rate if args.rate else (binlog.time.seconds + binlog.time.nanos / 1e9 - first) / args.speedup
+            delay = start + offset - perf_counter()
+            if delay > 0:
+                sleep(delay)
+            rpc, request = binlog_request(binlog)
+            call = methods[rpc].future(request, timeout=args.timeout)
+            call.add_done_callback(lambda future, binlog=binlog, rpc=rpc, due=start + offset: done(binlog, rpc, due, future))
+        logger.info(f"Sent {len(binlogs)} requests in {perf_counter() - start:.1f}s")
+        for _ in binlogs:
+            recorded.acquire()
+    else:
+
+        def send(binlog):
+            rpc, request = binlog_request(binlog)
+            sent = perf_counter()
+            try:
+                res = methods[rpc](request, timeout=args.timeout)
+                results.add(binlog, rpc, (perf_counter() - sent) * 1000, "OK", res)
+            except grpc.RpcError as e:
+                results.add(binlog, rpc, (perf_counter() - sent) * 1000, e.code().name, None)
+
+        with futures.ThreadPoolExecutor(args.concurrency) as pool:
+            list(pool.map(send, binlogs))
+    elapsed = perf_counter() - start
+
+    report = results.report(elapsed)
+    print(f"{'rpc':24} {'requests':>8} {'rps':>8} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8} {'errors':>6} {'drift':>6}")
+    for rpc, row in report.items():
+        print(
+            f"{rpc:24} {row['requests']:8} {row['rps']:8.1f} {row['p50_ms']:8.2f} {row['p90_ms']:8.2f} "
+            f"{row['p99_ms']:8.2f} {row['max_ms']:8.2f} {row['errors']:6} {row['drift']:6}"
+        )
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"target": args.target, "elapsed_s": elapsed, "results": report}, f, indent=2)
+    sys.exit(1 if report["all"]["errors"] or report["all"]["drift"] else 0)
+
+
+if __name__ == "__main__":
+    main()
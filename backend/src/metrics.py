@@ -0,0 +1,170 @@
+"""
+In-process request metrics, served as Prometheus text.
+
+Handlers run inside track(rpc, context), which times the whole call and counts
+it by status code. Code anywhere below a handler calls lap(stage) at the end
+of each stage, which records the time since the previous lap (or the start of
+the call) under that rpc and stage. Outside a tracked call lap does nothing.
+"""
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter_ns
+
+logging.basicConfig(format="%(asctime)s: %(name)s: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# milliseconds
+default_buckets = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+_metrics = []
+_local = threading.local()
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Gauge:
+    """
+    Value read from a callback whenever the metrics are rendered
+    """
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+        _metrics.append(self)
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.read()}"]
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=default_buckets):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = list(buckets)
+        # label values -> [count per bucket and +Inf, sum]
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        ix = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[ix] += 1
+            self._values[key] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ["+Inf"], counts):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, [('le', bound)])} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+requests = Counter("corical_requests_total", "Finished calls by status code", ["rpc", "code"])
+request_ms = Histogram("corical_request_ms", "Time spent in the handler, in milliseconds", ["rpc"])
+stage_ms = Histogram("corical_stage_ms", "Time spent in each stage of the handler, in milliseconds", ["rpc", "stage"])
+cache_lookups = Counter("corical_cache_lookups_total", "Response cache lookups", ["rpc", "result"])
+
+
+@contextmanager
+def track(rpc, context=None):
+    """
+    Time a call and count it by the status it ended with
+    """
+    start = perf_counter_ns()
+    previous = getattr(_local, "call", None)
+    _local.call = [rpc, start]
+    code = "OK"
+    try:
+        yield
+    except Exception:
+        code = getattr(context.code(), "name", "UNKNOWN") if context is not None and hasattr(context, "code") else "UNKNOWN"
+        raise
+    finally:
+        _local.call = previous
+        request_ms.observe((perf_counter_ns() - start) / 1e6, rpc=rpc)
+        requests.inc(rpc=rpc, code=code)
+
+
+def lap(stage):
+    """
+    Record the time since the previous lap of this call as the given stage
+    """
+    call = getattr(_local, "call", None)
+    if call is None:
+        return
+    now = perf_counter_ns()
+    stage_ms.observe((now - call[1]) / 1e6, rpc=call[0], stage=stage)
+    call[1] = now
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = render().encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes would drown out the server log
+        pass
+
+
+def start_http_server(port):
+    """
+    Serve /metrics on the port from a background thread
+    """
+    server = ThreadingHTTPServer(("", port), _Handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Serving metrics on port {port}")
+    return server
@@ -3,16 +3,31 @@ Calculate network probabilites using the SMILE API.
 
 This requires a smile license to be placed in the smile directory.
 """
+from contextlib import contextmanager
 from pathlib import Path
+from time import sleep
+import hashlib
+import json
 import numpy as np
 import logging
+import queue
+import threading
+import warnings
 
 import pysmile
 import smile.pysmile_license
 
+import metrics
+import xdsl
+
 logging.basicConfig(format="%(asctime)s: %(name)s: %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def file_sha256(path):
+    with Path(path).open("rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
 # make class
 class SmileModel:
     """
@@ -52,6 +67,43 @@ class SmileModel:
                 logger.error(e)
         self.net.update_beliefs()
 
+    def reset(self):
+        """
+        Remove all evidence so the network can be handed to the next request
+        """
+        self.net.clear_all_evidence()
+
+    def infer_batch(self, rows, nodes):
+        """
+        Posterior distributions for several evidence assignments, with one
+        network update per row. Matches xdsl.Model.infer_batch, except that
+        impossible evidence raises like update_beliefs does.
+
+        Params:
+            rows - list of evidence dictionaries, as for set_evidence
+            nodes - list of node names
+        Returns dictionary of node names and (len(rows), states) arrays
+        Raises ValueError if the evidence of a row is impossible
+        """
+        output = {node: np.zeros((len(rows), self.net.get_outcome_count(node))) for node in nodes}
+        # with targets set, SMILE's relevance reasoning only updates the part
+        # of the network they depend on
+        for node in nodes:
+            self.net.set_target(node, True)
+        try:
+            for i, row in enumerate(rows):
+                self.reset()
+                try:
+                    self.set_evidence(row)
+                except pysmile.SMILEException as e:
+                    raise ValueError(f"Evidence has zero probability: {row}") from e
+                for node in nodes:
+                    output[node][i] = self.net.get_node_value(node)
+        finally:
+            self.reset()
+            self.net.clear_all_targets()
+        return output
+
     def get_binary_outcomes(self, nodes):
         """
         Return values for the first probability of the specified nodes as a
@@ -72,3 +124,437 @@ class SmileModel:
         return positive_outcomes
 
 
+class SmileModelPool:
+    """
+    Idle SmileModel instances for one network file.
+
+    The file is read once when the pool is preloaded, and afterwards only when
+    more requests run concurrently than there are idle instances, so request
+    handlers never parse the xdsl file themselves.
+
+    pysmile networks hold their evidence, so an instance is only ever used by
+    the thread that checked it out. Sizing the pool to the server's thread
+    pool means there is always an instance for every handler thread.
+    """
+    def __init__(self, model_file, max_size=None):
+        """
+        params:
+            model_file - network xdsl file
+            max_size - most instances checked out at once, further callers
+                wait for one to come back. None for no limit.
+        """
+        self.model_file = model_file
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size) if max_size else None
+        # called with the SmileModel when it is checked out / handed back
+        self.on_acquire = []
+        self.on_release = [SmileModel.reset]
+
+    def preload(self, count=1):
+        """
+        Read the network so the first requests do not pay for it
+        """
+        for _ in range(count):
+            self._idle.put(SmileModel(self.model_file))
+
+    @contextmanager
+    def acquire(self):
+        """
+        Check out an evidence-free SmileModel for the duration of the block
+        """
+        if self._slots is not None:
+            self._slots.acquire()
+        try:
+            try:
+                model = self._idle.get_nowait()
+            except queue.Empty:
+                logger.info("Reading {} for a new pool instance".format(self.model_file))
+                model = SmileModel(self.model_file)
+            for hook in self.on_acquire:
+                hook(model)
+            try:
+                yield model
+            finally:
+                try:
+                    for hook in self.on_release:
+                        hook(model)
+                except Exception as e:
+                    # don't hand a network in an unknown state to the next request
+                    logger.error("Dropping {} instance after failed release".format(self.model_file))
+                    logger.error(e)
+                else:
+                    self._idle.put(model)
+        finally:
+            if self._slots is not None:
+                self._slots.release()
+
+
+class ModelVersion:
+    """
+    One version of a named network, as read from one file.
+
+    Requests hold on to the version they started with, so swapping a new
+    version into the registry never changes the network under them.
+    """
+    def __init__(self, name, model_file, engine="smile", pool_size=None):
+        """
+        params:
+            name - registry name of the network
+            model_file - network xdsl file, relative to this directory or absolute
+            engine - "smile" or "xdsl"
+            pool_size - most SmileModel instances, see SmileModelPool
+        """
+        self.name = name
+        self.file = model_file
+        self.path = (Path(__file__).parent / model_file).resolve()
+        self.engine = engine
+        self.version = file_sha256(self.path)[:12]
+        self.pool = SmileModelPool(model_file, pool_size)
+        self._model = None
+        self._concentration = None
+        self._lock = threading.Lock()
+
+    def model(self):
+        """
+        Shared xdsl.Model of this version
+        """
+        with self._lock:
+            if self._model is None:
+                model = xdsl.Model(self.file)
+                # compile the junction tree now rather than on the first request
+                model.junction_tree
+                self._model = model
+            return self._model
+
+    def preload(self):
+        if self.engine == "xdsl":
+            self.model()
+        else:
+            self.pool.preload()
+
+    def concentration(self, default):
+        """
+        node -> Dirichlet concentration for credible intervals, from the
+        <model>.uncertainty.json file next to the model where it has one and
+        default for every other node (nodes at 0 keep their CPT)
+        """
+        if self._concentration is None:
+            concentration = {name: default for name in self.model().nodes}
+            path = self.path.with_name(self.path.stem + ".uncertainty.json")
+            if path.exists():
+                with path.open() as f:
+                    concentration.update(json.load(f))
+            self._concentration = {name: alpha for name, alpha in concentration.items() if alpha > 0}
+        return self._concentration
+
+    @contextmanager
+    def acquire(self, engine=None):
+        """
+        Context manager yielding an evidence-free network of this version,
+        a SmileModel or an xdsl.Model depending on the engine. Both provide
+        infer_batch.
+
+        Params:
+            engine - "smile" or "xdsl" in place of the version's, e.g. for
+                points that go with compute_outcome_intervals
+        """
+        if (engine or self.engine) == "xdsl":
+            model = self.model()
+            metrics.lap("acquire")
+            yield model
+        else:
+            with self.pool.acquire() as network:
+                metrics.lap("acquire")
+                yield network
+
+
+class ModelRegistry:
+    """
+    Process-wide set of named networks.
+
+    With the "smile" engine each network is a pool of SmileModel instances,
+    with the "xdsl" engine a single xdsl.Model shared read-only by all requests.
+
+    Each name maps to its active ModelVersion. A new file for a name is read
+    and checked in the background, then swapped in with a single assignment;
+    requests that already took the old version from current() finish on it.
+    """
+    def __init__(self, engine="smile", pool_size=None):
+        """
+        params:
+            engine - "smile" or "xdsl"
+            pool_size - most SmileModel instances per network, normally the
+                number of server threads
+        """
+        self.engine = engine
+        self.pool_size = pool_size
+        self.files = {}
+        self.nodes = {}
+        self.active = {}
+        # called with each new ModelVersion before it is swapped in
+        self.on_swap = []
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, model_file, nodes=()):
+        """
+        params:
+            name - name requests use for the network
+            model_file - network xdsl file
+            nodes - nodes the server sets evidence on or reads, which every
+                later version of the file has to keep
+        """
+        self.files[name] = model_file
+        self.nodes[name] = list(nodes)
+        self.active[name] = ModelVersion(name, model_file, self.engine, self.pool_size)
+
+    def current(self, name):
+        """
+        Active ModelVersion of the named network. Take it once per request and
+        use it throughout, so the request sees a single version.
+        """
+        return self.active[name]
+
+    def version(self, name):
+        """
+        Identifies the network contents, e.g. to key caches on
+        """
+        return self.current(name).version
+
+    def model(self, name):
+        """
+        Shared xdsl.Model for the named network
+        """
+        return self.current(name).model()
+
+    def preload(self):
+        for network in list(self.active.values()):
+            network.preload()
+
+    def acquire(self, name):
+        """
+        See ModelVersion.acquire, for the active version of the named network
+        """
+        return self.current(name).acquire()
+
+    def validate(self, candidate):
+        """
+        Raise ValueError unless the candidate can stand in for the active
+        version: every registered node must exist and keep its states in the
+        same order (new states may only be added after them), since requests
+        name states and pass evidence vectors by position.
+        """
+        old_nodes = self.current(candidate.name).model().nodes
+        new_nodes = candidate.model().nodes
+        for node in self.nodes[candidate.name]:
+            if node not in new_nodes:
+                raise ValueError(f"node {node} is missing")
+            old_states = old_nodes[node]["states"]
+            new_states = new_nodes[node]["states"]
+            if new_states[: len(old_states)] != old_states:
+                raise ValueError(f"node {node} has states {new_states}, expected {old_states} first")
+        posteriors = candidate.model().infer_batch([{}], self.nodes[candidate.name])
+        for node, values in posteriors.items():
+            if not np.isfinite(values).all():
+                raise ValueError(f"node {node} has no valid posterior")
+
+    def swap(self, name, model_file):
+        """
+        Read, check and preload a new file for the named network, then make it
+        the active version. Raises if the file is unusable, leaving the active
+        version in place.
+        """
+        candidate = ModelVersion(name, model_file, self.engine, self.pool_size)
+        self.validate(candidate)
+        candidate.preload()
+        for hook in self.on_swap:
+            hook(candidate)
+        with self._lock:
+            previous = self.active[name]
+            self.active[name] = candidate
+        logger.info(f"Swapped {name} from {previous.path.name} ({previous.version}) to {candidate.path.name} ({candidate.version})")
+        return candidate
+
+    def poll(self, model_dir):
+        """
+        Swap in every network whose file has changed.
+
+        model_dir/models.json, if present, maps network names to file names in
+        model_dir and overrides the registered files. A network is reloaded
+        when its file is renamed in the manifest or rewritten in place; write
+        new files under a temporary name and rename them, so that no half
+        written file is read.
+        """
+        model_dir = Path(model_dir)
+        manifest = model_dir / "models.json"
+        files = dict(self.files)
+        if manifest.exists():
+            try:
+                with manifest.open() as f:
+                    files.update({name: str(model_dir / model_file) for name, model_file in json.load(f).items()})
+            except (OSError, ValueError) as e:
+                logger.error(f"Ignoring unreadable {manifest}: {e}")
+
+        for name, model_file in files.items():
+            if name not in self.active:
+                continue
+            path = (Path(__file__).parent / model_file).resolve()
+            try:
+                stat = path.stat()
+            except OSError as e:
+                logger.error(f"Keeping {name} {self.version(name)}: {e}")
+                continue
+            # only rehash files that were touched since the last poll
+            seen = (path, stat.st_mtime_ns, stat.st_size)
+            if self._seen.get(name) == seen:
+                continue
+            self._seen[name] = seen
+            current = self.current(name)
+            if file_sha256(path)[:12] == current.version:
+                continue
+            try:
+                self.swap(name, str(path))
+            except Exception as e:
+                logger.error(f"Keeping {name} {current.version}, {path.name} is not usable: {e}")
+
+    def watch(self, model_dir, interval):
+        """
+        Poll model_dir for new network files every interval seconds, from a
+        background thread
+        """
+        def run():
+            while True:
+                sleep(interval)
+                try:
+                    self.poll(model_dir)
+                except Exception as e:
+                    logger.error(f"Model watcher: {e}")
+
+        threading.Thread(target=run, name="model-watcher", daemon=True).start()
+        logger.info(f"Watching {model_dir} for new networks every {interval}s")
+
+
+def compute_outcomes(network, scenarios, baseline_outcomes, infected_outcomes, infection_node):
+    """
+    Probability of the first state (Yes) of each outcome node for several
+    scenarios, batched
+
+    Params:
+        network - SmileModel or xdsl.Model
+        scenarios - list of evidence dictionaries
+        baseline_outcomes - dictionary of outcome names and node names
+        infected_outcomes - same, read with infection_node set to Yes
+    Returns list of dictionaries of outcome names and probabilities, nan
+    where the evidence is impossible (e.g. infection without transmission)
+    """
+    nodes = list(baseline_outcomes.values()) + list(infected_outcomes.values())
+    if isinstance(network, xdsl.Model):
+        # setting infection only changes the messages out of its side of the tree
+        context = network.context(scenarios, nodes, varying=[infection_node])
+        metrics.lap("evidence")
+        baseline = context.marginals(baseline_outcomes.values())
+        context.set(infection_node, network.unit_vec_for_state(infection_node, "Yes"))
+        infected = context.marginals(infected_outcomes.values())
+    else:
+        rows = scenarios + [dict(evidence, **{infection_node: "Yes"}) for evidence in scenarios]
+        metrics.lap("evidence")
+        try:
+            beliefs = network.infer_batch(rows, nodes)
+        except ValueError:
+            # some rows are impossible: redo them one at a time, so that only
+            # those come out nan as they do with xdsl
+            beliefs = {node: np.full((len(rows), network.get_network().get_outcome_count(node)), np.nan) for node in nodes}
+            for i, row in enumerate(rows):
+                try:
+                    row_beliefs = network.infer_batch([row], nodes)
+                except ValueError:
+                    continue
+                for node in nodes:
+                    beliefs[node][i] = row_beliefs[node][0]
+        baseline = {node: beliefs[node][: len(scenarios)] for node in baseline_outcomes.values()}
+        infected = {node: beliefs[node][len(scenarios) :] for node in infected_outcomes.values()}
+    metrics.lap("inference")
+
+    baseline = {node: np.broadcast_to(dist, (len(scenarios), dist.shape[-1])) for node, dist in baseline.items()}
+    infected = {node: np.broadcast_to(dist, (len(scenarios), dist.shape[-1])) for node, dist in infected.items()}
+    outcomes = []
+    for i in range(len(scenarios)):
+        cur = {name: float(baseline[node][i, 0]) for name, node in baseline_outcomes.items()}
+        cur.update({name: float(infected[node][i, 0]) for name, node in infected_outcomes.items()})
+        outcomes.append(cur)
+    metrics.lap("extract")
+    return outcomes
+
+
+def compute_outcome_intervals(model, scenarios, baseline_outcomes, infected_outcomes, infection_node, concentration, samples, level=0.95):
+    """
+    Credible intervals for compute_outcomes, from evaluating each scenario
+    under every set of sampled CPTs (see xdsl.Model.sample_cpts) at once
+
+    Params:
+        model - xdsl.Model
+        concentration, samples - as for xdsl.Model.sample_cpts
+        level - probability mass inside each interval
+    Returns list of dictionaries of outcome names and (lower, upper) bounds
+    """
+    nodes = list(baseline_outcomes.values()) + list(infected_outcomes.values())
+    cpts = model.sample_cpts(concentration, samples)
+    contexts = model.sampled_contexts(scenarios, nodes, cpts, varying=[infection_node])
+    metrics.lap("evidence")
+
+    tail = (1 - level) / 2
+    intervals = []
+    for context in contexts:
+        bounds = {}
+        for outcomes in (baseline_outcomes, infected_outcomes):
+            if outcomes is infected_outcomes:
+                context.set(infection_node, model.unit_vec_for_state(infection_node, "Yes"))
+            try:
+                posteriors = context.marginals(outcomes.values())
+            except ValueError:
+                # impossible evidence, only raised when no CPT was sampled
+                bounds.update({name: (np.nan, np.nan) for name in outcomes})
+                continue
+            for name, node in outcomes.items():
+                dist = np.broadcast_to(posteriors[node], (samples, posteriors[node].shape[-1]))
+                with warnings.catch_warnings():
+                    # impossible evidence gives all nan
+                    warnings.simplefilter("ignore", RuntimeWarning)
+                    lower, upper = np.nanquantile(dist[:, 0], [tail, 1 - tail])
+                bounds[name] = (float(lower), float(upper))
+        intervals.append(bounds)
+    metrics.lap("intervals")
+    return intervals
+
+
+def compute_outcome_sensitivities(model, evidence, baseline_outcomes, infected_outcomes, infection_node, top_k=None):
+    """
+    The CPT entries each outcome of a scenario is most sensitive to, see
+    xdsl.Model.sensitivity
+
+    Params:
+        model - xdsl.Model
+        evidence - evidence dictionary, as for compute_outcomes
+        top_k - number of entries to return, over all outcomes
+    Returns list of dictionaries as from xdsl.Model.sensitivity plus the
+    outcome name, largest derivative first
+    """
+    values = {}
+    for name, value in evidence.items():
+        values[name] = model.unit_vec_for_state(name, value) if isinstance(value, str) else np.asarray(value, dtype=float)
+    infected = dict(values, **{infection_node: model.unit_vec_for_state(infection_node, "Yes")})
+    metrics.lap("evidence")
+
+    found = []
+    for outcomes, scenario in ((baseline_outcomes, values), (infected_outcomes, infected)):
+        if not outcomes:
+            continue
+        names = {}
+        for name, node in outcomes.items():
+            names.setdefault(node, []).append(name)
+        for entry in model.sensitivity(scenario, list(names), top_k):
+            for name in names[entry["node"]]:
+                found.append(dict(entry, outcome=name))
+    found.sort(key=lambda entry: -abs(entry["derivative"]))
+    metrics.lap("sensitivity")
+    return found[:top_k]
@@ -1,6 +1,26 @@
+import threading
+
+import numpy as np
+
+import metrics
 import xdsl
 
-pfizer = xdsl.Model("Pf_March_GeNie_01-03-22.xdsl")
+model_file = "Pf_March_GeNie_01-03-22.xdsl"
+_model = None
+_lock = threading.Lock()
+
+
+def model():
+    """
+    Shared xdsl.Model of the Pfizer network, read on first use
+    """
+    global _model
+    if _model is None:
+        with _lock:
+            if _model is None:
+                _model = xdsl.Model(model_file)
+    return _model
+
 
 # n1_Pfizer_dose
 # n2_Age_group
@@ -19,6 +39,7 @@ pfizer = xdsl.Model("Pf_March_GeNie_01-03-22.xdsl")
 # n15_Die_from_COVID19_myocarditis
 
 def compute_probs(n1_pfizer_dose, n2_age, n4_ct, sex_vec, variant_vec=None):
+    pfizer = model()
     values = {
         "n3_Sex": sex_vec,
     }
@@ -28,20 +49,26 @@ def compute_probs(n1_pfizer_dose, n2_age, n4_ct, sex_vec, variant_vec=None):
     pfizer.set_fact(values, "n2_Age_group", n2_age)
     pfizer.set_fact(values, "n4_Community_transmission", n4_ct)
 
-    values_infected = dict(values)
 
-    get_covid = pfizer.infer(values, "n10_Risk_of_infection_under_current_transmission_and_vaccination_status")[0]
-    die_covid = pfizer.infer(values, "n14_Die_from_COVID19")[0]
-    get_myocarditis_vax = pfizer.infer(values, "n5_Vaccine_associated_myocarditis")[0]
-    die_myocarditis_vax = pfizer.infer(values, "n12_Die_from_Pfizer_myocarditis")[0]
-    get_myocarditis_bg = pfizer.infer(values, "n6_Myocarditis_background")[0]
-    die_myocarditis_bg = pfizer.infer(values, "n13_Die_from_background_myocarditis")[0]
+    # the scenario replaces the priors of the roots (sex "other" is a 50/50
+    # population), see xdsl.Model.split_roots
+    values, roots = pfizer.split_roots(values)
+
+    baseline = pfizer.posteriors(values, interventions=roots)
+    get_covid = baseline["n10_Risk_of_infection_under_current_transmission_and_vaccination_status"][0]
+    die_covid = baseline["n14_Die_from_COVID19"][0]
+    get_myocarditis_vax = baseline["n5_Vaccine_associated_myocarditis"][0]
+    die_myocarditis_vax = baseline["n12_Die_from_Pfizer_myocarditis"][0]
+    get_myocarditis_bg = baseline["n6_Myocarditis_background"][0]
+    die_myocarditis_bg = baseline["n13_Die_from_background_myocarditis"][0]
 
-    # if infected
-    pfizer.set_fact(values_infected, "n10_Risk_of_infection_under_current_transmission_and_vaccination_status", "Yes")
-    die_covid_if_got_it = pfizer.infer(values_infected, "n14_Die_from_COVID19")[0]
-    get_myocarditis_given_covid = pfizer.infer(values_infected, "n11_Myocarditis_from_COVID19")[0]
-    die_myocarditis_given_covid = pfizer.infer(values_infected, "n15_Die_from_COVID19_myocarditis")[0]
+    # if infected, set rather than observed so it is given even where it is
+    # impossible, e.g. with no transmission
+    infection_node = "n10_Risk_of_infection_under_current_transmission_and_vaccination_status"
+    infected = pfizer.posteriors(values, interventions=dict(roots, **{infection_node: pfizer.unit_vec_for_state(infection_node, "Yes")}))
+    die_covid_if_got_it = infected["n14_Die_from_COVID19"][0]
+    get_myocarditis_given_covid = infected["n11_Myocarditis_from_COVID19"][0]
+    die_myocarditis_given_covid = infected["n15_Die_from_COVID19_myocarditis"][0]
 
     return (
         get_covid,
@@ -54,3 +81,75 @@ def compute_probs(n1_pfizer_dose, n2_age, n4_ct, sex_vec, variant_vec=None):
         die_covid_if_got_it,
         die_covid,
     )
+
+
+baseline_nodes = [
+    "n10_Risk_of_infection_under_current_transmission_and_vaccination_status",
+    "n14_Die_from_COVID19",
+    "n5_Vaccine_associated_myocarditis",
+    "n12_Die_from_Pfizer_myocarditis",
+    "n6_Myocarditis_background",
+    "n13_Die_from_background_myocarditis",
+]
+
+infected_nodes = [
+    "n14_Die_from_COVID19",
+    "n11_Myocarditis_from_COVID19",
+    "n15_Die_from_COVID19_myocarditis",
+]
+
+# names of the compute_probs values, in order
+outcome_names = [
+    "get_covid",
+    "get_myocarditis_vax",
+    "die_myocarditis_vax",
+    "get_myocarditis_given_covid",
+    "die_myocarditis_given_covid",
+    "get_myocarditis_bg",
+    "die_myocarditis_bg",
+    "die_from_covid_given_infected",
+    "die_from_covid",
+]
+
+
+def compute_probs_batch(scenarios):
+    """
+    compute_probs for many scenarios, batched over the network.
+    The shared model is only read, so this is safe to call from any thread.
+
+    Params:
+        scenarios - list of (n1_pfizer_dose, n2_age, n4_ct, sex_vec)
+    Returns a list with one compute_probs tuple per scenario
+    """
+    pfizer = model()
+    rows = [
+        {"n1_Pfizer_dose": dose, "n2_Age_group": age, "n4_Community_transmission": ct, "n3_Sex": sex_vec}
+        for dose, age, ct, sex_vec in scenarios
+    ]
+    infection_node = "n10_Risk_of_infection_under_current_transmission_and_vaccination_status"
+    # the infected pass only recomputes what setting infection changes
+    context = pfizer.context(rows, set(baseline_nodes + infected_nodes), varying=[infection_node], replace_priors=True)
+    metrics.lap("evidence")
+    baseline = context.marginals(baseline_nodes)
+    context.intervene(infection_node, pfizer.unit_vec_for_state(infection_node, "Yes"))
+    infected = context.marginals(infected_nodes)
+    metrics.lap("inference")
+
+    n = len(rows)
+    baseline = {node: np.broadcast_to(dist, (n, dist.shape[-1]))[:, 0] for node, dist in baseline.items()}
+    infected = {node: np.broadcast_to(dist, (n, dist.shape[-1]))[:, 0] for node, dist in infected.items()}
+
+    columns = (
+        baseline["n10_Risk_of_infection_under_current_transmission_and_vaccination_status"],
+        baseline["n5_Vaccine_associated_myocarditis"],
+        baseline["n12_Die_from_Pfizer_myocarditis"],
+        infected["n11_Myocarditis_from_COVID19"],
+        infected["n15_Die_from_COVID19_myocarditis"],
+        baseline["n6_Myocarditis_background"],
+        baseline["n13_Die_from_background_myocarditis"],
+        infected["n14_Die_from_COVID19"],
+        baseline["n14_Die_from_COVID19"],
+    )
+    probs = [tuple(float(column[i]) for column in columns) for i in range(n)]
+    metrics.lap("extract")
+    return probs
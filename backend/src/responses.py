@@ -0,0 +1,224 @@
+"""
+ComputeRes assembled from prebuilt, serialised pieces.
+
+The text of a response comes from small sets of labels (doses, age brackets,
+sexes, transmission levels), so each label, bar and graph heading is
+serialised the first time it is used and kept. Per request only the risks
+and intervals are encoded, and the bars are sorted as a plain list of risks.
+
+Protobuf parses fields written one after the other as one message, so a bar
+is its label, then its risk, then the rest of its fields, written out in
+field order. The bytes come out the same as ComputeRes.SerializeToString().
+
+Compact responses are made from the full ones, with each string replaced by
+a template of the string catalogue (see texts.py) and the values of its slots.
+"""
+import hashlib
+import math
+import re
+import struct
+from functools import lru_cache
+
+import texts
+from proto import corical_pb2
+from risks import generate_relatable_risks
+
+sex_disclaimer = corical_pb2.Message(
+    heading=texts.SEX_DISCLAIMER_HEADING,
+    text=texts.SEX_DISCLAIMER,
+    severity="info",
+)
+
+no_transmission_note = corical_pb2.Message(
+    heading=texts.NO_TRANSMISSION_HEADING,
+    text=texts.NO_TRANSMISSION,
+    severity="warning",
+)
+
+_slot = re.compile(r"\{(\w+)\}")
+
+
+_small_varints = [bytes((value,)) for value in range(0x80)]
+
+
+def _varint(value):
+    if value < 0x80:
+        return _small_varints[value]
+    out = bytearray()
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _field(number, payload):
+    # length-delimited field, e.g. an embedded message
+    return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+
+
+def _risk(risk):
+    # BarGraphRisk.risk, a double left out when 0 like proto3 does
+    return struct.pack("<Bd", 2 << 3 | 1, risk) if risk != 0 else b""
+
+
+@lru_cache(maxsize=None)
+def _bar_fields(label, is_other_shot, bar_text, hover_text):
+    # the fields of a BarGraphRisk before and after its risk
+    before = corical_pb2.BarGraphRisk(label=label).SerializeToString()
+    after = corical_pb2.BarGraphRisk(is_other_shot=is_other_shot, bar_text=bar_text, hover_text=hover_text).SerializeToString()
+    return before, after
+
+
+@lru_cache(maxsize=None)
+def _relatable_bar(event, risk):
+    return _field(3, corical_pb2.BarGraphRisk(label=event, risk=risk, is_relatable=True).SerializeToString())
+
+
+@lru_cache(maxsize=4096)
+def _graph_heading(title, subtitle):
+    return corical_pb2.BarGraph(title=title, subtitle=subtitle).SerializeToString()
+
+
+def bar(label, risk, interval=None, is_other_shot=False, bar_text="", hover_text=""):
+    """
+    One bar of a graph, for bars()
+
+    Params:
+        label - text next to the bar
+        risk - probability
+        interval - (lower, upper) credible interval, or None
+    """
+    return _bar_fields(label, is_other_shot, bar_text, hover_text), risk, interval
+
+
+def bars(input_bars):
+    """
+    Serialised bars of a graph, lowest risk first, followed by a relatable risk
+    for comparison
+
+    Params:
+        input_bars - list of bar()
+    """
+    risks = [float(risk) for _, risk, _ in input_bars]
+    out = []
+    # nan (impossible evidence, which the handlers turn away) compares false
+    # both ways and would leave the order undefined, so it goes last
+    for i in sorted(range(len(risks)), key=lambda i: (math.isnan(risks[i]), risks[i])):
+        (before, after), risk, interval = input_bars[i]
+        body = before + _risk(risk) + after
+        if interval is not None:
+            body += _field(7, corical_pb2.Interval(lower=interval[0], upper=interval[1]).SerializeToString())
+        out.append(_field(3, body))
+    out += [_relatable_bar(r["event"], r["risk"]) for r in generate_relatable_risks(risks)]
+    return out
+
+
+def bar_graph(title, subtitle, risks):
+    """
+    Serialised BarGraph, as ComputeRes.bar_graphs
+
+    Params:
+        risks - from bars()
+    """
+    return _field(2, _graph_heading(title, subtitle) + b"".join(risks))
+
+
+def compute_res(scenario_description, bar_graphs, messages=(), printable=None, success=True, vaccine_type=""):
+    """
+    Serialised ComputeRes
+
+    Params:
+        bar_graphs - list of bar_graph()
+        messages - list of corical_pb2.Message
+        printable - corical_pb2.PrintableButton or None
+    """
+    head = corical_pb2.ComputeRes(scenario_description=scenario_description).SerializeToString()
+    tail = corical_pb2.ComputeRes(
+        messages=messages, printable=printable, success=success, vaccine_type=vaccine_type
+    ).SerializeToString()
+    return head + b"".join(bar_graphs) + tail
+
+
+class StringCatalogue:
+    """
+    Templates the text of compact responses refers to, versioned by a hash of
+    them, so a version never changes.
+
+    Params:
+        templates - list of strings with {slots}, the first standing for any
+            string that isn't in the catalogue, see texts.catalogue()
+    """
+
+    def __init__(self, templates):
+        self.templates = templates
+        self.version = hashlib.sha256("\0".join(templates).encode("utf8")).hexdigest()[:12]
+        self.serialised = corical_pb2.StringCatalogueRes(version=self.version, templates=templates).SerializeToString()
+        self._literals = {}
+        self._patterns = []
+        for index, template in enumerate(templates[1:], 1):
+            parts = _slot.split(template)
+            if len(parts) == 1:
+                self._literals.setdefault(template, index)
+            else:
+                # literal text and slots alternate, a slot takes anything
+                pattern = "".join(re.escape(part) if i % 2 == 0 else "(.*?)" for i, part in enumerate(parts))
+                self._patterns.append((index, re.compile(pattern, re.DOTALL)))
+
+    @lru_cache(maxsize=4096)
+    def text(self, text):
+        """
+        CompactText for a string
+        """
+        if not text:
+            return corical_pb2.CompactText()
+        if text in self._literals:
+            return corical_pb2.CompactText(template=self._literals[text])
+        for index, pattern in self._patterns:
+            match = pattern.fullmatch(text)
+            if match:
+                return corical_pb2.CompactText(template=index, args=match.groups())
+        return corical_pb2.CompactText(template=0, args=[text])
+
+
+def compact_res(scenario, res, catalogue):
+    """
+    Serialised ComputeRes with only compact, success and vaccine_type set
+
+    Params:
+        scenario - response cache key of the response, past the RPC name
+        res - serialised ComputeRes, as from compute_res
+        catalogue - StringCatalogue the text refers to
+    """
+    full = corical_pb2.ComputeRes.FromString(res)
+    text = catalogue.text
+    compact = corical_pb2.CompactRes(
+        scenario=[str(value) for value in scenario],
+        strings_version=catalogue.version,
+        scenario_description=text(full.scenario_description),
+        messages=[
+            corical_pb2.CompactMessage(heading=text(m.heading), text=text(m.text), severity=m.severity)
+            for m in full.messages
+        ],
+    )
+    if full.HasField("printable"):
+        compact.printable_text.CopyFrom(text(full.printable.text))
+        compact.printable_url.CopyFrom(text(full.printable.url))
+    for graph in full.bar_graphs:
+        risks = graph.risks
+        compact_graph = compact.bar_graphs.add(
+            title=text(graph.title),
+            subtitle=text(graph.subtitle),
+            labels=[text(r.label) for r in risks],
+            risks=[r.risk for r in risks],
+            flags=[r.is_relatable | r.is_other_shot << 1 for r in risks],
+        )
+        if any(r.bar_text or r.hover_text for r in risks):
+            compact_graph.bar_texts.extend(text(r.bar_text) for r in risks)
+            compact_graph.hover_texts.extend(text(r.hover_text) for r in risks)
+        if any(r.HasField("interval") for r in risks):
+            compact_graph.lower.extend(r.interval.lower if r.HasField("interval") else math.nan for r in risks)
+            compact_graph.upper.extend(r.interval.upper if r.HasField("interval") else math.nan for r in risks)
+
+    out = corical_pb2.ComputeRes(compact=compact, success=full.success, vaccine_type=full.vaccine_type)
+    return out.SerializeToString()
@@ -1,123 +1,99 @@
-risks = [
-    {
-        "event": "0%",
-        "risk": 0,
-    },
-    {
-        "event": "Chance of winning the best prize in the lotto in Australia",
-        "risk": 1 / 134_000_000,
-    },
-    {
-        "event": "Chance of giving birth to four identical babies if you are pregnant",
-        "risk": 1 / 15_000_000,
-    },
-    {
-        "event": "Chance of dying in a shark attack in a year in Australia",
-        "risk": 1 / 8_000_000,
-    },
-    {
-        "event": "Chance of dying from a lightning strike in a year in Australia",
-        "risk": 1 / 4_000_000,
-    },
-    {
-        "event": "Chance of dying by drowning in the bath some time in your life",
-        "risk": 1 / 685_000,
-    },
-    {
-        "event": "Chance of dying after being assaulted in a year in Australia",
-        "risk": 1 / 105_000,
-    },
-    {
-        "event": "Chance of dying from a skydive",
-        "risk": 1 / 100_000,
-    },
-    {
-        "event": "Chance of dying in a car crash in a year in Australia",
-        "risk": 1 / 18_000,
-    },
-    {
-        "event": "Chance of dying by choking on food in Australia some time in your life",
-        "risk": 1 / 5000,
-    },
-    {
-        "event": "Chance of dying from a base jump",
-        "risk": 1 / 2500,
-    },
-    {
-        "event": "Chance of being born with extra fingers and toes in Australia",
-        "risk": 1 / 1000,
-    },
-    {
-        "event": "Chance of getting cancer in the next year in Australia",
-        "risk": 1 / 200,
-    },
-    {
-        "event": "Chance of going to hospital after a fall in a year in Australia",
-        "risk": 1 / 100,
-    },
-    {
-        "event": "Chance of getting a speeding ticket in a year in Australia",
-        "risk": 1 / 12,
-    },
-    {
-        "event": "Chance of getting food poisoning in a year in Australia",
-        "risk": 1 / 6,
-    },
-    {
-        "event": "Chance of getting shingles some time in your life",
-        "risk": 1 / 3,
-    },
-    {
-        "event": "100%",
-        "risk": 1,
-    },
-]
+"""
+Relatable risks shown next to the bars of a graph, for comparison.
 
+The catalogue is read from a JSON list of events, each with either a risk or a
+"one_in" count, into arrays sorted by risk. Lookups are searchsorted over
+those, and take whole batches of graphs at once.
+"""
+import json
+import logging
+from pathlib import Path
 
-def generate_relatable_risks_orig(risk_vals):
+import numpy as np
+
+import config
+
+logging.basicConfig(format="%(asctime)s: %(name)s: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class RiskCatalogue:
     """
-    Generate risks given a list of risks
+    Relatable risks in increasing order. The first and last entries are the
+    0% and 100% ends of the scale, which the three point mode never returns.
     """
-    risks_min = min(risk_vals)
-    risks_max = max(risk_vals)
 
-    # we choose three values:
-    # one less than risks_min
-    # one larger than risks_max
-    # one in between, or if nothing in between, then one more larger
+    def __init__(self, entries):
+        entries = [
+            {"event": entry["event"], "risk": entry["risk"] if "risk" in entry else 1 / entry["one_in"]} for entry in entries
+        ]
+        self.entries = sorted(entries, key=lambda entry: entry["risk"])
+        self.risks = np.array([entry["risk"] for entry in self.entries], dtype=float)
 
-    ix_less = 0
-    ix_more = 0
+    @classmethod
+    def load(cls, path):
+        with Path(path).open(encoding="utf8") as f:
+            catalogue = cls(json.load(f))
+        logger.info(f"Read {len(catalogue.entries)} relatable risks from {path}")
+        return catalogue
 
-    for i, rel_risk in enumerate(risks):
-        if rel_risk["risk"] < risks_min:
-            ix_less = i
-        if rel_risk["risk"] > risks_max:
-            ix_more = i
-            break
+    def above(self, risks_max):
+        """
+        Index of the first risk above each of risks_max, or of the last one if
+        none is
 
-    # if we didn't find a bigger risk
-    if ix_more == 0:
-        ix_more = len(risks) - 1
+        Params:
+            risks_max - array of the largest risk of each graph
+        """
+        return np.minimum(np.searchsorted(self.risks, risks_max, side="right"), len(self.risks) - 1)
 
-    if ix_more - ix_less > 1:
-        ix_third = ix_more - (ix_more - ix_less) // 2
-    else:
-        ix_third = ix_more + 1
-        if ix_third >= len(risks):
-            ix_third = ix_less - 1
+    def three_point(self, risks_min, risks_max):
+        """
+        Indices of three risks per graph: one below its smallest risk, one
+        above its largest, and one in between (or one more above if nothing
+        is in between). Returns a (graphs, 3) array, sorted along each row,
+        with -1 where an index is left out.
 
-    return [risks[i] for i in sorted([ix_less, ix_more, ix_third]) if i not in [0, len(risks) - 1]]
+        Params:
+            risks_min, risks_max - arrays of the smallest and largest risk of each graph
+        """
+        last = len(self.risks) - 1
+        ix_less = np.maximum(np.searchsorted(self.risks, risks_min, side="left") - 1, 0)
+        # nothing is below nan
+        ix_less = np.where(np.isnan(risks_min), 0, ix_less)
+        ix_more = self.above(risks_max)
+        ix_third = np.where(ix_more - ix_less > 1, ix_more - (ix_more - ix_less) // 2, ix_more + 1)
+        ix_third = np.where(ix_third > last, ix_less - 1, ix_third)
+        indices = np.sort(np.stack([ix_less, ix_more, ix_third], axis=-1), axis=-1)
+        return np.where((indices == 0) | (indices == last), -1, indices)
 
+    def relatable(self, risk_vals, mode="above"):
+        """
+        Relatable risks for the values of one graph, as catalogue entries
+
+        Params:
+            risk_vals - risks in the graph
+            mode - "above" for the next risk above the largest value, or
+                "three_point" for three around and between them
+        """
+        # min and max rather than numpy's, which keep nan wherever it is
+        if mode == "above":
+            return [self.entries[self.above(max(risk_vals))]]
+        if mode == "three_point":
+            return [self.entries[i] for i in self.three_point(min(risk_vals), max(risk_vals)) if i >= 0]
+        raise ValueError(f"Unknown relatable risk mode {mode}")
 
-def generate_relatable_risks(risk_vals):
-    risks_max = max(risk_vals)
 
-    ix_more = len(risks) - 1
+catalogue = RiskCatalogue.load(Path(__file__).parent / config.RISKS_FILE)
+risks = catalogue.entries
 
-    for i, rel_risk in enumerate(risks):
-        if rel_risk["risk"] > risks_max:
-            ix_more = i
-            break
 
-    return [risks[ix_more]]
+def generate_relatable_risks_orig(risk_vals):
+    """
+    Generate risks given a list of risks
+    """
+    return catalogue.relatable(risk_vals, mode="three_point")
+
+
+def generate_relatable_risks(risk_vals):
+    return catalogue.relatable(risk_vals)
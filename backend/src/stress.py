@@ -0,0 +1,239 @@
+"""
+Concurrency check for the request handlers.
+
+Sends a mix of requests for every RPC to an in-process server, first one at a
+time and then from many client threads at once, and checks every concurrent
+response is byte-identical to the single-threaded one, and that every risk,
+interval bound and sensitivity in them is finite, except for the sweep
+outcomes given infection without transmission, which are nan, and that every
+interval holds its risk. The response cache is
+switched off so each request runs inference. Set CORICAL_ENGINE to choose the
+engine under test.
+
+    python src/stress.py [--threads 64] [--rounds 20]
+"""
+import argparse
+import logging
+import math
+import random
+import sys
+from concurrent import futures
+from itertools import product
+
+import grpc
+
+import app
+import config
+from proto import corical_pb2
+from tables import combined_infected_outcomes
+
+logging.basicConfig(format="%(asctime)s: %(name)s: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def stress_requests():
+    """
+    (method, request) pairs covering every RPC. ComputeTTSReq.compute_count is
+    left out since its timing message differs between runs.
+    """
+    reqs = []
+    for age, sex, vaccine, transmission in product(
+        [16, 35, 90], ["female", "male", "other"], ["None", "OneAZ_under_3_weeks", "TwoAZ_4to6_months"], ["None", "ATAGI_Low", "Ten_percent"]
+    ):
+        reqs.append(("ComputeTTS", corical_pb2.ComputeTTSReq(age=age, sex=sex, vaccine=vaccine, transmission=transmission)))
+    for age, sex, dose, ct in product([16, 35, 90], ["female", "male", "other"], ["None", "Two_2_4mths", "Three"], ["None_0", "ATAGI_High"]):
+        reqs.append(("ComputePfizer", corical_pb2.ComputePfizerReq(age=age, sex=sex, dose=dose, ct=ct)))
+    for (dose_number, dose_2, dose_3, dose_time), age, sex, ct in product(
+        [("Two", "Pf", "", "under_2_months"), ("Three", "AZ", "Pf", "6_months"), ("Four_doses_any", "", "", "")],
+        [19, 44, 90],
+        ["female", "male", "other"],
+        ["Two_percent", "ATAGI_Low"],
+    ):
+        reqs.append(
+            (
+                "ComputeCombined",
+                corical_pb2.ComputeCombinedReq(
+                    dose_number=dose_number, dose_2=dose_2, dose_3=dose_3, dose_time=dose_time, age=age, sex=sex, ct=ct
+                ),
+            )
+        )
+    for age, sex, ct in product([6, 15], ["female", "male", "other"], ["One_Percent", "Ten_Percent"]):
+        reqs.append(("ComputePfizerChildren", corical_pb2.ComputePfizerReq(age=age, sex=sex, ct=ct)))
+    # credible intervals, which must hold their risks
+    for sex in ["female", "male", "other"]:
+        reqs.append(
+            (
+                "ComputeCombined",
+                corical_pb2.ComputeCombinedReq(
+                    dose_number="Three", dose_2="AZ", dose_3="Pf", dose_time="6_months", age=19, sex=sex, ct="Ten_percent",
+                    credible_intervals=True,
+                ),
+            )
+        )
+        reqs.append(("ComputePfizerChildren", corical_pb2.ComputePfizerReq(age=15, sex=sex, ct="One_Percent", credible_intervals=True)))
+    reqs.append(("SweepCombined", corical_pb2.SweepCombinedReq(sex=["female"], age_min=30, age_max=59, ct=["ATAGI_Low"])))
+    # the ends of the age range, and impossible infection
+    reqs.append(("SweepCombined", corical_pb2.SweepCombinedReq(sex=["male"], age_min=12, age_max=12, ct=["None", "Ten_percent"])))
+    reqs.append(("SweepCombined", corical_pb2.SweepCombinedReq(sex=["other"], age_min=120, age_max=120, dose=["None"])))
+    evidence = {"n1_Dose": "ThreePf_6_months", "n2_Age": "age_50_59", "n4_Transmission": "ATAGI_Low"}
+    reqs.append(("Sensitivity", corical_pb2.SensitivityReq(model="combined", evidence=evidence, top_k=5)))
+    reqs.append(("Sensitivity", corical_pb2.SensitivityReq(model="pfizer_children", outcomes=["MSIC_given_infected"])))
+    # compact responses and the catalogue they refer to
+    reqs.append(("ComputeTTS", corical_pb2.ComputeTTSReq(age=35, sex="other", vaccine="None", transmission="None", compact=True)))
+    reqs.append(("ComputePfizer", corical_pb2.ComputePfizerReq(age=35, sex="female", dose="Three", ct="None_0", compact=True)))
+    reqs.append(
+        (
+            "ComputeCombined",
+            corical_pb2.ComputeCombinedReq(
+                dose_number="Two", dose_2="Pf", dose_time="under_2_months", age=44, sex="male", ct="Two_percent", compact=True
+            ),
+        )
+    )
+    reqs.append(
+        ("ComputePfizerChildren", corical_pb2.ComputePfizerReq(age=6, sex="other", ct="Ten_Percent", credible_intervals=True, compact=True))
+    )
+    reqs.append(("StringCatalogue", corical_pb2.StringCatalogueReq(version=app.string_catalogue.version)))
+    # invalid requests must fail the same way too
+    reqs.append(("ComputeTTS", corical_pb2.ComputeTTSReq(age=30, sex="female", vaccine="bad", transmission="None")))
+    reqs.append(("ComputeCombined", corical_pb2.ComputeCombinedReq(sex="bad", age=30, ct="Two_percent", dose_number="Four_doses_any")))
+    reqs.append(("Sensitivity", corical_pb2.SensitivityReq(model="combined", evidence={"n1_Dose": "bad"})))
+    reqs.append(("StringCatalogue", corical_pb2.StringCatalogueReq(version="bad")))
+    for age_min, age_max in [(11, 20), (12, 121), (50, 40)]:
+        reqs.append(("SweepCombined", corical_pb2.SweepCombinedReq(sex=["female"], age_min=age_min, age_max=age_max)))
+    return reqs
+
+
+def risk_values(method, res):
+    """
+    Every risk, interval bound and sensitivity in a raw response. Compact
+    interval bounds are left out, they are nan for bars without an interval.
+    """
+    output = corical_pb2.DESCRIPTOR.services_by_name["Corical"].methods_by_name[method].output_type.name
+    # a stream joined together parses as one message with all the rows
+    res = getattr(corical_pb2, output).FromString(res)
+    if output == "ComputeRes":
+        for graph in res.bar_graphs:
+            for risk in graph.risks:
+                yield risk.risk
+                if risk.HasField("interval"):
+                    yield risk.interval.lower
+                    yield risk.interval.upper
+        for graph in res.compact.bar_graphs:
+            yield from graph.risks
+    elif output == "SweepCombinedRes":
+        for row in res.rows:
+            for name, value in zip(res.header.outcomes, row.values):
+                if not impossible(res.header, row, name):
+                    yield value
+    elif output == "SensitivityRes":
+        for parameter in res.parameters:
+            yield parameter.probability
+            yield parameter.value
+            yield parameter.derivative
+
+
+def outside_intervals(method, res):
+    """
+    (risk, lower, upper) for every risk of a raw response outside its interval
+    """
+    output = corical_pb2.DESCRIPTOR.services_by_name["Corical"].methods_by_name[method].output_type.name
+    if output != "ComputeRes":
+        return
+    res = corical_pb2.ComputeRes.FromString(res)
+    for graph in res.bar_graphs:
+        for risk in graph.risks:
+            if risk.HasField("interval") and not risk.interval.lower <= risk.risk <= risk.interval.upper:
+                yield risk.risk, risk.interval.lower, risk.interval.upper
+    for graph in res.compact.bar_graphs:
+        for risk, lower, upper in zip(graph.risks, graph.lower, graph.upper):
+            if not math.isnan(lower) and not lower <= risk <= upper:
+                yield risk, lower, upper
+
+
+def impossible(header, row, name):
+    """
+    Whether a sweep value is given infection where there is no transmission
+    """
+    return header.ct[row.ct] == "None" and name in combined_infected_outcomes
+
+
+def impossible_values(method, res):
+    """
+    Sweep values that must be nan, see impossible
+    """
+    if method == "SweepCombined":
+        res = corical_pb2.SweepCombinedRes.FromString(res)
+        for row in res.rows:
+            for name, value in zip(res.header.outcomes, row.values):
+                if impossible(res.header, row, name):
+                    yield value
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", type=int, default=2 * config.THREADS, help="concurrent client threads")
+    parser.add_argument("--rounds", type=int, default=20, help="times each request is sent concurrently")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    app.response_cache.max_entries = 0
+    app.registry.preload()
+
+    server = grpc.server(futures.ThreadPoolExecutor(config.THREADS))
+    port = server.add_insecure_port("localhost:0")
+    app.add_servicer(app.Corical(), server)
+    server.start()
+    channel = grpc.insecure_channel(f"localhost:{port}")
+    methods = {
+        method.name: (channel.unary_stream if method.server_streaming else channel.unary_unary)(
+            f"/corical.Corical/{method.name}",
+            request_serializer=lambda request: request.SerializeToString(),
+        )
+        for method in corical_pb2.DESCRIPTOR.services_by_name["Corical"].methods
+    }
+
+    def call(method, request):
+        """
+        Raw response bytes (joined for streams), or the error
+        """
+        try:
+            res = methods[method](request)
+            return res if isinstance(res, bytes) else b"".join(res)
+        except grpc.RpcError as e:
+            return e.code(), e.details()
+
+    reqs = stress_requests()
+    expected = [call(method, request) for method, request in reqs]
+    failed = 0
+    for (method, request), res in zip(reqs, expected):
+        if not isinstance(res, bytes):
+            continue
+        if not all(math.isfinite(value) for value in risk_values(method, res)):
+            failed += 1
+            logger.error(f"{method} response has non-finite risks for {request}")
+        if not all(math.isnan(value) for value in impossible_values(method, res)):
+            failed += 1
+            logger.error(f"{method} response has risks for an impossible scenario for {request}")
+        outside = list(outside_intervals(method, res))
+        if outside:
+            failed += 1
+            logger.error(f"{method} response has risks outside their intervals {outside} for {request}")
+
+    jobs = list(range(len(reqs))) * args.rounds
+    random.Random(args.seed).shuffle(jobs)
+    logger.info(f"Sending {len(jobs)} requests from {args.threads} threads")
+    with futures.ThreadPoolExecutor(args.threads) as pool:
+        results = list(pool.map(lambda i: call(*reqs[i]), jobs))
+
+    mismatches = 0
+    for i, result in zip(jobs, results):
+        if result != expected[i]:
+            mismatches += 1
+            logger.error(f"{reqs[i][0]} response differs from the single-threaded one for {reqs[i][1]}")
+    logger.info(f"{len(jobs) - mismatches} of {len(jobs)} responses identical, {failed} of {len(reqs)} failing the checks")
+    server.stop(None)
+    sys.exit(1 if mismatches or failed else 0)
+
+
+if __name__ == "__main__":
+    main()
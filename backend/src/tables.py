@@ -0,0 +1,150 @@
+"""
+Precomputed answers for the combined network.
+
+Every ComputeCombined scenario is a (sex, age bracket, transmission, dose)
+cell, so all of them can be evaluated offline and served with an array lookup.
+Run this module to (re)build the table next to the model file:
+
+    python src/tables.py
+"""
+import json
+import logging
+import sys
+from itertools import product
+from pathlib import Path
+
+import numpy as np
+
+import xdsl
+from model import compute_outcomes, file_sha256
+from tts_util import sex_vecs
+
+logging.basicConfig(format="%(asctime)s: %(name)s: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+combined_baseline_outcomes = {
+    "get_covid": "n14_Infection_at_current_transmission",
+    "get_myocarditis_bg": "n10_BackMyo",
+    "die_myocarditis_bg": "n22_Die_from_myocarditis__background",
+    "get_myocarditis_vax": "n7_VacMyo",
+    "die_myocarditis_vax": "n19_Die_from_vaccine_associatedmyocarditis",
+}
+
+combined_infected_outcomes = {
+    "die_from_covid_given_infected": "n23_Die_from_Covid",
+    "get_myocarditis_given_covid": "n17_COV_Myo",
+    "die_myocarditis_given_covid": "n26_Die_from_COV_Myo",
+}
+
+
+def combined_evidence(sex_vec, age_label, ct, dose):
+    return {
+        "n5_Sex": sex_vec,
+        "n1_Dose": dose,
+        "n2_Age": age_label,
+        "n4_Transmission": ct,
+    }
+
+
+def compute_combined_outcomes(network, scenarios):
+    """
+    Baseline and infected outcomes of the combined network for several
+    scenarios (evidence dictionaries), see model.compute_outcomes
+    """
+    return compute_outcomes(
+        network,
+        scenarios,
+        combined_baseline_outcomes,
+        combined_infected_outcomes,
+        "n14_Infection_at_current_transmission",
+    )
+
+
+class CombinedTable:
+    """
+    Memory-mapped (sex, age, transmission, dose, outcome) array for one model file
+    """
+
+    def __init__(self, model_file):
+        self.model_path = Path(__file__).parent / model_file
+        self.table_path = self.model_path.with_suffix(".table.npy")
+        self.meta_path = self.model_path.with_suffix(".table.json")
+        self.values = None
+
+    def load(self):
+        """
+        Map the table if it exists and was built from the current model file.
+        Returns whether lookups will be served from it.
+        """
+        self.values = None
+        if not self.table_path.exists() or not self.meta_path.exists():
+            logger.warning(f"No precomputed table for {self.model_path.name}, using live inference")
+            return False
+        with self.meta_path.open() as f:
+            meta = json.load(f)
+        if meta["model_sha256"] != file_sha256(self.model_path):
+            logger.warning(f"Precomputed table for {self.model_path.name} is stale, using live inference")
+            return False
+
+        self.outcomes = meta["outcomes"]
+        self.axes = [{label: ix for ix, label in enumerate(meta[axis])} for axis in ("sex", "age", "ct", "dose")]
+        self.values = np.load(self.table_path, mmap_mode="r")
+        logger.info(f"Serving {self.model_path.name} from {self.table_path.name}")
+        return True
+
+    def lookup(self, sex, age_label, ct, dose):
+        """
+        Outcomes for one scenario, or None if it has to be computed live
+        """
+        if self.values is None:
+            return None
+        try:
+            ix = tuple(axis[key] for axis, key in zip(self.axes, (sex, age_label, ct, dose)))
+        except KeyError:
+            return None
+        row = self.values[ix]
+        if np.isnan(row).any():
+            return None
+        return dict(zip(self.outcomes, row.tolist()))
+
+    def build(self, network):
+        """
+        Evaluate every scenario on the given network (SmileModel or
+        xdsl.Model) and write the table
+        """
+        nodes = xdsl.Model(str(self.model_path)).nodes
+        meta = {
+            "model_sha256": file_sha256(self.model_path),
+            "sex": list(sex_vecs),
+            "age": nodes["n2_Age"]["states"],
+            "ct": nodes["n4_Transmission"]["states"],
+            "dose": nodes["n1_Dose"]["states"],
+            "outcomes": list(combined_baseline_outcomes) + list(combined_infected_outcomes),
+        }
+        axes = [meta[axis] for axis in ("sex", "age", "ct", "dose")]
+        values = np.zeros([len(axis) for axis in axes] + [len(meta["outcomes"])])
+
+        # one batched call per (sex, age, transmission) covers every dose,
+        # cells with impossible evidence stay nan and are left to live inference
+        for ix in product(*[range(len(axis)) for axis in axes[:3]]):
+            sex, age_label, ct = (axis[i] for axis, i in zip(axes, ix))
+            scenarios = [combined_evidence(np.array(sex_vecs[sex]), age_label, ct, dose) for dose in meta["dose"]]
+            for dose_ix, outcomes in enumerate(compute_combined_outcomes(network, scenarios)):
+                values[ix + (dose_ix,)] = [outcomes[name] for name in meta["outcomes"]]
+
+        np.save(self.table_path, values)
+        with self.meta_path.open("w") as f:
+            json.dump(meta, f, indent=2)
+        logger.info(f"Wrote {values.shape} table to {self.table_path.name}")
+
+
+if __name__ == "__main__":
+    import config
+    from model import ModelRegistry
+
+    # build with the engine the server will use for live inference
+    model_file = sys.argv[1] if len(sys.argv) > 1 else "combined_22-09-22.xdsl"
+    registry = ModelRegistry(config.ENGINE)
+    registry.register("combined", model_file)
+    with registry.acquire("combined") as network:
+        CombinedTable(model_file).build(network)
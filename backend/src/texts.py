@@ -0,0 +1,85 @@
+"""
+Text of the responses, as templates with {slots} for the labels of a scenario
+(age bracket, sex, transmission level, dose, shot ordinal).
+
+Compact responses refer to these by their index in catalogue(), which only
+depends on this file, the printable links and the relatable risk file, so
+every worker of a deployment builds the same catalogue with the same version.
+"""
+from risks import catalogue as risk_catalogue
+from tts_util import get_link
+
+# stands for a string that isn't in the catalogue, sent as its one argument
+VERBATIM = "{text}"
+
+SEX_DISCLAIMER_HEADING = "Sex disclaimer"
+SEX_DISCLAIMER = "We do not have data on the chosen sex, so the results reflect a population with 50% females and 50% males"
+NO_TRANSMISSION_HEADING = "Note"
+NO_TRANSMISSION = "You have selected a scenario with no community transmission. This is only a temporary situation and will change when state or national borders open."
+PRINTABLE = "Printable version"
+
+# ComputeTTS, ComputePfizer and ComputeCombined
+SCENARIO = "Here are your results. These are for a {age} {sex} when there are {transmission} in your community. They are based on the number and timing of shots of {vaccine} vaccine you have had."
+COMBINED_SCENARIO = "Here are your results. These are for a {age} {sex} when there are {transmission} in your community. They are based on the number and timing of shots of {vaccine} vaccines you have had."
+SUBTITLE = "These results are for a {age} {sex}."
+COVID_TITLE = "What is my chance of getting COVID-19?"
+COVID_SUBTITLE = "This is your chance of getting COVID-19 over a 2-month period. These results are for a {age} {sex} when there are {transmission} in your community."
+COVID_LABEL = "Chance of getting COVID-19 if you have {dose}"
+DEATH_TITLE = "If I get COVID-19, what are my chances of dying?"
+DEATH_LABEL = "Chance of dying from COVID-19 if you have {dose}"
+
+# ComputeTTS
+CLOTS_TITLE = "What is my chance of getting unusual blood clots?"
+CLOTS_SUBTITLE = "The AstraZeneca vaccine can cause unusual blood clots with low platelets (TTS). COVID-19 (infection) can also cause unusual blood clots. These results are for a {age} {sex}."
+CLOTS_VAX_LABEL = "Chance of getting blood clots with low platelets (TTS) after the {ordinal} shot of AstraZeneca"
+CLOTS_COVID_LABEL = "Chance of getting unusual blood clots from COVID-19 (infection)"
+CLOTS_DEATH_TITLE = "What is my chance of dying from unusual blood clots?"
+CLOTS_DEATH_VAX_LABEL = "Chance of dying from blood clots with low platelets (TTS) after the {ordinal} shot of AstraZeneca"
+CLOTS_DEATH_BG_LABEL = "Chance of dying from unusual blood clots in 2 months even if you haven't had a vaccine or COVID-19 (background rate)"
+CLOTS_DEATH_COVID_LABEL = "Chance of dying from unusual blood clots after COVID-19 (infection)"
+
+# ComputePfizer and ComputeCombined
+MYO_TITLE = "What is my chance of having inflammation of my heart muscle (myocarditis)?"
+MYO_SUBTITLE = "You may have heard that the Pfizer vaccine can give you inflammation of your heart muscle. This is also called myocarditis. There are many other causes of myocarditis, so people can develop this problem even if they haven’t had the vaccine. Myocarditis is also very common in people who have had COVID-19 (infection).   These results are for a {age} {sex}."
+MYO_BG_LABEL = "Chance of having myocarditis over 2 months even if you haven't had a vaccine or COVID-19 infection (background rate)"
+MYO_COVID_LABEL = "Chance of having myocarditis from a COVID-19 infection"
+MYO_VAX_LABEL = "Your chance of myocarditis after the {ordinal} shot of Pfizer vaccine will increase by:"
+MYO_DEATH_TITLE = "What is my chance of dying from inflammation of my heart muscle (myocarditis)?"
+MYO_DEATH_BG_LABEL = "Chance of dying from myocarditis in 2 months even if you haven’t had any vaccine and haven’t had COVID-19 (infection)"
+MYO_DEATH_COVID_LABEL = "Chance of dying from myocarditis after COVID-19 (infection) "
+MYO_DEATH_VAX_LABEL = "Your chance of dying from myocarditis after the {ordinal} shot of Pfizer vaccine will increase by:"
+
+# ComputePfizerChildren
+CHILDREN_SCENARIO = "Here are your results. These are for a {age} {sex} when there is {transmission} in your community. They are based on the number and timing of shots of vaccines the child has had."
+CHILDREN_COVID_TITLE = "What is my child's chance of getting COVID-19?"
+CHILDREN_COVID_SUBTITLE = "The COVID-19 vaccines aim to stop children from getting very sick from COVID-19. The vaccines can also protect children from getting COVID-19."
+CHILDREN_COVID_VAX_LABEL = "Chance of getting COVID-19 if the child has had two shots of the vaccine "
+CHILDREN_COVID_NO_VAX_LABEL = "Chance of getting COVID-19 if the child has had 0 shot of the vaccine"
+CHILDREN_MYO_TITLE = "What is my child's chance of having inflammation of their heart muscle (myocarditis)?"
+CHILDREN_MYO_SUBTITLE = "The Pfizer vaccine can cause inflammation of the heart muscle. This is called myocarditis. Children can get myocarditis from other causes even if they haven't had the vaccine. COVID-19 infection can also cause myocarditis in some children. "
+CHILDREN_MYO_VAX_LABEL = "Chance of getting myocarditis after the child has 2 shots of the vaccine "
+CHILDREN_MYO_BG_LABEL = "Chance of getting myocarditis over 2 weeks if the child has had 0 shots of the vaccine and no COVID-19"
+CHILDREN_MYO_COVID_LABEL = "Chance of getting myocarditis after the child gets COVID-19"
+CHILDREN_HOSPITAL_TITLE = "What is the chance of my child going to hospital due to COVID-19?"
+CHILDREN_HOSPITAL_SUBTITLE = "Whilst most children do not get very sick from COVID-19, some do need to go to hospital. Many of these children have other health problems."
+CHILDREN_HOSPITAL_VAX_LABEL = "Chance of going to hospital if the child has 2 shots of the vaccine and gets COVID-19 "
+CHILDREN_HOSPITAL_NO_VAX_LABEL = "Chance of going to hospital if the child has 0 shots of the vaccine and gets COVID-19"
+CHILDREN_MIS_TITLE = "What is the chance of my child having Multisystem Inflammatory Syndrome due to COVID-19?"
+CHILDREN_MIS_SUBTITLE = "COVID-19 can cause serious health problems in some children. A small number of children can get inflammation of their organs, such as the heart, brain, kidneys, blood vessels, skin, digestive system or eyes. This is called Multisystem Inflammatory Syndrome in Children."
+CHILDREN_MIS_VAX_LABEL = "Chance of Multisystem Inflammatory Syndrome if the child has 2 shots of the vaccine and gets COVID-19"
+CHILDREN_MIS_NO_VAX_LABEL = "Chance of Multisystem Inflammatory Syndrome if the child has 0 shots of the vaccine and gets COVID-19"
+CHILDREN_HOSPITAL_UNKNOWN_LABEL = "Chance of going to the hospital from COVID-19 if infected"
+CHILDREN_MIS_UNKNOWN_LABEL = "Chance of Multisystem Inflammatory Syndrome in Children from COVID-19 if infected"
+NOT_ENOUGH_EVIDENCE = "Not enough evidence available."
+NOT_ENOUGH_EVIDENCE_HOVER = "There is not enough evidence to provide information on this."
+
+
+def catalogue():
+    """
+    Every template above, then the printable links and the relatable risks,
+    each once and in a fixed order, starting with VERBATIM
+    """
+    templates = [value for name, value in globals().items() if name.isupper() and isinstance(value, str)]
+    links = [get_link(sex, age_ix) for sex in ("female", "male") for age_ix in range(8)]
+    events = [entry["event"] for entry in risk_catalogue.entries]
+    return list(dict.fromkeys(templates + [link for link in links if link] + events))
@@ -1,12 +1,34 @@
+import threading
+
+import numpy as np
+
+import metrics
 import xdsl
 
-tts = xdsl.Model("AZ_March_GeNie_01-03-22.xdsl")
+model_file = "AZ_March_GeNie_01-03-22.xdsl"
+_model = None
+_lock = threading.Lock()
+
+
+def model():
+    """
+    Shared xdsl.Model of the AZ network, read on first use
+    """
+    global _model
+    if _model is None:
+        with _lock:
+            if _model is None:
+                _model = xdsl.Model(model_file)
+    return _model
+
 
 def scenario_to_vec(scenario_name):
+    tts = model()
     return tts.unit_vec_for_state("n4_Transmission", scenario_name)
 
 
 def compute_probs(az_dose, age_label, sex_vec, ct_vec, variant_vec=None):
+    tts = model()
     values = {
         "n5_Sex": sex_vec,
         "n4_Transmission": ct_vec,
@@ -15,22 +37,33 @@ def compute_probs(az_dose, age_label, sex_vec, ct_vec, variant_vec=None):
     tts.set_fact(values, "n2_Age", age_label)
     tts.set_fact(values, "n1_Dose", az_dose)
 
-    values_infected = dict(values)
 
-    get_tts = tts.infer(values, "n6_TTS")[0]
-    die_from_tts = tts.infer(values, "n18_Die_from_TTS_AZ")[0]
-    die_from_csvt = tts.infer(values, "n20_Die_from_CSVT")[0]
-    die_from_pvt = tts.infer(values, "n21_Die_from_PVT")[0]
-    symptomatic_infection = tts.infer(values, "n14_Infection_at_current_transmission")[0]
-    n23_Die_from_Covid = tts.infer(values, "n23_Die_from_Covid")[0]
+    # the scenario replaces the priors of the roots (sex "other" is a 50/50
+    # population), see xdsl.Model.split_roots
+    values, roots = tts.split_roots(values)
+
+    # one pass over the network gives every node
+    baseline = tts.posteriors(values, interventions=roots)
+    get_tts = baseline["n6_TTS"][0]
+    die_from_tts = baseline["n18_Die_from_TTS_AZ"][0]
+    die_from_csvt = baseline["n20_Die_from_CSVT"][0]
+    die_from_pvt = baseline["n21_Die_from_PVT"][0]
+    symptomatic_infection = baseline["n14_Infection_at_current_transmission"][0]
+    n23_Die_from_Covid = baseline["n23_Die_from_Covid"][0]
 
-    # copy values and set infection to Yes
-    tts.set_fact(values_infected, "n14_Infection_at_current_transmission", "Yes")
-    n23_Die_from_Covid_given_infected = tts.infer(values_infected, "n23_Die_from_Covid")[0]
-    get_csvt_covid_given_infected = tts.infer(values_infected, "n15_CSVT_Covid")[0]
-    get_pvt_covid_given_infected = tts.infer(values_infected, "n16_PVT_Covid")[0]
-    die_from_csvt_covid_given_infected = tts.infer(values_infected, "n24_Die_from_CSVT_Covid")[0]
-    die_from_pvt_covid_given_infected = tts.infer(values_infected, "n25_Die_from_PVT_Covid")[0]
+    # set infection to Yes rather than observe it, so it is given even where
+    # it is impossible, e.g. with no transmission
+    infected = tts.posteriors(
+        values,
+        interventions=dict(
+            roots, n14_Infection_at_current_transmission=tts.unit_vec_for_state("n14_Infection_at_current_transmission", "Yes")
+        ),
+    )
+    n23_Die_from_Covid_given_infected = infected["n23_Die_from_Covid"][0]
+    get_csvt_covid_given_infected = infected["n15_CSVT_Covid"][0]
+    get_pvt_covid_given_infected = infected["n16_PVT_Covid"][0]
+    die_from_csvt_covid_given_infected = infected["n24_Die_from_CSVT_Covid"][0]
+    die_from_pvt_covid_given_infected = infected["n25_Die_from_PVT_Covid"][0]
 
     # after discussion on sep 12, assume csvt & pvt are indep and combine into one
     die_from_clots = die_from_csvt + die_from_pvt - die_from_csvt * die_from_pvt
@@ -45,12 +78,12 @@ def compute_probs(az_dose, age_label, sex_vec, ct_vec, variant_vec=None):
         - get_csvt_covid_given_infected * get_pvt_covid_given_infected
     )
 
-    get_myocarditis_vax = tts.infer(values, "n7_VacMyo")[0]
-    die_myocarditis_vax = tts.infer(values, "n19_Die_from_vaccine_associatedmyocarditis")[0]
-    get_myocarditis_given_covid = tts.infer(values_infected, "n17_COV_Myo")[0]
-    die_myocarditis_given_covid = tts.infer(values_infected, "n26_Die_from_COV_Myo")[0]
-    get_myocarditis_bg = tts.infer(values, "n10_BackMyo")[0]
-    die_myocarditis_bg = tts.infer(values, "n22_Die_from_myocarditis__background")[0]
+    get_myocarditis_vax = baseline["n7_VacMyo"][0]
+    die_myocarditis_vax = baseline["n19_Die_from_vaccine_associatedmyocarditis"][0]
+    get_myocarditis_given_covid = infected["n17_COV_Myo"][0]
+    die_myocarditis_given_covid = infected["n26_Die_from_COV_Myo"][0]
+    get_myocarditis_bg = baseline["n10_BackMyo"][0]
+    die_myocarditis_bg = baseline["n22_Die_from_myocarditis__background"][0]
 
     return (
         symptomatic_infection,
@@ -68,3 +101,106 @@ def compute_probs(az_dose, age_label, sex_vec, ct_vec, variant_vec=None):
         get_myocarditis_bg,
         die_myocarditis_bg,
     )
+
+
+baseline_nodes = [
+    "n14_Infection_at_current_transmission",
+    "n6_TTS",
+    "n18_Die_from_TTS_AZ",
+    "n20_Die_from_CSVT",
+    "n21_Die_from_PVT",
+    "n23_Die_from_Covid",
+    "n7_VacMyo",
+    "n19_Die_from_vaccine_associatedmyocarditis",
+    "n10_BackMyo",
+    "n22_Die_from_myocarditis__background",
+]
+
+infected_nodes = [
+    "n23_Die_from_Covid",
+    "n15_CSVT_Covid",
+    "n16_PVT_Covid",
+    "n24_Die_from_CSVT_Covid",
+    "n25_Die_from_PVT_Covid",
+    "n17_COV_Myo",
+    "n26_Die_from_COV_Myo",
+]
+
+# names of the compute_probs values, in order
+outcome_names = [
+    "get_covid",
+    "get_tts",
+    "die_from_covid_given_infected",
+    "die_from_tts",
+    "die_from_clots",
+    "die_from_covid",
+    "get_clots_covid_given_infected",
+    "die_from_clots_covid_given_infected",
+    "get_myocarditis_vax",
+    "die_myocarditis_vax",
+    "get_myocarditis_given_covid",
+    "die_myocarditis_given_covid",
+    "get_myocarditis_bg",
+    "die_myocarditis_bg",
+]
+
+
+def compute_probs_batch(scenarios):
+    """
+    compute_probs for many scenarios, batched over the network.
+    The shared model is only read, so this is safe to call from any thread.
+
+    Params:
+        scenarios - list of (az_dose, age_label, sex_vec, ct) where ct is a
+            transmission state or vector
+    Returns a list with one compute_probs tuple per scenario
+    """
+    tts = model()
+    rows = [
+        {"n1_Dose": az_dose, "n2_Age": age_label, "n5_Sex": sex_vec, "n4_Transmission": ct}
+        for az_dose, age_label, sex_vec, ct in scenarios
+    ]
+    # the infected pass only recomputes what setting infection changes
+    context = tts.context(
+        rows, set(baseline_nodes + infected_nodes), varying=["n14_Infection_at_current_transmission"], replace_priors=True
+    )
+    metrics.lap("evidence")
+    baseline = context.marginals(baseline_nodes)
+    context.intervene("n14_Infection_at_current_transmission", tts.unit_vec_for_state("n14_Infection_at_current_transmission", "Yes"))
+    infected = context.marginals(infected_nodes)
+    metrics.lap("inference")
+
+    n = len(rows)
+    baseline = {node: np.broadcast_to(dist, (n, dist.shape[-1]))[:, 0] for node, dist in baseline.items()}
+    infected = {node: np.broadcast_to(dist, (n, dist.shape[-1]))[:, 0] for node, dist in infected.items()}
+
+    # csvt & pvt combined as independent, as in compute_probs
+    die_from_clots = baseline["n20_Die_from_CSVT"] + baseline["n21_Die_from_PVT"] - baseline["n20_Die_from_CSVT"] * baseline["n21_Die_from_PVT"]
+    die_from_clots_covid_given_infected = (
+        infected["n24_Die_from_CSVT_Covid"]
+        + infected["n25_Die_from_PVT_Covid"]
+        - infected["n24_Die_from_CSVT_Covid"] * infected["n25_Die_from_PVT_Covid"]
+    )
+    get_clots_covid_given_infected = (
+        infected["n15_CSVT_Covid"] + infected["n16_PVT_Covid"] - infected["n15_CSVT_Covid"] * infected["n16_PVT_Covid"]
+    )
+
+    columns = (
+        baseline["n14_Infection_at_current_transmission"],
+        baseline["n6_TTS"],
+        infected["n23_Die_from_Covid"],
+        baseline["n18_Die_from_TTS_AZ"],
+        die_from_clots,
+        baseline["n23_Die_from_Covid"],
+        get_clots_covid_given_infected,
+        die_from_clots_covid_given_infected,
+        baseline["n7_VacMyo"],
+        baseline["n19_Die_from_vaccine_associatedmyocarditis"],
+        infected["n17_COV_Myo"],
+        infected["n26_Die_from_COV_Myo"],
+        baseline["n10_BackMyo"],
+        baseline["n22_Die_from_myocarditis__background"],
+    )
+    probs = [tuple(float(column[i]) for column in columns) for i in range(n)]
+    metrics.lap("extract")
+    return probs
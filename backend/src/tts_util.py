@@ -1,5 +1,12 @@
 import numpy as np
 
+# request sex -> distribution over the network's sex states (male, female)
+sex_vecs = {
+    "female": [0.0, 1.0],
+    "male": [1.0, 0.0],
+    "other": [0.5, 0.5],
+}
+
 
 def get_link(sex, age_ix):
     if sex == "female" and age_ix == 1:
@@ -69,6 +76,23 @@ def get_age_bracket_pz(age):
     else:
         raise Exception("Invalid age")
 
+def get_age_bracket_pfizer(age):
+    age_brackets = [
+        [12, 19, "Age_12_19", "12–19 year-old"],
+        [20, 29, "Age_20_29", "20–29 year-old"],
+        [30, 39, "Age_30_39", "30–39 year-old"],
+        [40, 49, "Age_40_49", "40–49 year-old"],
+        [50, 59, "Age_50_59", "50–59 year-old"],
+        [60, 69, "Age_60_69", "60–69 year-old"],
+        [70, 79, "Age_70_79", "70–79 year-old"],
+        [80, 120, "Age_80plus", "80+ year-old"],
+    ]
+    for ix, (lower, upper, label, text) in enumerate(age_brackets):
+        if lower <= age <= upper:
+            return text, label, ix
+    else:
+        raise Exception("Invalid age")
+
 def get_age_bracket_children(age):
     age_brackets = [
         [5, 11, "Age_5_11", "5–11 year-old"],
@@ -0,0 +1,61 @@
+"""
+The warm set: distinct responses most often asked for in binlogs.
+
+    python src/warm.py binlogs/ [--hours 24] [--top 50]
+    python src/warm.py binlogs/*.bin.gz --target localhost:21000 [--top 500]
+
+Lists the warm set, most frequent first, or with --target sends its requests
+to a running server, which caches the responses. A server started with
+CORICAL_WARM_BINLOG_DIR warms its own cache like this before reporting ready.
+"""
+import argparse
+import logging
+from datetime import datetime
+from pathlib import Path
+
+import grpc
+
+import app
+from binlog import recent_binlogs
+from proto import corical_pb2_grpc
+
+logging.basicConfig(format="%(asctime)s: %(name)s: %(message)s", level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="binlog files or directories of them")
+    parser.add_argument("--hours", type=float, default=24, help="only count requests from the last this many hours, 0 for all")
+    parser.add_argument("--top", type=int, default=50, help="entries listed or sent, 0 for all")
+    parser.add_argument("--target", help="server to send the requests to, host:port")
+    args = parser.parse_args()
+
+    since = datetime.now().timestamp() - args.hours * 3600 if args.hours else 0
+    paths = []
+    for path in map(Path, args.paths):
+        paths += recent_binlogs(path, since) if path.is_dir() else [path]
+    entries = app.warm_set(paths, since)
+    total = sum(count for count, _, _, _ in entries)
+    logger.info(f"{len(entries)} distinct responses for {total} requests in {len(paths)} files")
+    entries = entries[: args.top or None]
+
+    if not args.target:
+        for count, key, rpc, _ in entries:
+            # leave out the rpc and model version
+            print(f"{count:8} {rpc:22} {' '.join(map(str, key[2:]))}")
+        return
+
+    stub = corical_pb2_grpc.CoricalStub(grpc.insecure_channel(args.target))
+    sent = 0
+    for count, key, rpc, request in entries:
+        try:
+            getattr(stub, rpc)(request)
+            sent += 1
+        except grpc.RpcError as e:
+            logger.warning(f"{rpc} {key} failed: {e.code().name} {e.details()}")
+    logger.info(f"Sent {sent} of {len(entries)} requests to {args.target}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,18 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import sys
+import threading
+from itertools import combinations
 from pathlib import Path
 
 import numpy as np
 from lxml import etree
 
+logger = logging.getLogger(__name__)
+
 
 def load_model_facts(tree):
     output = {}
@@ -47,12 +57,590 @@ def _unit_vec_for_state(states, state):
     return out
 
 
+def _contract(factors, out_vars):
+    """
+    Multiply (vars, array) factors together and sum out every var not in out_vars.
+    Arrays with one more axis than vars are batched along their leading axis.
+    """
+    # einsum only takes small integer axis labels, so number the vars per call
+    ids = {}
+    args = []
+    for vars_, array in factors:
+        axes = [ids.setdefault(var, len(ids)) for var in vars_]
+        args += [array, [Ellipsis] + axes if array.ndim > len(vars_) else axes]
+    return np.einsum(*args, [Ellipsis] + [ids[var] for var in out_vars])
+
+
+def _triangulate(neighbours, card):
+    """
+    Eliminate nodes greedily (min fill-in, then min clique size) from the moral
+    graph and return the maximal cliques of the resulting chordal graph
+    """
+    neighbours = {node: set(adj) for node, adj in neighbours.items()}
+    cliques = []
+    while neighbours:
+
+        def cost(node):
+            adj = neighbours[node]
+            fill = sum(1 for a, b in combinations(adj, 2) if b not in neighbours[a])
+            return fill, np.prod([card[n] for n in adj | {node}])
+
+        node = min(neighbours, key=cost)
+        adj = neighbours.pop(node)
+        for a, b in combinations(adj, 2):
+            neighbours[a].add(b)
+            neighbours[b].add(a)
+        for a in adj:
+            neighbours[a].discard(node)
+        clique = frozenset(adj | {node})
+        if not any(clique <= other for other in cliques):
+            cliques.append(clique)
+    return cliques
+
+
+def _requisite(nodes, targets, observed, likelihood):
+    """
+    Bayes-ball (Shachter 1998) over the network: the nodes whose CPTs the
+    posteriors of targets depend on. Everything else is barren or d-separated
+    from the targets by the evidence.
+
+    Params:
+        nodes - network nodes, as from load_model_facts
+        targets - nodes to be inferred
+        observed - nodes with hard evidence (a single state in every row)
+        likelihood - nodes with soft evidence, which acts like an observed
+            child of the node
+    """
+    children = {name: [] for name in nodes}
+    for name, node in nodes.items():
+        for parent in node["parents"]:
+            children[parent].append(name)
+
+    top = set()
+    bottom = set()
+    # (node, whether the ball comes from a child)
+    schedule = [(name, True) for name in targets]
+    while schedule:
+        name, from_child = schedule.pop()
+        if from_child and name in observed:
+            continue
+        if name in observed or from_child:
+            # pass the ball up to the parents
+            if name not in top:
+                top.add(name)
+                schedule += [(parent, True) for parent in nodes[name]["parents"]]
+        if name not in observed and name not in bottom:
+            # pass the ball down to the children, and bounce it off the
+            # observed virtual child of soft evidence
+            bottom.add(name)
+            schedule += [(child, False) for child in children[name]]
+            if name in likelihood:
+                schedule.append((name, True))
+    return top
+
+
+class JunctionTree:
+    """
+    Junction tree of a network for exact inference with Shafer-Shenoy message
+    passing. One propagation gives the posterior of every node.
+
+    Evidence on any node is a likelihood multiplied into the joint, as SMILE's
+    virtual evidence is, so soft evidence on a node without parents weighs its
+    prior rather than replacing it (see InferenceContext.intervene for that).
+    A single state of a node without parents is certain even where its prior
+    is 0, as set_fact always gave, where SMILE finds such evidence impossible.
+    Evidence vectors may be (batch, states) arrays, which propagates the whole
+    batch at once and gives (batch, states) posteriors.
+
+    A tree never changes after it is built: evidence only lives in the
+    arguments and locals of propagate, so any number of threads can share one.
+    """
+
+    def __init__(self, nodes, probability_matrix):
+        self.nodes = nodes
+        self.probability_matrix = probability_matrix
+        self.card = {name: len(node["states"]) for name, node in nodes.items()}
+
+        # moralise: connect every node with its parents, and co-parents with each other
+        neighbours = {name: set() for name in nodes}
+        for name, node in nodes.items():
+            family = node["parents"] + [name]
+            for a, b in combinations(family, 2):
+                neighbours[a].add(b)
+                neighbours[b].add(a)
+        self.cliques = [tuple(sorted(clique)) for clique in _triangulate(neighbours, self.card)]
+
+        # maximum weight spanning tree on separator size (Kruskal), empty
+        # separators join disconnected parts into a single tree
+        candidates = sorted(
+            combinations(range(len(self.cliques)), 2),
+            key=lambda ij: -len(set(self.cliques[ij[0]]) & set(self.cliques[ij[1]])),
+        )
+        component = list(range(len(self.cliques)))
+
+        def find(i):
+            while component[i] != i:
+                i = component[i]
+            return i
+
+        self.adjacent = [[] for _ in self.cliques]
+        for i, j in candidates:
+            if find(i) != find(j):
+                component[find(i)] = find(j)
+                self.adjacent[i].append(j)
+                self.adjacent[j].append(i)
+
+        # collect towards clique 0, distribute back out in the reverse order
+        self.order = [0]
+        self.parent = {0: None}
+        for i in self.order:
+            for j in self.adjacent[i]:
+                if j not in self.parent:
+                    self.parent[j] = i
+                    self.order.append(j)
+
+        # each node's CPT goes to the smallest clique that holds its family,
+        # each node is read off the smallest clique that holds it
+        self.home = {}
+        self.lookup = {}
+        assigned = [[] for _ in self.cliques]
+        by_size = sorted(range(len(self.cliques)), key=lambda i: np.prod([self.card[n] for n in self.cliques[i]]))
+        for name, node in nodes.items():
+            family = set(node["parents"] + [name])
+            self.home[name] = next(i for i in by_size if family <= set(self.cliques[i]))
+            self.lookup[name] = next(i for i in by_size if name in self.cliques[i])
+            if node["parents"]:
+                assigned[self.home[name]].append((node["parents"] + [name], probability_matrix[name]))
+        self.priors = {name: probability_matrix[name] for name, node in nodes.items() if not node["parents"]}
+
+        # clique potentials without priors and evidence, which are added per propagation
+        self.base = []
+        for clique, factors in zip(self.cliques, assigned):
+            ones = np.ones([self.card[n] for n in clique])
+            self.base.append(_contract([(clique, ones)] + factors, clique))
+        # shared between threads, so make accidental in-place updates fail loudly
+        for potential in self.base:
+            potential.setflags(write=False)
+        self._sides = None
+        self._separators = {}
+
+    @classmethod
+    def from_layout(cls, nodes, probability_matrix, layout, base):
+        """
+        Rebuild a tree from layout() and its base potentials, without
+        triangulating again
+        """
+        tree = cls.__new__(cls)
+        tree.nodes = nodes
+        tree.probability_matrix = probability_matrix
+        tree.card = {name: len(node["states"]) for name, node in nodes.items()}
+        tree.cliques = [tuple(clique) for clique in layout["cliques"]]
+        tree.adjacent = layout["adjacent"]
+        tree.order = layout["order"]
+        tree.parent = {child: parent for child, parent in layout["parent"]}
+        tree.home = layout["home"]
+        tree.lookup = layout["lookup"]
+        tree.priors = {name: probability_matrix[name] for name, node in nodes.items() if not node["parents"]}
+        tree.base = base
+        tree._sides = None
+        tree._separators = {}
+        return tree
+
+    def layout(self):
+        """
+        JSON-able structure of the tree, everything but the base potentials
+        """
+        return {
+            "cliques": [list(clique) for clique in self.cliques],
+            "adjacent": self.adjacent,
+            "order": self.order,
+            "parent": list(self.parent.items()),
+            "home": self.home,
+            "lookup": self.lookup,
+        }
+
+    def separator(self, i, j):
+        separator = self._separators.get((i, j))
+        if separator is None:
+            separator = tuple(n for n in self.cliques[i] if n in self.cliques[j])
+            self._separators[i, j] = separator
+        return separator
+
+    def propagate(self, values):
+        """
+        Calibrate the tree for the given evidence and return clique beliefs
+        """
+        vectors = [[] for _ in self.cliques]
+        for name, prior in self.priors.items():
+            if name not in values:
+                vectors[self.home[name]].append(((name,), prior))
+        for name, vec in values.items():
+            vec = np.asarray(vec, dtype=float)
+            if name in self.priors:
+                vec = _weigh(self.priors[name], vec)
+            vectors[self.home[name]].append(((name,), vec))
+        potentials = [
+            _contract([(clique, base)] + vecs, clique) if vecs else base
+            for clique, base, vecs in zip(self.cliques, self.base, vectors)
+        ]
+
+        messages = {}
+
+        def incoming(i, exclude=None):
+            return [(self.separator(j, i), messages[j, i]) for j in self.adjacent[i] if j != exclude]
+
+        for i in reversed(self.order[1:]):
+            p = self.parent[i]
+            messages[i, p] = _contract([(self.cliques[i], potentials[i])] + incoming(i, p), self.separator(i, p))
+        for i in self.order:
+            for j in self.adjacent[i]:
+                if self.parent.get(j) == i:
+                    messages[i, j] = _contract([(self.cliques[i], potentials[i])] + incoming(i, j), self.separator(i, j))
+
+        return [
+            _contract([(clique, potential)] + incoming(i), clique)
+            for i, (clique, potential) in enumerate(zip(self.cliques, potentials))
+        ]
+
+    def marginals(self, values, nodes=None):
+        beliefs = self.propagate(values)
+        output = {}
+        for name in self.nodes if nodes is None else nodes:
+            i = self.lookup[name]
+            output[name] = _normalise(name, _contract([(self.cliques[i], beliefs[i])], (name,)))
+        return output
+
+    @property
+    def sides(self):
+        """
+        (i, j) -> cliques on i's side of the edge between cliques i and j,
+        i.e. the ones whose evidence the message from i to j carries
+        """
+        if self._sides is None:
+            sides = {}
+            for i in range(len(self.cliques)):
+                for j in self.adjacent[i]:
+                    side = {i}
+                    stack = [k for k in self.adjacent[i] if k != j]
+                    while stack:
+                        k = stack.pop()
+                        side.add(k)
+                        stack += [m for m in self.adjacent[k] if m not in side]
+                    sides[i, j] = frozenset(side)
+            self._sides = sides
+        return self._sides
+
+
+def _is_hard(vec):
+    # a single state in every row
+    vec = np.asarray(vec)
+    return ((vec == 0) | (vec == 1)).all() and (vec.sum(axis=-1) == 1).all()
+
+
+def _weigh(prior, vec):
+    # evidence on a root times its prior, except rows of a single state
+    hard = ((vec == 0) | (vec == 1)).all(axis=-1, keepdims=True) & (vec.sum(axis=-1, keepdims=True) == 1)
+    return np.where(hard, vec, vec * prior)
+
+
+def _normalise(name, marginal):
+    total = marginal.sum(axis=-1, keepdims=True)
+    if marginal.ndim == 1 and not total[0] > 0:
+        raise ValueError(f"Evidence has zero probability, can't infer {name}")
+    # batched rows with impossible evidence come out as nan
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(total > 0, marginal / total, np.nan)
+
+
+class InferenceContext:
+    """
+    Evidence held across several queries on one junction tree.
+
+    Messages are computed only as the queried nodes need them and kept, and
+    changing the evidence on one node only drops the messages leaving the
+    side of the tree that holds it. Queries that each change a little evidence,
+    like reading outcomes before and after setting infection, then cost a
+    fraction of a full propagation each.
+
+    A context can also evaluate its evidence under other CPTs, e.g. batches of
+    sampled ones, and condition on fixed states by slicing the CPTs rather
+    than multiplying in evidence, which keeps batched potentials small.
+
+    A context is meant for one thread, the tree it reads may be shared.
+    """
+
+    def __init__(self, tree, values=None, cpts=None, fixed=None):
+        """
+        Params:
+            tree - JunctionTree
+            values - initial evidence, as for JunctionTree.propagate
+            cpts - node -> CPT to use in place of the tree's, optionally with
+                leading batch axes (for nodes the tree holds with the same parents)
+            fixed - node -> index of the state it is known to be in
+        """
+        self.tree = tree
+        self.cpts = cpts or {}
+        self.fixed = fixed or {}
+        self.values = {}
+        self._potentials = {}
+        self._messages = {}
+        if self.cpts or self.fixed:
+            self._base = {}
+            self.priors = {name: self.cpts.get(name, prior) for name, prior in tree.priors.items() if name not in self.fixed}
+        else:
+            self._base = dict(enumerate(tree.base))
+            self.priors = tree.priors
+        for name, vec in (values or {}).items():
+            self.set(name, vec)
+
+    def set(self, name, vec):
+        """
+        Set or replace the evidence on a node. Nodes the tree doesn't hold
+        were pruned as irrelevant to its queries and are ignored.
+        """
+        if name not in self.tree.home:
+            return
+        if name in self.fixed:
+            raise ValueError(f"{name} is fixed in this context")
+        self.values[name] = np.asarray(vec, dtype=float)
+        self._invalidate(self.tree.home[name])
+
+    def clear(self, name):
+        if self.values.pop(name, None) is not None:
+            self._invalidate(self.tree.home[name])
+
+    def intervene(self, name, vec):
+        """
+        Set a node to vec by intervention: vec replaces its CPT for every
+        state of its parents (its prior for a node without parents), so what
+        it depends on keeps its distribution. Unlike evidence, this can set a
+        node to a state that is impossible given the rest.
+        """
+        tree = self.tree
+        if name not in tree.home:
+            return
+        if name in self.fixed:
+            raise ValueError(f"{name} is fixed in this context")
+        vec = np.asarray(vec, dtype=float)
+        parents = tree.nodes[name]["parents"]
+        self.values.pop(name, None)
+        if not parents:
+            self.priors = dict(self.priors)
+            self.priors[name] = vec
+            self._invalidate(tree.home[name])
+            return
+        cpt = tree.probability_matrix[name]
+        self.cpts = dict(self.cpts)
+        self.cpts[name] = np.broadcast_to(
+            vec.reshape(vec.shape[:-1] + (1,) * len(parents) + vec.shape[-1:]), vec.shape[:-1] + cpt.shape
+        )
+        self._base.pop(tree.home[name], None)
+        self._invalidate(tree.home[name])
+
+    def _invalidate(self, clique):
+        self._potentials.pop(clique, None)
+        for edge in [edge for edge in self._messages if clique in self.tree.sides[edge]]:
+            del self._messages[edge]
+
+    def _vars(self, names):
+        return tuple(name for name in names if name not in self.fixed)
+
+    def _base_potential(self, i):
+        if i not in self._base:
+            tree = self.tree
+            factors = []
+            for name, node in tree.nodes.items():
+                if node["parents"] and tree.home[name] == i:
+                    family = node["parents"] + [name]
+                    cpt = self.cpts.get(name, tree.probability_matrix[name])
+                    index = tuple(self.fixed.get(var, slice(None)) for var in family)
+                    factors.append((self._vars(family), cpt[(Ellipsis,) + index]))
+            clique = self._vars(tree.cliques[i])
+            self._base[i] = _contract([(clique, np.ones([tree.card[n] for n in clique]))] + factors, clique)
+        return self._base[i]
+
+    def _potential(self, i):
+        if i not in self._potentials:
+            tree = self.tree
+            vecs = [((name,), prior) for name, prior in self.priors.items() if tree.home[name] == i and name not in self.values]
+            vecs += [
+                ((name,), _weigh(self.priors[name], vec) if name in self.priors else vec)
+                for name, vec in self.values.items()
+                if tree.home[name] == i
+            ]
+            clique = self._vars(tree.cliques[i])
+            base = self._base_potential(i)
+            self._potentials[i] = _contract([(clique, base)] + vecs, clique) if vecs else base
+        return self._potentials[i]
+
+    def _incoming(self, i, exclude=None):
+        return [(self._vars(self.tree.separator(j, i)), self._message(j, i)) for j in self.tree.adjacent[i] if j != exclude]
+
+    def _message(self, i, j):
+        if (i, j) not in self._messages:
+            self._messages[i, j] = _contract(
+                [(self._vars(self.tree.cliques[i]), self._potential(i))] + self._incoming(i, j),
+                self._vars(self.tree.separator(i, j)),
+            )
+        return self._messages[i, j]
+
+    def marginals(self, nodes):
+        """
+        Posterior distributions of the nodes under the current evidence
+        """
+        beliefs = {}
+        output = {}
+        for name in nodes:
+            i = self.tree.lookup[name]
+            clique = self._vars(self.tree.cliques[i])
+            if i not in beliefs:
+                beliefs[i] = _contract([(clique, self._potential(i))] + self._incoming(i), clique)
+            if name in self.fixed:
+                # whatever is left of the belief is the probability of the evidence
+                total = beliefs[i].reshape(beliefs[i].shape[: beliefs[i].ndim - len(clique)] + (-1,)).sum(axis=-1)
+                marginal = total[..., None] * _unit_vec_for_state(self.tree.nodes[name]["states"], self.tree.nodes[name]["states"][self.fixed[name]])
+            else:
+                marginal = _contract([(clique, beliefs[i])], (name,))
+            output[name] = _normalise(name, marginal)
+        return output
+
+
+# compiled models: magic, header length, JSON header, padding to 8 bytes,
+# then every CPT and base potential as float64
+compiled_magic = b"XDSLC1\n"
+
+
+def compiled_path(path):
+    return path.with_name(path.name + ".compiled")
+
+
+def write_compiled(path, source_sha256, nodes, probability_matrix, junction_tree):
+    """
+    Write the parsed network and its junction tree next to the xdsl file
+    """
+    arrays = []
+    offset = 0
+
+    def add(array):
+        nonlocal offset
+        spec = [offset, list(array.shape)]
+        arrays.append(np.ascontiguousarray(array, dtype="<f8").ravel())
+        offset += array.size
+        return spec
+
+    header = {
+        "source_sha256": source_sha256,
+        "nodes": {
+            name: {"states": node["states"], "parents": node["parents"], "cpt": add(probability_matrix[name])}
+            for name, node in nodes.items()
+        },
+        "junction_tree": dict(junction_tree.layout(), base=[add(potential) for potential in junction_tree.base]),
+    }
+    encoded = json.dumps(header).encode("utf8")
+    start = len(compiled_magic) + 8 + len(encoded)
+    padding = b"\0" * (-start % 8)
+
+    # write then rename, so concurrent readers never see half a file
+    target = compiled_path(path)
+    tmp = target.with_name(f"{target.name}.{os.getpid()}.tmp")
+    with tmp.open("wb") as f:
+        f.write(compiled_magic + len(encoded).to_bytes(8, "little") + encoded + padding)
+        f.write(np.concatenate(arrays).tobytes())
+    os.replace(tmp, target)
+
+
+def read_compiled(path, source_sha256):
+    """
+    (nodes, probability_matrix, junction_tree) from the compiled file, or None
+    if there is none for this version of the source. The arrays are read-only
+    maps of the file, so processes loading the same model share the memory.
+    """
+    target = compiled_path(path)
+    try:
+        with target.open("rb") as f:
+            if f.read(len(compiled_magic)) != compiled_magic:
+                return None
+            size = int.from_bytes(f.read(8), "little")
+            header = json.loads(f.read(size))
+    except (OSError, ValueError):
+        return None
+    if header["source_sha256"] != source_sha256:
+        return None
+
+    start = len(compiled_magic) + 8 + size
+    data = np.asarray(np.memmap(target, dtype="<f8", mode="r", offset=start + -start % 8))
+
+    def get(spec):
+        offset, shape = spec
+        return data[offset : offset + math.prod(shape)].reshape(shape)
+
+    nodes = {}
+    probability_matrix = {}
+    for name, node in header["nodes"].items():
+        probability_matrix[name] = get(node["cpt"])
+        nodes[name] = {
+            "states": node["states"],
+            "parents": node["parents"],
+            "probabilities": probability_matrix[name].ravel().tolist(),
+        }
+    layout = header["junction_tree"]
+    junction_tree = JunctionTree.from_layout(nodes, probability_matrix, layout, [get(spec) for spec in layout["base"]])
+    return nodes, probability_matrix, junction_tree
+
+
 class Model:
-    def __init__(self, filename):
-        with (Path(__file__).parent / filename).open() as f:
-            self.tree = etree.parse(f)
-        self.nodes = load_model_facts(self.tree)
+    """
+    Bayesian network read from an xdsl file.
+
+    Evidence is passed in to every call rather than stored on the model, so
+    one instance can serve concurrent requests without locking.
+    """
+
+    def __init__(self, filename, compile=True, prune=True):
+        """
+        Params:
+            filename - xdsl file, relative to this directory
+            compile - load from (and write) the compiled file next to the
+                xdsl file when it matches the source, rather than parsing
+            prune - answer queries for some nodes on the part of the network
+                they depend on, see plan
+        """
+        self.path = Path(__file__).parent / filename
+        source = self.path.read_bytes()
+        self.source_sha256 = hashlib.sha256(source).hexdigest()
+        self.prune = prune
+        self._tree = None
+        self._junction_tree = None
+        self._plans = {}
+        self._samples = {}
+        self._lock = threading.Lock()
+        self._plan_lock = threading.Lock()
+
+        compiled = read_compiled(self.path, self.source_sha256) if compile else None
+        if compiled is not None:
+            self.nodes, self.probability_matrix, self._junction_tree = compiled
+            return
+
+        self._tree = etree.ElementTree(etree.fromstring(source))
+        self.nodes = load_model_facts(self._tree)
         self.probability_matrix = generate_prob_mx(self.nodes)
+        for cpt in self.probability_matrix.values():
+            cpt.setflags(write=False)
+        if compile:
+            try:
+                write_compiled(self.path, self.source_sha256, self.nodes, self.probability_matrix, self.junction_tree)
+                logger.info(f"Compiled {self.path.name}")
+            except OSError as e:
+                logger.warning(f"Could not write compiled {self.path.name}: {e}")
+
+    @property
+    def tree(self):
+        """
+        Parsed xdsl document, read on first use when loaded from the compiled file
+        """
+        if self._tree is None:
+            self._tree = etree.parse(str(self.path))
+        return self._tree
 
     def unit_vec_for_state(self, node, state):
         return _unit_vec_for_state(self.nodes[node]["states"], state)
@@ -68,18 +656,321 @@ class Model:
         assert np.sum(state_dist) == 1.0
         values[node] = state_dist
 
+    @property
+    def junction_tree(self):
+        # built on first use, threads arriving meanwhile wait for it rather
+        # than building their own
+        if self._junction_tree is None:
+            with self._lock:
+                if self._junction_tree is None:
+                    self._junction_tree = JunctionTree(self.nodes, self.probability_matrix)
+        return self._junction_tree
+
+    def plan(self, values, nodes):
+        """
+        Junction tree for inferring nodes given evidence like values: only the
+        nodes the answer depends on (see _requisite), with the observed nodes
+        they are conditioned on as roots. Plans depend on the queried nodes,
+        the evidence nodes and whether each one's evidence is hard, and are
+        built once per such signature.
+        """
+        observed = {name for name, vec in values.items() if _is_hard(vec)}
+        likelihood = set(values) - observed
+        key = (frozenset(nodes), frozenset(observed), frozenset(likelihood))
+        tree = self._plans.get(key)
+        if tree is None:
+            with self._plan_lock:
+                tree = self._plans.get(key)
+                if tree is None:
+                    tree = self._build_plan(nodes, observed, likelihood)
+                    self._plans[key] = tree
+        return tree
+
+    def _build_plan(self, nodes, observed, likelihood):
+        requisite = _requisite(self.nodes, nodes, observed, likelihood)
+        if len(requisite) == len(self.nodes):
+            return self.junction_tree
+        # observed parents and targets outside the requisite nodes are only
+        # conditioned on, so they become roots with a flat prior under their evidence
+        conditioning = {parent for name in requisite for parent in self.nodes[name]["parents"]} | set(nodes)
+        sub_nodes = {}
+        probability_matrix = {}
+        for name in sorted(requisite | conditioning):
+            if name in requisite:
+                sub_nodes[name] = self.nodes[name]
+                probability_matrix[name] = self.probability_matrix[name]
+            else:
+                states = self.nodes[name]["states"]
+                sub_nodes[name] = {"states": states, "parents": [], "probabilities": [1 / len(states)] * len(states)}
+                probability_matrix[name] = np.full(len(states), 1 / len(states))
+        logger.debug(f"Pruned {self.path.name} to {len(sub_nodes)} of {len(self.nodes)} nodes for {sorted(nodes)}")
+        return JunctionTree(sub_nodes, probability_matrix)
+
+    def posteriors(self, values, nodes=None, interventions=None):
+        """
+        Infer probability distributions of all nodes (or just the given ones)
+        in a single pass over the junction tree
+
+        Params:
+            values - evidence, node -> state vector
+            nodes - nodes to return, defaults to all
+            interventions - node -> state vector the node is set to rather
+                than observed in, see InferenceContext.intervene
+        """
+        if interventions:
+            tree = self.junction_tree if nodes is None else self._context_plan(values, nodes, interventions)
+            context = InferenceContext(tree, values)
+            for name, vec in interventions.items():
+                context.intervene(name, vec)
+            return context.marginals(list(tree.nodes) if nodes is None else nodes)
+        if nodes is None or not self.prune:
+            return self.junction_tree.marginals(values, nodes)
+        tree = self.plan(values, nodes)
+        return tree.marginals({name: vec for name, vec in values.items() if name in tree.nodes}, nodes)
+
+    def split_roots(self, values):
+        """
+        Split evidence into (evidence on nodes with parents, evidence on nodes
+        without), for passing the latter as interventions that replace their
+        priors, as evidence on roots used to
+        """
+        roots = {name: vec for name, vec in values.items() if not self.nodes[name]["parents"]}
+        return {name: vec for name, vec in values.items() if name not in roots}, roots
+
     def infer(self, values, node):
         """
         Infer probability distribution of the node
         """
-        if node in values:
-            return values[node]
-        parent_names = self.nodes[node]["parents"]
-        if not parent_names:
-            raise ValueError(f"Node {node} has no parents and haven't set_fact")
-        cur = self.probability_matrix[node]
-        # we multiply them right to left
-        for parent in reversed(parent_names):
-            parent_vec = self.infer(values, parent)
-            cur = parent_vec @ cur
-        return cur
+        return self.posteriors(values, [node])[node]
+
+    def batch_evidence(self, rows, priors=False):
+        """
+        Stack evidence dictionaries (node -> state or vector, as for
+        SmileModel.set_evidence) into node -> (batch, states) arrays.
+        Rows without evidence on a node get a flat likelihood, or with priors
+        its prior if it has no parents, for setting roots by intervention.
+        """
+        evidence = {}
+        for node in {node for row in rows for node in row}:
+            states = self.nodes[node]["states"]
+            default = self.probability_matrix[node] if priors and not self.nodes[node]["parents"] else np.ones(len(states))
+            stacked = np.tile(default, (len(rows), 1))
+            for i, row in enumerate(rows):
+                if node not in row:
+                    continue
+                value = row[node]
+                if isinstance(value, str):
+                    if value not in states:
+                        logger.error(f"Error in setting evidence {value} to node {node}")
+                        continue
+                    value = _unit_vec_for_state(states, value)
+                stacked[i] = value
+            evidence[node] = stacked
+        return evidence
+
+    def posteriors_batch(self, evidence, nodes=None):
+        """
+        Infer probability distributions for a batch of scenarios in one pass
+
+        Params:
+            evidence - node -> (batch, states) array, e.g. from batch_evidence
+            nodes - nodes to return, defaults to all
+        Returns node -> (batch, states) array, nan for rows with impossible evidence
+        """
+        return self.posteriors(evidence, nodes)
+
+    def sample_cpts(self, concentration, samples, seed=0):
+        """
+        Draws of the CPTs as Dirichlet distributions centred on their rows.
+        Rows of only 0s and 1s are certain and kept as they are. The draws
+        for a given set of arguments are made once and kept, so repeated
+        queries give the same intervals.
+
+        Params:
+            concentration - node -> Dirichlet concentration (the weight of
+                evidence behind each CPT row, in observations, and at least
+                enough for one observation of its least likely state), nodes
+                left out keep their CPT
+            samples - number of draws
+            seed - random seed
+        Returns node -> (samples, ...CPT shape) array
+        """
+        key = (tuple(sorted(concentration.items())), samples, seed)
+        cpts = self._samples.get(key)
+        if cpts is None:
+            rng = np.random.default_rng(seed)
+            cpts = {}
+            for name, alpha in sorted(concentration.items()):
+                cpt = np.asarray(self.probability_matrix[name])
+                rows = cpt.reshape(-1, cpt.shape[-1])
+                certain = ((rows == 0) | (rows == 1)).all(axis=-1)
+                noisy = rows[~certain]
+                # a rare state with a weight below one observation would mostly
+                # be drawn at vanishing probabilities (lower bounds of 1e-30
+                # for a risk of 1e-5), so such rows weigh more
+                weight = np.maximum(alpha, 1 / np.where(noisy > 0, noisy, 1).min(axis=-1, keepdims=True))
+                # normalised gamma draws are Dirichlet, states with probability
+                # 0 stay that way
+                draws = rng.gamma(weight * noisy, size=(samples,) + noisy.shape)
+                sampled = np.tile(rows, (samples, 1, 1))
+                sampled[:, ~certain] = draws / draws.sum(axis=-1, keepdims=True)
+                cpts[name] = sampled.reshape((samples,) + cpt.shape)
+                cpts[name].setflags(write=False)
+            self._samples[key] = cpts
+        return cpts
+
+    def _context_plan(self, evidence, nodes, varying):
+        # plan for soft evidence on the varying nodes, which keeps every node
+        # that hard evidence on them could leave relevant
+        signature = dict(evidence, **{name: np.ones(len(self.nodes[name]["states"])) for name in varying})
+        return self.plan(signature, nodes) if self.prune else self.junction_tree
+
+    def context(self, rows, nodes, varying=(), replace_priors=False):
+        """
+        InferenceContext for querying nodes in a batch of scenarios while the
+        evidence on the varying nodes changes, on the part of the network the
+        nodes depend on under any such evidence
+
+        Params:
+            rows - evidence dictionaries, as for infer_batch
+            nodes - nodes that will be queried
+            varying - nodes whose evidence will be set or changed later
+            replace_priors - set nodes without parents by intervention, see
+                split_roots
+        """
+        evidence = self.batch_evidence(rows, priors=replace_priors)
+        tree = self._context_plan(evidence, nodes, varying)
+        if not replace_priors:
+            return InferenceContext(tree, evidence)
+        evidence, roots = self.split_roots(evidence)
+        context = InferenceContext(tree, evidence)
+        for name, vec in roots.items():
+            context.intervene(name, vec)
+        return context
+
+    def sampled_contexts(self, rows, nodes, cpts, varying=()):
+        """
+        One InferenceContext per row, like context, that evaluates the row
+        under every sample in cpts at once: posteriors are (samples, states).
+        Each row's hard evidence is conditioned on by slicing the sampled CPTs.
+
+        Params:
+            cpts - node -> (samples, ...CPT shape) array, e.g. from sample_cpts
+        """
+        tree = self._context_plan(self.batch_evidence(rows), nodes, varying)
+        # nodes the plan only conditions on have lost their parents and CPT
+        cpts = {name: cpt for name, cpt in cpts.items() if tree.nodes.get(name) is self.nodes[name]}
+        contexts = []
+        for row in rows:
+            fixed = {}
+            values = {}
+            for name, value in row.items():
+                if name not in tree.home:
+                    continue
+                states = self.nodes[name]["states"]
+                if isinstance(value, str):
+                    if value not in states:
+                        logger.error(f"Error in setting evidence {value} to node {name}")
+                        continue
+                    fixed[name] = states.index(value)
+                else:
+                    values[name] = value
+            contexts.append(InferenceContext(tree, values, cpts, fixed))
+        return contexts
+
+    def sensitivity(self, values, nodes, top_k=None):
+        """
+        Derivatives of the probability of each node's first state given values
+        with respect to every CPT entry, from one batched propagation.
+
+        Entries of a CPT row are co-varied proportionally (raising one scales
+        the rest of its row down), so a derivative is
+            P(y|e) * ((P(x,u|y,e) - P(x,u|e)) / t - (P(u|y,e) - P(u|e) - P(x,u|y,e) + P(x,u|e)) / (1 - t))
+        for the entry t = P(x|u), read off the family marginals with and without
+        y. Entries of 0 or 1, priors of roots with hard evidence and CPTs the
+        nodes don't depend on (see plan) have no derivative.
+
+        Params:
+            values - evidence, node -> state vector
+            nodes - node names
+            top_k - keep only the largest derivatives by magnitude
+        Returns list of dictionaries, largest derivative first: node,
+        probability (of its first state), parameter (the CPT's node), parents
+        (parent -> state), state, value and derivative
+        """
+        tree = self.plan(values, nodes) if self.prune else self.junction_tree
+        values = {name: np.asarray(vec, dtype=float) for name, vec in values.items() if name in tree.nodes}
+        nodes = list(nodes)
+
+        # row 0 has the evidence, row 1 + k also has the first state of nodes[k]
+        evidence = {}
+        for name in set(values) | set(nodes):
+            stacked = np.tile(values.get(name, np.ones(tree.card[name])), (1 + len(nodes), 1))
+            for k, node in enumerate(nodes):
+                if node == name:
+                    stacked[1 + k] *= _unit_vec_for_state(self.nodes[name]["states"], self.nodes[name]["states"][0])
+            evidence[name] = stacked
+        beliefs = tree.propagate(evidence)
+        if not beliefs[0][0].sum() > 0:
+            raise ValueError("Evidence has zero probability, can't compute sensitivities")
+        probability = np.array([_normalise(node, _contract([(tree.cliques[tree.lookup[node]], beliefs[tree.lookup[node]][0])], (node,)))[0] for node in nodes])
+
+        names = []
+        derivatives = []
+        for name, node in tree.nodes.items():
+            # conditioned-on nodes of a pruned plan, and priors of observed roots
+            if node is not self.nodes.get(name) or (not node["parents"] and name in values and _is_hard(values[name])):
+                continue
+            family = node["parents"] + [name]
+            i = tree.home[name]
+            joint = _contract([(tree.cliques[i], beliefs[i])], family)
+            theta = self.probability_matrix[name]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                marginal = joint / joint.reshape(len(joint), -1).sum(axis=-1).reshape((-1,) + (1,) * len(family))
+                diff = marginal[1:] - marginal[:1]
+                diff_parents = diff.sum(axis=-1, keepdims=True)
+                derivative = probability.reshape((-1,) + (1,) * len(family)) * (diff / theta - (diff_parents - diff) / (1 - theta))
+            names.append(name)
+            derivatives.append(np.where((theta > 0) & (theta < 1), derivative, np.nan).reshape(len(nodes), -1))
+
+        # pick the largest over every CPT at once, then find where each came from
+        flat = np.abs(np.concatenate(derivatives, axis=1)) if derivatives else np.zeros((len(nodes), 0))
+        flat = np.where(np.isfinite(flat), flat, -1)
+        offsets = np.cumsum([0] + [d.shape[1] for d in derivatives])
+        order = np.argsort(-flat, axis=None, kind="stable")
+        if top_k is not None:
+            order = order[:top_k]
+        output = []
+        for k, column in zip(*np.unravel_index(order, flat.shape)):
+            if flat[k, column] < 0:
+                break
+            n = np.searchsorted(offsets, column, side="right") - 1
+            name = names[n]
+            index = np.unravel_index(column - offsets[n], self.probability_matrix[name].shape)
+            parents = self.nodes[name]["parents"]
+            output.append(
+                {
+                    "node": nodes[k],
+                    "probability": float(probability[k]),
+                    "parameter": name,
+                    "parents": {parent: self.nodes[parent]["states"][ix] for parent, ix in zip(parents, index[:-1])},
+                    "state": self.nodes[name]["states"][index[-1]],
+                    "value": float(self.probability_matrix[name][index]),
+                    "derivative": float(derivatives[n][k, column - offsets[n]]),
+                }
+            )
+        return output
+
+    def infer_batch(self, rows, nodes):
+        """
+        Same as SmileModel.infer_batch, in a single tensor pass
+        """
+        posteriors = self.posteriors_batch(self.batch_evidence(rows), nodes)
+        return {node: np.broadcast_to(dist, (len(rows), dist.shape[-1])) for node, dist in posteriors.items()}
+
+
+if __name__ == "__main__":
+    # compile the given or all bundled networks, e.g. while building the image
+    logging.basicConfig(format="%(asctime)s: %(name)s: %(message)s", level=logging.INFO)
+    for filename in sys.argv[1:] or sorted(p.name for p in Path(__file__).parent.glob("*.xdsl")):
+        Model(filename)